@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+
+#
+# copyright Tom Goetz
+#
+
+import logging, collections
+
+import HealthDB
+import GarminDB
+
+
+logger = logging.getLogger(__file__)
+
+
+#
+# Gathers the Activities and sport table rows for each activity from all of its sources, the summary and details JSON and the
+# FIT, TCX, and GPX files, and writes each row once. Sources are added in the order they were previously written in, so a value
+# from a later source replaces one from an earlier source, except for fill_only columns, which are only set if no source or
+# existing row has a value, ex: the FIT sport, because the JSON sport is more specific.
+#
+class ActivityAssembler():
+
+    def __init__(self, db_params_dict, debug):
+        self.debug = debug
+        self.garmin_act_db = GarminDB.ActivitiesDB(db_params_dict, debug - 1)
+        self.rows = collections.OrderedDict()
+        self.rows_added = 0
+
+    def add(self, table, values_dict, fill_only=[]):
+        (values, fill_columns) = self.rows.setdefault((table, values_dict['activity_id']), ({}, set()))
+        for (column, value) in values_dict.iteritems():
+            if value is None:
+                continue
+            if column not in fill_only:
+                values[column] = value
+                fill_columns.discard(column)
+            elif column not in values:
+                values[column] = value
+                fill_columns.add(column)
+        self.rows_added += 1
+
+    def write(self):
+        buffer = HealthDB.WriteBuffer(self.garmin_act_db)
+        try:
+            for ((table, activity_id), (values, fill_columns)) in self.rows.iteritems():
+                buffer.create_or_update(table, values, True, list(fill_columns))
+        finally:
+            buffer.close()
+        logger.info("Wrote %d activity rows assembled from %d", len(self.rows), self.rows_added)
+        self.rows.clear()
+        self.rows_added = 0
@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+
+#
+# copyright Tom Goetz
+#
+
+import logging, re
+
+import Fit
+import HealthDB
+import GarminDB
+from ActivityAssembler import ActivityAssembler
+
+
+logger = logging.getLogger(__file__)
+
+
+class Stats():
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self.max = None
+        self.min = None
+
+    def add(self, value):
+        if value is not None:
+            self.count += 1
+            self.total += value
+            self.max = max(self.max, value)
+            self.min = value if self.min is None else min(self.min, value)
+
+    def avg(self):
+        if self.count > 0:
+            return int(self.total / self.count)
+
+
+#
+# Base class for the importers of activity files that aren't FIT files: sets up the DBs, the write buffer for laps and
+# records, and the assembler for the activity row, converts units, and records the file and the device that created it.
+#
+class ActivityFileProcessor():
+
+    file_type = None
+
+    def __init__(self, db_params_dict, english_units, debug, assembler=None):
+        self.english_units = english_units
+        self.debug = debug
+        self.garmin_db = GarminDB.GarminDB(db_params_dict, debug - 1)
+        self.garmin_act_db = GarminDB.ActivitiesDB(db_params_dict, debug - 1)
+        self.garmin_act_buffer = HealthDB.WriteBuffer(self.garmin_act_db)
+        # the activity rows are written by the caller if it passed in the assembler
+        self.own_assembler = assembler is None
+        self.assembler = ActivityAssembler(db_params_dict, debug) if self.own_assembler else assembler
+        self.time_parser = HealthDB.DateParser(ignoretz=True)
+        self.activity_id = None
+        logger.info("Debug: %s English units: %s", str(debug), str(english_units))
+
+    def close(self):
+        self.garmin_act_buffer.close()
+        if self.own_assembler:
+            self.assembler.write()
+
+    @classmethod
+    def local_name(cls, tag):
+        return tag.rsplit('}', 1)[-1]
+
+    def convert_distance(self, meters):
+        if meters is None:
+            return None
+        if self.english_units:
+            return Fit.Conversions.meters_to_miles(meters)
+        return meters / 1000.0
+
+    def convert_altitude(self, meters):
+        if meters is not None and self.english_units:
+            return Fit.Conversions.meters_to_feet(meters)
+        return meters
+
+    def convert_speed(self, mps):
+        if mps is None:
+            return None
+        if self.english_units:
+            return Fit.Conversions.mps_to_mph(mps)
+        return mps * 3.6
+
+    def convert_temperature(self, celsius):
+        if celsius is not None and self.english_units:
+            return Fit.Conversions.celsius_to_fahrenheit(celsius)
+        return celsius
+
+    def get_activity_id(self):
+        # the file is recorded before its laps and records, the device that created it is only known at the end of the file
+        if self.activity_id is None:
+            GarminDB.File.find_or_create(self.garmin_db, {'name' : self.file_name, 'type' : self.file_type})
+            self.activity_id = GarminDB.File.get(self.garmin_db, self.file_name)
+            # laps and records are inserted rather than looked up and updated, so first remove any from an earlier import of the file
+            self.garmin_act_buffer.delete(GarminDB.ActivityRecords, {'activity_id' : self.activity_id})
+            self.garmin_act_buffer.delete(GarminDB.ActivityLaps, {'activity_id' : self.activity_id})
+        return self.activity_id
+
+    def discard_file(self, file_name):
+        # removes the laps and records written for a file that failed part way through importing, after the ones still queued
+        if self.activity_id is not None:
+            self.garmin_act_buffer.delete(GarminDB.ActivityRecords, {'activity_id' : self.activity_id})
+            self.garmin_act_buffer.delete(GarminDB.ActivityLaps, {'activity_id' : self.activity_id})
+
+    def write_file(self, product, serial_number, timestamp):
+        manufacturer = 'Unknown'
+        if product is not None and re.search('Microsoft', product):
+            manufacturer = Fit.FieldEnums.Manufacturer.Microsoft
+        if serial_number is None or serial_number == 0:
+            serial_number = GarminDB.Device.unknown_device_serial_number
+        device = {
+            'serial_number'     : serial_number,
+            'timestamp'         : timestamp,
+            'manufacturer'      : manufacturer,
+            'product'           : product,
+            'hardware_version'  : None,
+        }
+        GarminDB.Device.create_or_update_not_none(self.garmin_db, device)
+        file = {
+            'name'          : self.file_name,
+            'type'          : self.file_type,
+            'serial_number' : serial_number,
+        }
+        GarminDB.File.create_or_update_not_none(self.garmin_db, file)
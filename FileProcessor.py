@@ -4,8 +4,9 @@
 # copyright Tom Goetz
 #
 
-import logging, sys, os, re, datetime
+import logging, sys, os, re, datetime, zipfile
 
+from RawDataStore import RawDataStore
 
 logger = logging.getLogger(__file__)
 
@@ -15,11 +16,23 @@ class FileProcessor():
     @classmethod
     def match_file(cls, input_file, file_regex):
         logger.info("Reading file: " + input_file)
+        if zipfile.is_zipfile(input_file):
+            return cls.zip_to_files(input_file, file_regex)
         match = re.search(file_regex, input_file)
         if match:
             return [input_file]
         return []
 
+    @classmethod
+    def zip_to_files(cls, input_zip, file_regex, since=None):
+        # zip members are listed as <zip file>/<member> paths
+        file_names = []
+        with zipfile.ZipFile(input_zip, 'r') as files_zip:
+            for info in files_zip.infolist():
+                if re.search(file_regex, info.filename) and (since is None or datetime.datetime(*info.date_time) > since):
+                    file_names.append(input_zip + '/' + info.filename)
+        return file_names
+
     @classmethod
     def dir_to_files(cls, input_dir, file_regex, latest=False):
         logger.info("Reading directory: " + input_dir)
@@ -30,4 +43,21 @@ class FileProcessor():
             file_with_path = input_dir + "/" + file
             if match and (not latest or datetime.datetime.fromtimestamp(os.stat(file_with_path).st_ctime) > timestamp):
                 file_names.append(file_with_path)
+            elif re.search(r'\.zip$', file) and not re.search(RawDataStore.archive_regex, file):
+                if not latest or datetime.datetime.fromtimestamp(os.stat(file_with_path).st_ctime) > timestamp:
+                    file_names.extend(cls.zip_to_files(file_with_path, file_regex))
+        # files in raw data store archives are listed as <archive>/<file> paths
+        file_names.extend(RawDataStore(input_dir).files(file_regex, timestamp if latest else None))
         return file_names
+
+    @classmethod
+    def open_file(cls, file_name):
+        if RawDataStore.member_path(file_name):
+            return RawDataStore.open(file_name)
+        return open(file_name)
+
+    @classmethod
+    def file_size(cls, file_name):
+        if RawDataStore.member_path(file_name):
+            return RawDataStore.size(file_name)
+        return os.path.getsize(file_name)
@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+
+#
+# copyright Tom Goetz
+#
+
+import logging, os, json, csv, struct, threading, multiprocessing, contextlib
+import xml.etree.cElementTree as ElementTree
+
+import FileProcessor
+from JsonFileProcessor import JsonFileProcessor
+
+
+logger = logging.getLogger(__file__)
+
+
+def make_fit_crc_table():
+    # CRC-16 with the reversed 0x8005 polynomial, the CRC FIT files use, a byte at a time
+    table = []
+    for byte in xrange(256):
+        crc = byte
+        for bit in xrange(8):
+            crc = (crc >> 1) ^ 0xA001 if crc & 1 else crc >> 1
+        table.append(crc)
+    return table
+
+fit_crc_table = make_fit_crc_table()
+
+
+def fit_crc(data):
+    crc = 0
+    for byte in bytearray(data):
+        crc = (crc >> 8) ^ fit_crc_table[(crc ^ byte) & 0xff]
+    return crc
+
+
+def validate_file(file_and_columns):
+    # module level so it can be run in a multiprocessing pool, returns the file name and what's wrong with it or None
+    (file_name, required_columns) = file_and_columns
+    try:
+        return (file_name, FileValidator.check_file(file_name, required_columns))
+    except Exception as e:
+        return (file_name, str(e))
+
+
+#
+# Checks the input files before they're imported, so that a corrupt file is skipped instead of ending the import part way through:
+# FIT files by their header and size, JSON and TCX and GPX files by parsing them, and CSV files by their header. The files are
+# checked in a pool of processes if the caller is single threaded. Files that fail the checks, or fail to import, are recorded in
+# the DB's quarantine table and the import goes on without them. A quarantined file that passes the checks when it's imported
+# again is released.
+#
+class FileValidator():
+
+    fit_header_sizes = [12, 14]
+    xml_root_elements = {'.tcx' : 'TrainingCenterDatabase', '.gpx' : 'gpx'}
+
+    def __init__(self, db=None, quarantine_table=None, processes=None):
+        self.db = db
+        self.quarantine_table = quarantine_table
+        self.processes = processes if processes is not None else multiprocessing.cpu_count()
+        self.lock = threading.Lock()
+        self.checked = 0
+        self.skipped = []
+
+    @classmethod
+    def check_fit(cls, fit_file, file_size):
+        # Only the header and the file size are checked up front, a CRC of the whole file in Python takes about as long as
+        # importing it. A file with corrupt data fails when it's decoded during the import and is quarantined then.
+        header = fit_file.read(max(cls.fit_header_sizes))
+        header_size = ord(header[0]) if len(header) > 0 else 0
+        if header_size not in cls.fit_header_sizes or len(header) < header_size:
+            return "not a FIT file, header size %d" % header_size
+        if header[8:12] != '.FIT':
+            return "not a FIT file, no .FIT signature"
+        if header_size == 14:
+            # a header CRC of 0 means it wasn't set
+            (header_crc,) = struct.unpack('<H', header[12:14])
+            if header_crc != 0 and fit_crc(header[:12]) != header_crc:
+                return "FIT header CRC mismatch"
+        (data_size,) = struct.unpack('<I', header[4:8])
+        expected_size = header_size + data_size + 2
+        if file_size < expected_size:
+            return "truncated FIT file, %d of %d bytes" % (file_size, expected_size)
+
+    @classmethod
+    def check_json(cls, json_file):
+        # A JSON array, ex: weight or rhr history, is imported an element at a time so it's checked the same way, without the whole
+        # file in memory. Other JSON files are loaded whole when they're imported.
+        try:
+            start = json_file.read(JsonFileProcessor.chunk_size)
+            if start.lstrip(JsonFileProcessor.whitespace)[:1] == '[':
+                for element in JsonFileProcessor.iter_json_array(json_file, start):
+                    pass
+            else:
+                json.loads(start + json_file.read())
+        except ValueError as e:
+            return "invalid JSON: %s" % str(e)
+
+    @classmethod
+    def check_xml(cls, xml_file, root_element):
+        # checks the root element and that the file is well formed, parsed a piece at a time since activity files can be large
+        root = None
+        try:
+            for (event, element) in ElementTree.iterparse(xml_file, events=('start', 'end')):
+                if root is None:
+                    root = element.tag.rsplit('}', 1)[-1]
+                    if root != root_element:
+                        return "not a %s file, root element %s" % (root_element, root)
+                elif event == 'end':
+                    element.clear()
+        except SyntaxError as e:
+            return "invalid XML: %s" % str(e)
+
+    @classmethod
+    def check_csv(cls, data, required_columns):
+        try:
+            read_csv = csv.reader(data.splitlines(), delimiter=',')
+            header = next(read_csv, None)
+            if header is None:
+                return "empty CSV file"
+            missing = [column for column in required_columns if column not in header]
+            if len(missing) > 0:
+                return "CSV header is missing %s" % ', '.join(missing)
+            for row in read_csv:
+                pass
+        except csv.Error as e:
+            return "invalid CSV: %s" % str(e)
+
+    @classmethod
+    def check_file(cls, file_name, required_columns=[]):
+        extension = os.path.splitext(file_name)[1].lower()
+        if extension not in ['.fit', '.json', '.csv'] + cls.xml_root_elements.keys():
+            return None
+        with FileProcessor.FileProcessor.open_file(file_name) as input_file:
+            if extension == '.fit':
+                return cls.check_fit(input_file, FileProcessor.FileProcessor.file_size(file_name))
+            if extension == '.json':
+                return cls.check_json(input_file)
+            if extension in cls.xml_root_elements:
+                return cls.check_xml(input_file, cls.xml_root_elements[extension])
+            return cls.check_csv(input_file.read(), required_columns)
+
+    def validate(self, *file_sets):
+        # checks the files of the data sets, ex: GarminFitData, and removes the bad ones from their file_names
+        files = [(file_name, getattr(file_set, 'required_columns', [])) for file_set in file_sets for file_name in file_set.file_names]
+        if len(files) == 0:
+            return
+        processes = min(self.processes, len(files))
+        # Forking while other threads hold locks, ex: the DB writers or the downloads of update_garmin, can deadlock the pool's
+        # processes, so the files are only checked in a pool when this is the only thread.
+        if processes > 1 and threading.active_count() == 1:
+            pool = multiprocessing.Pool(processes)
+            try:
+                results = pool.map(validate_file, files, max(1, len(files) / (processes * 4)))
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = map(validate_file, files)
+        errors = {file_name : error for (file_name, error) in results if error is not None}
+        for file_set in file_sets:
+            file_set.file_names = [file_name for file_name in file_set.file_names if file_name not in errors]
+        for (file_name, error) in sorted(errors.iteritems()):
+            self.quarantine(file_name, error)
+        with self.lock:
+            self.checked += len(files)
+        if self.db is not None:
+            released = self.quarantine_table.release(self.db, [file_name for (file_name, error) in results if error is None])
+            if released > 0:
+                logger.info("Released %d files from quarantine", released)
+
+    def quarantine(self, file_name, reason):
+        logger.error("Skipping %s: %s", file_name, reason)
+        with self.lock:
+            self.skipped.append((file_name, reason))
+        if self.db is not None:
+            self.quarantine_table.quarantine(self.db, file_name, reason)
+
+    @contextlib.contextmanager
+    def importing(self, file_name, discard=None):
+        # Quarantines the file if importing it fails, instead of ending the import. The rows already written for the file are
+        # removed by discard(file_name), so the file isn't left half imported.
+        try:
+            yield
+        except Exception as e:
+            logger.exception("Failed to import %s", file_name)
+            if discard is not None:
+                try:
+                    discard(file_name)
+                except Exception as discard_e:
+                    logger.error("Failed to remove the rows imported from %s: %s", file_name, str(discard_e))
+            self.quarantine(file_name, "import failed: %s" % str(e))
+
+    def log_summary(self):
+        if len(self.skipped) == 0:
+            logger.info("Checked %d files, skipped none", self.checked)
+            return
+        logger.warning("Checked %d files, skipped %d:", self.checked, len(self.skipped))
+        for (file_name, reason) in self.skipped:
+            logger.warning("    %s: %s", file_name, reason)
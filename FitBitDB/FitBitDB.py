@@ -25,6 +25,10 @@ class Attributes(FitBitDB.Base, KeyValueObject):
     __tablename__ = 'attributes'
 
 
+class Quarantine(FitBitDB.Base, QuarantineObject):
+    __tablename__ = 'quarantine'
+
+
 class DaysSummary(FitBitDB.Base, DBObject):
     __tablename__ = 'days_summary'
 
@@ -62,17 +66,15 @@ class DaysSummary(FitBitDB.Base, DBObject):
 
     @classmethod
     def get_activity_mins_stats(cls, db, func, start_ts, end_ts):
-        moderate_activity_time = Conversions.min_to_dt_time(func(db, cls.fairly_active_mins, start_ts, end_ts))
-        vigorous_activity_time = Conversions.min_to_dt_time(func(db, cls.very_active_mins, start_ts, end_ts))
-        intensity_time = datetime.time.min
-        if moderate_activity_time:
-            intensity_time = Conversions.add_time(intensity_time, moderate_activity_time)
-        if vigorous_activity_time:
-            intensity_time = Conversions.add_time(intensity_time, vigorous_activity_time, 2)
+        # the minutes are totaled as integers and stored as Durations, so weekly and monthly totals aren't capped at 24 hours
+        moderate_activity_mins = func(db, cls.fairly_active_mins, start_ts, end_ts)
+        vigorous_activity_mins = func(db, cls.very_active_mins, start_ts, end_ts)
+        # vigorous minutes count double towards intensity minutes
+        intensity_mins = (moderate_activity_mins or 0) + ((vigorous_activity_mins or 0) * 2)
         stats = {
-            'intensity_time'            : intensity_time,
-            'moderate_activity_time'    : moderate_activity_time,
-            'vigorous_activity_time'    : vigorous_activity_time,
+            'intensity_time'            : Duration.from_secs(intensity_mins * 60),
+            'moderate_activity_time'    : Duration.from_secs(moderate_activity_mins * 60 if moderate_activity_mins is not None else None),
+            'vigorous_activity_time'    : Duration.from_secs(vigorous_activity_mins * 60 if vigorous_activity_mins is not None else None),
         }
         return stats
 
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+
+#
+# copyright Tom Goetz
+#
+
+import logging, os, zlib, hashlib, tempfile, cPickle
+
+import Fit
+
+
+logger = logging.getLogger(__file__)
+
+
+class CachedMessage():
+
+    def __init__(self, message_dict):
+        self.message_dict = message_dict
+
+    def to_dict(self):
+        return self.message_dict
+
+
+#
+# The parts of a Fit.File that FitFileProcessor uses, replayed from the message dicts saved in a FitFileCache.
+#
+class CachedFitFile():
+
+    def __init__(self, filename, cached):
+        self.filename = filename
+        self.cached = cached
+        self.messages = {Fit.MessageType[name] : [CachedMessage(message_dict) for message_dict in message_dicts]
+            for (name, message_dicts) in cached['messages'].iteritems()}
+
+    def time_created(self):
+        return self.cached['time_created']
+
+    def type(self):
+        return self.cached['type']
+
+    def message_types(self):
+        return [Fit.MessageType[name] for name in self.cached['message_types']]
+
+    def __getitem__(self, message_type):
+        return self.messages.get(message_type, [])
+
+
+#
+# Keeps the decoded messages of FIT files so that rebuilding the DBs doesn't have to decode the files again. Entries are keyed
+# by the SHA1 of the file contents, the units, and the message types that aren't saved, so renamed or archived copies of a file
+# share an entry, and a changed file gets a new one. Each entry is a zlib compressed pickle of the message dicts. Clear the cache
+# directory after updating the Fit module, the entries hold what the previous version decoded.
+#
+class FitFileCache():
+
+    # change when what's saved in an entry changes, old entries are then ignored
+    version = 1
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, file_data, english_units, uncached_message_types=[]):
+        # the decoded values depend on the units as well as on the file contents, and which messages were saved on the message
+        # types that weren't
+        sha1 = hashlib.sha1(file_data)
+        sha1.update('%d %s %s' % (self.version, english_units, ','.join(sorted(message_type.name for message_type in uncached_message_types))))
+        return sha1.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + '.fitcache')
+
+    def load(self, key, file_name):
+        path = self.path(key)
+        if os.path.isfile(path):
+            try:
+                with open(path, 'rb') as cache_file:
+                    cached = cPickle.loads(zlib.decompress(cache_file.read()))
+                self.hits += 1
+                return CachedFitFile(file_name, cached)
+            except Exception as e:
+                logger.warning("Ignoring cache entry %s for %s: %s", path, file_name, str(e))
+        self.misses += 1
+
+    def save(self, key, file_name, fit_file, message_types):
+        # returns the cached file, so the messages aren't decoded a second time when they are imported
+        cached = {
+            'time_created'  : fit_file.time_created(),
+            'type'          : fit_file.type(),
+            'message_types' : [message_type.name for message_type in fit_file.message_types()],
+            'messages'      : {message_type.name : [message.to_dict() for message in fit_file[message_type]] for message_type in message_types},
+        }
+        path = self.path(key)
+        directory = os.path.dirname(path)
+        try:
+            try:
+                os.makedirs(directory)
+            except OSError:
+                # another import may have just created it
+                if not os.path.isdir(directory):
+                    raise
+            # an interrupted or concurrent import never leaves a partial entry
+            (fd, temp_path) = tempfile.mkstemp(dir=directory)
+            try:
+                with os.fdopen(fd, 'wb') as cache_file:
+                    cache_file.write(zlib.compress(cPickle.dumps(cached, cPickle.HIGHEST_PROTOCOL)))
+                os.rename(temp_path, path)
+            except Exception:
+                os.remove(temp_path)
+                raise
+        except Exception as e:
+            logger.warning("Failed to cache %s: %s", file_name, str(e))
+        return CachedFitFile(file_name, cached)
+
+    def log_stats(self):
+        logger.info("FIT file cache %s: %d hits %d misses", self.cache_dir, self.hits, self.misses)
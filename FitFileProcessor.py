@@ -4,10 +4,14 @@
 # copyright Tom Goetz
 #
 
-import logging, sys, datetime
+import logging, sys, os, datetime, collections, tempfile, contextlib
 
 import Fit
+import HealthDB
 import GarminDB
+from RawDataStore import RawDataStore
+from ActivityAssembler import ActivityAssembler
+from FitFileCache import FitFileCache
 
 
 logger = logging.getLogger(__file__)
@@ -15,14 +19,41 @@ logger = logging.getLogger(__file__)
 
 class FitFileProcessor():
 
-    def __init__(self, db_params_dict, english_units, debug):
+    # monitoring messages go to the first table they match, otherwise to the Monitoring table
+    monitoring_tables = [GarminDB.MonitoringHeartRate, GarminDB.MonitoringIntensity, GarminDB.MonitoringClimb]
+    # message types that are read but not imported, their messages are only decoded when debugging
+    ignored_message_types = [
+        'event', 'software', 'file_creator', 'sport', 'sensor', 'source', 'device_settings', 'battery', 'activity', 'zones_target',
+        'dev_data_id', 'field_description'
+    ]
+    # sports and sub sports that have handlers, named by enum name
+    handled_sports = [
+        'running', 'walking', 'hiking', 'cycling', 'stand_up_paddleboarding', 'rowing', 'elliptical', 'fitness_equipment', 'alpine_skiing',
+        'training'
+    ]
+
+    def __init__(self, db_params_dict, english_units, debug, assembler=None, fit_cache_dir=None):
         self.db_params_dict = db_params_dict
         self.english_units = english_units
         self.debug = debug
+        # a device only sends a handful of distinct monitoring message shapes, keyed by the set of field names
+        self.monitoring_classifications = {}
+        self.message_handlers = self.build_message_handlers()
+        self.sport_handlers = {sport : getattr(self, 'write_' + sport + '_entry') for sport in self.handled_sports}
+        self.unhandled_message_types = collections.Counter()
+        self.unhandled_sports = collections.Counter()
 
         self.garmin_db = GarminDB.GarminDB(db_params_dict, debug - 1)
         self.garmin_mon_db = GarminDB.MonitoringDB(self.db_params_dict, self.debug - 1)
         self.garmin_act_db = GarminDB.ActivitiesDB(self.db_params_dict, self.debug - 1)
+        # high volume monitoring and activity rows are written in batches on writer threads while parsing continues
+        self.garmin_mon_buffer = HealthDB.WriteBuffer(self.garmin_mon_db)
+        self.garmin_act_buffer = HealthDB.WriteBuffer(self.garmin_act_db)
+        # activity and sport rows are merged with the ones from the other sources for the activity and written once, by the caller
+        # if it passed in the assembler
+        self.own_assembler = assembler is None
+        self.assembler = ActivityAssembler(db_params_dict, debug) if self.own_assembler else assembler
+        self.fit_cache = FitFileCache(fit_cache_dir) if fit_cache_dir else None
 
         if english_units:
             GarminDB.Attributes.set_newer(self.garmin_db, 'dist_setting', str(Fit.FieldEnums.DisplayMeasure.statute))
@@ -30,35 +61,97 @@ class FitFileProcessor():
             GarminDB.Attributes.set_newer(self.garmin_db, 'dist_setting', str(Fit.FieldEnums.DisplayMeasure.metric))
         logger.info("Debug: %s English units: %s", str(debug), str(english_units))
 
-    def write_generic(self, fit_file, message_type, messages):
-        for message in messages:
-            handler_name = 'write_' + message_type.name + '_entry'
-            try:
-                function = getattr(self, handler_name)
-                function(fit_file, message)
-            except AttributeError:
-                logger.debug("No entry handler %s for message type %s (%d) from %s: %s",
-                    handler_name, repr(message_type), len(messages), fit_file.filename, str(messages[0]))
-
-    def write_message_type(self, fit_file, message_type):
-        messages = fit_file[message_type]
-        function = getattr(self, 'write_' + message_type.name, self.write_generic)
-        function(fit_file, message_type, messages)
-        logger.debug("Processed %d %s entries for %s", len(messages), repr(message_type), fit_file.filename)
+    def build_message_handlers(self):
+        message_handlers = {}
+        for message_type in Fit.MessageType:
+            if message_type.name in self.ignored_message_types:
+                message_handlers[message_type] = self.log_message if self.debug > 0 else None
+            else:
+                handler = getattr(self, 'write_' + message_type.name + '_entry', None)
+                if handler is not None:
+                    message_handlers[message_type] = handler
+        return message_handlers
 
-    def write_message_types(self, fit_file, message_types):
-        logger.info("Importing %s (%s) [%s] with message types: %s", fit_file.filename, fit_file.time_created(), fit_file.type(), message_types)
+    def messages(self, fit_file, message_types):
         #
         # Some ordering is import: 1. create new file entries 2. create new device entries
         #
         priority_message_types = [Fit.MessageType.file_id, Fit.MessageType.device_info]
-        for message_type in priority_message_types:
-            self.write_message_type(fit_file, message_type)
-        for message_type in message_types:
-            if message_type not in priority_message_types:
-                self.write_message_type(fit_file, message_type)
+        for message_type in priority_message_types + [message_type for message_type in message_types if message_type not in priority_message_types]:
+            for message in fit_file[message_type]:
+                yield (message_type, message)
 
-    def write_file(self, fit_file):
+    def write_message_types(self, fit_file, message_types):
+        logger.info("Importing %s (%s) [%s] with message types: %s", self.file_name, fit_file.time_created(), fit_file.type(), message_types)
+        # skip ignored message types without decoding them
+        handled_message_types = []
+        for message_type in message_types:
+            if message_type not in self.message_handlers:
+                logger.debug("No entry handler for message type %s from %s", repr(message_type), self.file_name)
+                self.unhandled_message_types[message_type] += len(fit_file[message_type])
+            elif self.message_handlers[message_type] is not None:
+                handled_message_types.append(message_type)
+        message_count = 0
+        for (message_type, message) in self.messages(fit_file, handled_message_types):
+            self.message_handlers[message_type](fit_file, message)
+            message_count += 1
+        self.garmin_mon_buffer.flush()
+        self.garmin_act_buffer.flush()
+        logger.debug("Processed %d messages for %s", message_count, self.file_name)
+
+    def cached_message_types(self, message_types):
+        # the ignored message types aren't decoded
+        return [message_type for message_type in message_types if self.message_handlers.get(message_type, self.log_message) is not None]
+
+    def uncached_message_types(self):
+        return [message_type for message_type in Fit.MessageType if self.message_handlers.get(message_type, self.log_message) is None]
+
+    def open_cached_file(self, file_name):
+        file_data = RawDataStore.read(file_name) if RawDataStore.member_path(file_name) else None
+        if file_data is None:
+            with open(file_name, 'rb') as fit_file:
+                file_data = fit_file.read()
+        # an entry only has the message types that were decoded, changing the ignored types or debug level needs new entries
+        key = self.fit_cache.key(file_data, self.english_units, self.uncached_message_types())
+        cached_file = self.fit_cache.load(key, file_name)
+        if cached_file is not None:
+            return cached_file
+        with self.local_file(file_name, file_data) as local_file_name:
+            fit_file = Fit.File(local_file_name, self.english_units)
+            return self.fit_cache.save(key, file_name, fit_file, self.cached_message_types(fit_file.message_types()))
+
+    @classmethod
+    @contextlib.contextmanager
+    def local_file(cls, file_name, file_data=None):
+        # Fit.File only decodes files by name, so a FIT file in a zip archive is copied to a temporary file while it's imported. The
+        # archives aren't extracted into the input directories, but each member is still written to and read back from disk.
+        if not RawDataStore.member_path(file_name):
+            yield file_name
+            return
+        (fd, temp_path) = tempfile.mkstemp(suffix='.fit')
+        try:
+            with os.fdopen(fd, 'wb') as temp_file:
+                temp_file.write(file_data if file_data is not None else RawDataStore.read(file_name))
+            yield temp_path
+        finally:
+            os.remove(temp_path)
+
+    def import_file(self, file_name):
+        if self.fit_cache is not None:
+            self.write_file(self.open_cached_file(file_name), file_name)
+            return
+        with self.local_file(file_name) as local_file_name:
+            self.write_file(Fit.File(local_file_name, self.english_units), file_name)
+
+    def discard_file(self, file_name):
+        # removes the laps and records written for a file that failed part way through importing, after the ones still queued
+        activity_id = GarminDB.File.get(self.garmin_db, file_name)
+        if activity_id is not None:
+            self.garmin_act_buffer.delete(GarminDB.ActivityRecords, {'activity_id' : activity_id})
+            self.garmin_act_buffer.delete(GarminDB.ActivityLaps, {'activity_id' : activity_id})
+
+    def write_file(self, fit_file, file_name=None):
+        self.file_name = file_name or fit_file.filename
         self.lap = 1
         self.record = 1
         self.serial_number = None
@@ -66,9 +159,34 @@ class FitFileProcessor():
         self.product = None
         self.write_message_types(fit_file, fit_file.message_types())
 
+    def close(self):
+        try:
+            self.garmin_mon_buffer.close()
+            self.garmin_act_buffer.close()
+        finally:
+            if self.own_assembler:
+                self.assembler.write()
+        if self.fit_cache is not None:
+            self.fit_cache.log_stats()
+        for message_type, count in self.unhandled_message_types.most_common():
+            logger.info("No handler for %d %s messages", count, repr(message_type))
+        for sport, count in self.unhandled_sports.most_common():
+            logger.info("No handler for %d %s sessions", count, sport)
+
+    def dispatch_sport(self, fit_file, activity_id, sport, sub_sport, message_dict):
+        handler = self.sport_handlers.get(sport.name)
+        if handler is None:
+            logger.debug("No sport handler for type %s from %s: %s", sport, self.file_name, str(message_dict))
+            self.unhandled_sports[sport.name] += 1
+        else:
+            handler(fit_file, activity_id, sub_sport, message_dict)
+
     #
     # Message type handlers
     #
+    def log_message(self, fit_file, message):
+        logger.debug("%s message: %s", self.file_name, repr(message.to_dict()))
+
     def write_file_id_entry(self, fit_file, message):
         parsed_message = message.to_dict()
         self.serial_number = parsed_message.get('serial_number', None)
@@ -83,7 +201,7 @@ class FitFileProcessor():
             }
             GarminDB.Device.find_or_create(self.garmin_db, device)
         file = {
-            'name'          : fit_file.filename,
+            'name'          : self.file_name,
             'type'          : parsed_message['type'],
             'serial_number' : self.serial_number,
         }
@@ -97,24 +215,6 @@ class FitFileProcessor():
         }
         GarminDB.Stress.find_or_create(self.garmin_db, stress)
 
-    def write_event_entry(self, fit_file, event_message):
-        logger.debug("event message: %s", repr(event_message.to_dict()))
-
-    def write_software_entry(self, fit_file, software_message):
-        logger.debug("software message: %s", repr(software_message.to_dict()))
-
-    def write_file_creator_entry(self, fit_file, file_creator_message):
-        logger.debug("file creator message: %s", repr(file_creator_message.to_dict()))
-
-    def write_sport_entry(self, fit_file, sport_message):
-        logger.debug("sport message: %s", repr(sport_message.to_dict()))
-
-    def write_sensor_entry(self, fit_file, sensor_message):
-        logger.debug("sensor message: %s", repr(sensor_message.to_dict()))
-
-    def write_source_entry(self, fit_file, source_message):
-        logger.debug("source message: %s", repr(source_message.to_dict()))
-
     def get_field_value(self, message_dict, field_name):
         return message_dict.get('dev_' + field_name, message_dict.get(field_name, None))
 
@@ -134,7 +234,7 @@ class FitFileProcessor():
             'avg_ground_contact_time'           : self.get_field_value(message_dict, 'avg_stance_time'),
             'avg_stance_time_percent'           : self.get_field_value(message_dict, 'avg_stance_time_percent'),
         }
-        GarminDB.RunActivities.create_or_update_not_none(self.garmin_act_db, run)
+        self.assembler.add(GarminDB.RunActivities, run)
 
     def write_walking_entry(self, fit_file, activity_id, sub_sport, message_dict):
         logger.debug("walk entry: %s", repr(message_dict))
@@ -144,7 +244,7 @@ class FitFileProcessor():
             'avg_pace'                          : Fit.Conversions.speed_to_pace(message_dict.get('avg_speed', None)),
             'max_pace'                          : Fit.Conversions.speed_to_pace(message_dict.get('max_speed', None)),
         }
-        GarminDB.WalkActivities.create_or_update_not_none(self.garmin_act_db, walk)
+        self.assembler.add(GarminDB.WalkActivities, walk)
 
     def write_hiking_entry(self, fit_file, activity_id, sub_sport, message_dict):
         logger.debug("hike entry: %", repr(message_dict))
@@ -156,7 +256,7 @@ class FitFileProcessor():
             'strokes'                            : self.get_field_value(message_dict, 'total_strokes'),
         }
         logger.debug("ride entry: %s writing %s", repr(message_dict), repr(ride))
-        GarminDB.CycleActivities.create_or_update_not_none(self.garmin_act_db, ride)
+        self.assembler.add(GarminDB.CycleActivities, ride)
 
     def write_stand_up_paddleboarding_entry(self, fit_file, activity_id, sub_sport, message_dict):
         logger.debug("sup entry: %s", repr(message_dict))
@@ -165,7 +265,7 @@ class FitFileProcessor():
             'strokes'                           : self.get_field_value(message_dict, 'total_strokes'),
             'avg_stroke_distance'               : self.get_field_value(message_dict, 'avg_stroke_distance'),
         }
-        GarminDB.PaddleActivities.create_or_update_not_none(self.garmin_act_db, paddle)
+        self.assembler.add(GarminDB.PaddleActivities, paddle)
 
     def write_rowing_entry(self, fit_file, activity_id, sub_sport, message_dict):
         logger.debug("row entry: %s", repr(message_dict))
@@ -178,14 +278,10 @@ class FitFileProcessor():
             'steps'                             : message_dict.get('dev_Steps', message_dict.get('total_steps', None)),
             'elliptical_distance'               : message_dict.get('dev_User_distance', message_dict.get('dev_distance', message_dict.get('distance', None))),
         }
-        GarminDB.EllipticalActivities.create_or_update_not_none(self.garmin_act_db, workout)
+        self.assembler.add(GarminDB.EllipticalActivities, workout)
 
     def write_fitness_equipment_entry(self, fit_file, activity_id, sub_sport, message_dict):
-        try:
-            function = getattr(self, 'write_' + sub_sport.name + '_entry')
-            function(fit_file, activity_id, sub_sport, message_dict)
-        except AttributeError:
-            logger.info("No sub sport handler type %s from %s: %s", sub_sport, fit_file.filename, str(message_dict))
+        self.dispatch_sport(fit_file, activity_id, sub_sport, sub_sport, message_dict)
 
     def write_alpine_skiing_entry(self, fit_file, activity_id, sub_sport, message_dict):
         logger.debug("Skiing entry: %s", repr(message_dict))
@@ -196,7 +292,7 @@ class FitFileProcessor():
     def write_session_entry(self, fit_file, message):
         logger.debug("session message: %s", repr(message.to_dict()))
         message_dict = message.to_dict()
-        activity_id = GarminDB.File.get(self.garmin_db, fit_file.filename)
+        activity_id = GarminDB.File.get(self.garmin_db, self.file_name)
         sport = message_dict['sport']
         sub_sport = message_dict['sub_sport']
         activity = {
@@ -224,29 +320,18 @@ class FitFileProcessor():
             'max_temperature'                   : self.get_field_value(message_dict, 'max_temperature'),
             'avg_temperature'                   : self.get_field_value(message_dict, 'avg_temperature'),
             'training_effect'                   : self.get_field_value(message_dict, 'total_training_effect'),
-            'anaerobic_training_effect'         : self.get_field_value(message_dict, 'total_anaerobic_training_effect')
+            'anaerobic_training_effect'         : self.get_field_value(message_dict, 'total_anaerobic_training_effect'),
+            'sport'                             : sport.name,
+            'sub_sport'                         : sub_sport.name,
         }
         # json metadata gives better values for sport and subsport, so use existing value if set
-        current = GarminDB.Activities.get_id(self.garmin_act_db, activity_id)
-        if current:
-            if current.sport is None:
-                activity['sport'] = sport.name
-            if current.sub_sport is None:
-                activity['sub_sport'] = sub_sport.name
-        GarminDB.Activities.create_or_update_not_none(self.garmin_act_db, activity)
-        try:
-            function = getattr(self, 'write_' + sport.name + '_entry')
-            function(fit_file, activity_id, sub_sport, message_dict)
-        except AttributeError:
-            logger.info("No sport handler for type %s from %s: %s", sport, fit_file.filename, str(message_dict))
-
-    def write_device_settings_entry(self, fit_file, device_settings_message):
-        logger.debug("device settings message: " + repr(device_settings_message.to_dict()))
+        self.assembler.add(GarminDB.Activities, activity, ['sport', 'sub_sport'])
+        self.dispatch_sport(fit_file, activity_id, sport, sub_sport, message_dict)
 
     def write_lap_entry(self, fit_file, lap_message):
         message_dict = lap_message.to_dict()
         logger.debug("lap message: " + repr(message_dict))
-        activity_id = GarminDB.File.get(self.garmin_db, fit_file.filename)
+        activity_id = GarminDB.File.get(self.garmin_db, self.file_name)
         lap = {
             'activity_id'                       : activity_id,
             'lap'                               : self.lap,
@@ -272,12 +357,9 @@ class FitFileProcessor():
             'max_temperature'                   : self.get_field_value(message_dict, 'max_temperature'),
             'avg_temperature'                   : self.get_field_value(message_dict, 'avg_temperature'),
         }
-        GarminDB.ActivityLaps.create_or_update_not_none(self.garmin_act_db, lap)
+        self.garmin_act_buffer.create_or_update_not_none(GarminDB.ActivityLaps, lap)
         self.lap += 1
 
-    def write_battery_entry(self, fit_file, battery_message):
-        logger.debug("battery message: %s", repr(battery_message.to_dict()))
-
     def write_attribute(self, timestamp, parsed_message, attribute_name):
         attribute = parsed_message.get(attribute_name, None)
         if attribute is not None:
@@ -292,16 +374,10 @@ class FitFileProcessor():
             ]:
             self.write_attribute(timestamp, parsed_message, attribute_name)
 
-    def write_activity_entry(self, fit_file, activity_message):
-        logger.debug("activity message: %s", repr(activity_message.to_dict()))
-
-    def write_zones_target_entry(self, fit_file, zones_target_message):
-        logger.debug("zones target message: %s", repr(zones_target_message.to_dict()))
-
     def write_record_entry(self, fit_file, record_message):
         message_dict = record_message.to_dict()
         logger.debug("record message: %s", repr(message_dict))
-        activity_id = GarminDB.File.get(self.garmin_db, fit_file.filename)
+        activity_id = GarminDB.File.get(self.garmin_db, self.file_name)
         record = {
             'activity_id'                       : activity_id,
             'record'                            : self.record,
@@ -315,45 +391,42 @@ class FitFileProcessor():
             'speed'                             : self.get_field_value(message_dict, 'speed'),
             'temperature'                       : self.get_field_value(message_dict, 'temperature'),
         }
-        GarminDB.ActivityRecords.create_or_update_not_none(self.garmin_act_db, record)
+        self.garmin_act_buffer.create_or_update_not_none(GarminDB.ActivityRecords, record)
         self.record += 1
 
-    def write_dev_data_id_entry(self, fit_file, dev_data_id_message):
-        logger.debug("dev_data_id message: %s", repr(dev_data_id_message.to_dict()))
-
-    def write_field_description_entry(self, fit_file, field_description_message):
-        logger.debug("field_description message: %s", repr(field_description_message.to_dict()))
-
     def write_monitoring_info_entry(self, fit_file, message):
         parsed_message = message.to_dict()
         activity_types = parsed_message['activity_type']
         if isinstance(activity_types, list):
             for index, activity_type in enumerate(activity_types):
                 entry = {
-                    'file_id'                   : GarminDB.File.get(self.garmin_db, fit_file.filename),
+                    'file_id'                   : GarminDB.File.get(self.garmin_db, self.file_name),
                     'timestamp'                 : parsed_message['local_timestamp'],
                     'activity_type'             : activity_type,
                     'resting_metabolic_rate'    : self.get_field_value(parsed_message, 'resting_metabolic_rate'),
                     'cycles_to_distance'        : parsed_message['cycles_to_distance'][index],
                     'cycles_to_calories'        : parsed_message['cycles_to_calories'][index]
                 }
-                GarminDB.MonitoringInfo.find_or_create(self.garmin_mon_db, entry)
+                self.garmin_mon_buffer.find_or_create(GarminDB.MonitoringInfo, entry)
+
+    def classify_monitoring_entry(self, field_names):
+        for table in self.monitoring_tables:
+            columns = table.matching_columns(field_names)
+            if len(columns) >= table.min_row_values:
+                return (table, columns)
+        return (GarminDB.Monitoring, GarminDB.Monitoring.matching_columns(field_names))
 
     def write_monitoring_entry(self, fit_file, message):
         entry = message.to_dict()
-        try:
-            if GarminDB.MonitoringHeartRate.matches(entry):
-                GarminDB.MonitoringHeartRate.create_or_update_not_none(self.garmin_mon_db, entry)
-            elif GarminDB.MonitoringIntensity.matches(entry):
-                GarminDB.MonitoringIntensity.create_or_update_not_none(self.garmin_mon_db, entry)
-            elif GarminDB.MonitoringClimb.matches(entry):
-                GarminDB.MonitoringClimb.create_or_update_not_none(self.garmin_mon_db, entry)
-            else:
-                GarminDB.Monitoring.create_or_update_not_none(self.garmin_mon_db, entry)
-        except ValueError as e:
-            logger.error("ValueError: %s" % str(e))
-        except Exception as e:
-            logger.error("Exception on monitoring entry: %s: %s" % (repr(entry), str(e)))
+        signature = frozenset(entry)
+        classification = self.monitoring_classifications.get(signature)
+        if classification is None:
+            classification = self.classify_monitoring_entry(signature)
+            logger.debug("Monitoring message with fields %s goes to %s", repr(sorted(signature)), classification[0].__name__)
+            self.monitoring_classifications[signature] = classification
+        (table, columns) = classification
+        # the row is written on the buffer's writer thread, which logs and counts the rows that fail
+        self.garmin_mon_buffer.create_or_update_not_none(table, {column : entry[column] for column in columns})
 
     def write_device_info_entry(self, fit_file, device_info_message):
         try:
@@ -388,7 +461,7 @@ class FitFileProcessor():
             except Exception as e:
                 logger.error("Device not written: %s - %s", repr(parsed_message), str(e))
             device_info = {
-                'file_id'               : GarminDB.File.get(self.garmin_db, fit_file.filename),
+                'file_id'               : GarminDB.File.get(self.garmin_db, self.file_name),
                 'serial_number'         : serial_number,
                 'device_type'           : Fit.FieldEnums.name_for_enum(device_type),
                 'timestamp'             : parsed_message['timestamp'],
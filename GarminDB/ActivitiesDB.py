@@ -12,7 +12,7 @@ logger = logging.getLogger(__name__)
 class ActivitiesDB(DB):
     Base = declarative_base()
     db_name = 'garmin_activities'
-    db_version = 7
+    db_version = 8
 
     class DbVersion(Base, DbVersionObject):
         pass
@@ -43,8 +43,8 @@ class Activities(ActivitiesDB.Base, DBObject):
     #
     start_time = Column(DateTime, unique=True)
     stop_time = Column(DateTime, unique=True)
-    elapsed_time = Column(Time)
-    moving_time = Column(Time)
+    elapsed_time = Column(Duration)
+    moving_time = Column(Duration)
     #
     sport = Column(String)
     sub_sport = Column(String)
@@ -125,8 +125,8 @@ class ActivityLaps(ActivitiesDB.Base, DBObject):
     #
     start_time = Column(DateTime, primary_key=True)
     stop_time = Column(DateTime, unique=True)
-    elapsed_time = Column(Time)
-    moving_time = Column(Time)
+    elapsed_time = Column(Duration)
+    moving_time = Column(Duration)
     # degrees
     start_lat = Column(Float)
     start_long = Column(Float)
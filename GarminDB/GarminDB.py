@@ -14,7 +14,7 @@ logger = logging.getLogger(__name__)
 class GarminDB(DB):
     Base = declarative_base()
     db_name = 'garmin'
-    db_version = 4
+    db_version = 5
 
     class DbVersion(Base, DbVersionObject):
         pass
@@ -33,6 +33,10 @@ class Attributes(GarminDB.Base, KeyValueObject):
     __tablename__ = 'attributes'
 
 
+class Quarantine(GarminDB.Base, QuarantineObject):
+    __tablename__ = 'quarantine'
+
+
 class Device(GarminDB.Base, DBObject):
     __tablename__ = 'devices'
     unknown_device_serial_number = 9999999999
@@ -227,11 +231,11 @@ class Sleep(GarminDB.Base, DBObject):
     day = Column(Date, primary_key=True)
     start = Column(DateTime)
     end = Column(DateTime)
-    total_sleep = Column(Time)
-    deep_sleep = Column(Time)
-    light_sleep = Column(Time)
-    rem_sleep = Column(Time)
-    awake = Column(Time)
+    total_sleep = Column(Duration)
+    deep_sleep = Column(Duration)
+    light_sleep = Column(Duration)
+    rem_sleep = Column(Duration)
+    awake = Column(Duration)
 
     time_col = synonym("day")
     min_row_values = 2
@@ -240,6 +244,26 @@ class Sleep(GarminDB.Base, DBObject):
     def _find_query(cls, session, values_dict):
         return session.query(cls).filter(cls.day == values_dict['day'])
 
+    @classmethod
+    def replace_night(cls, db, day_data, events):
+        # The night's sleep row and its events in one transaction. The events, (timestamp, event, duration) tuples, replace
+        # all of the ones previously stored for the night, from its start to its end as imported before and now, even if the new
+        # ones cover less of it.
+        def replace_night(session):
+            timestamps = [day_data.get('start'), day_data.get('end')]
+            previous = cls._find_query(session, day_data).first()
+            if previous is not None:
+                timestamps += [previous.start, previous.end]
+            cls._create_or_update(db, session, day_data, True)
+            timestamps = [timestamp for timestamp in timestamps if timestamp is not None]
+            timestamps += [timestamp for (timestamp, event, duration) in events]
+            if len(timestamps) > 0:
+                SleepEvents._delete_period(db, session, {'start' : min(timestamps), 'end' : max(timestamps)})
+            if len(events) > 0:
+                SleepEvents._insert(db, session, [{'timestamp' : timestamp, 'event' : event, 'duration' : duration}
+                    for (timestamp, event, duration) in events])
+        db.write(replace_night)
+
     @classmethod
     def get_stats(cls, db, start_ts, end_ts):
         return {
@@ -276,7 +300,7 @@ class SleepEvents(GarminDB.Base, DBObject):
     id = Column(Integer, primary_key=True)
     timestamp = Column(DateTime, unique=True)
     event = Column(String)
-    duration = Column(Time)
+    duration = Column(Duration)
 
     time_col = synonym("timestamp")
     min_row_values = 2
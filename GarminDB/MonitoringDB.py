@@ -5,7 +5,7 @@
 #
 
 from HealthDB import *
-from Fit import Conversions, FieldEnums
+from Fit import FieldEnums
 
 
 logger = logging.getLogger(__name__)
@@ -14,7 +14,7 @@ logger = logging.getLogger(__name__)
 class MonitoringDB(DB):
     Base = declarative_base()
     db_name = 'garmin_monitoring'
-    db_version = 3
+    db_version = 4
 
     class DbVersion(Base, DbVersionObject):
         pass
@@ -128,8 +128,8 @@ class MonitoringIntensity(MonitoringDB.Base, DBObject):
     __tablename__ = 'monitoring_intensity'
 
     timestamp = Column(DateTime, primary_key=True)
-    moderate_activity_time = Column(Time)
-    vigorous_activity_time = Column(Time)
+    moderate_activity_time = Column(Duration)
+    vigorous_activity_time = Column(Duration)
 
     __table_args__ = (
         UniqueConstraint("timestamp", "moderate_activity_time", "vigorous_activity_time"),
@@ -146,13 +146,10 @@ class MonitoringIntensity(MonitoringDB.Base, DBObject):
     def get_stats(cls, db, start_ts, end_ts):
         moderate_activity_time = cls.get_time_col_sum(db, cls.moderate_activity_time, start_ts, end_ts)
         vigorous_activity_time = cls.get_time_col_sum(db, cls.vigorous_activity_time, start_ts, end_ts)
-        intensity_time = datetime.time.min
-        if moderate_activity_time:
-            intensity_time = Conversions.add_time(intensity_time, moderate_activity_time)
-        if vigorous_activity_time:
-            intensity_time = Conversions.add_time(intensity_time, vigorous_activity_time, 2)
+        # vigorous minutes count double towards intensity minutes
+        intensity_time = cls.get_time_col_sum(db, func.coalesce(cls.moderate_activity_time, 0) + (func.coalesce(cls.vigorous_activity_time, 0) * 2), start_ts, end_ts)
         stats = {
-            'intensity_time'            : intensity_time,
+            'intensity_time'            : intensity_time if intensity_time is not None else datetime.timedelta(0),
             'moderate_activity_time'    : moderate_activity_time,
             'vigorous_activity_time'    : vigorous_activity_time,
         }
@@ -7,6 +7,7 @@
 import logging, json
 
 import FileProcessor
+from FileValidator import FileValidator
 
 
 logger = logging.getLogger(__file__)
@@ -14,9 +15,10 @@ logger = logging.getLogger(__file__)
 
 class GarminJsonData():
 
-    def __init__(self, input_file, input_dir, file_regex, latest, english_units, debug):
+    def __init__(self, input_file, input_dir, file_regex, latest, english_units, debug, validator=None):
         self.english_units = english_units
         self.debug = debug
+        self.validator = validator if validator is not None else FileValidator()
         logger.info("Debug: %s", str(debug))
         if input_file:
             self.file_names = FileProcessor.FileProcessor.match_file(input_file, file_regex)
@@ -37,5 +39,6 @@ class GarminJsonData():
     def process_files(self):
         for file_name in self.file_names:
             logger.info("Processing: %s", file_name)
-            json_data = json.load(open(file_name))
-            self.process_json(json_data)
+            with self.validator.importing(file_name):
+                json_data = json.load(FileProcessor.FileProcessor.open_file(file_name))
+                self.process_json(json_data)
@@ -0,0 +1,257 @@
+#!/usr/bin/env python
+
+#
+# copyright Tom Goetz
+#
+
+import logging, math, datetime
+import xml.etree.cElementTree as ElementTree
+
+import Fit
+import GarminDB
+import FileProcessor
+from ActivityFileProcessor import ActivityFileProcessor, Stats
+
+
+logger = logging.getLogger(__file__)
+
+
+def haversine(lat1, long1, lat2, long2):
+    # great circle distance in meters between two positions given in degrees
+    earth_radius = 6371008.8
+    (lat1, long1, lat2, long2) = map(math.radians, [lat1, long1, lat2, long2])
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((long2 - long1) / 2) ** 2
+    return 2 * earth_radius * math.asin(min(1.0, math.sqrt(a)))
+
+
+#
+# The summary of a run of trackpoints, either a lap or the whole activity, accumulated one trackpoint at a time.
+#
+class TrackStats():
+
+    def __init__(self):
+        self.first_trackpoint = None
+        self.last_trackpoint = None
+        self.distance = 0.0
+        self.moving_time = 0.0
+        self.ascent = 0.0
+        self.descent = 0.0
+        self.hr = Stats()
+        self.cadence = Stats()
+        self.speed = Stats()
+        self.temperature = Stats()
+
+    def add(self, trackpoint, distance, moving_time, climb):
+        if self.first_trackpoint is None:
+            self.first_trackpoint = trackpoint
+        self.last_trackpoint = trackpoint
+        self.distance += distance
+        self.moving_time += moving_time
+        if climb > 0:
+            self.ascent += climb
+        else:
+            self.descent -= climb
+        self.hr.add(trackpoint.get('hr'))
+        self.cadence.add(trackpoint.get('cadence'))
+        self.speed.add(trackpoint.get('speed'))
+        self.temperature.add(trackpoint.get('temperature'))
+
+    def elapsed_time(self):
+        return self.last_trackpoint['timestamp'] - self.first_trackpoint['timestamp']
+
+
+#
+# Imports GPX files in one streaming pass. GPX only has positions, elevations, and times, so the distance, speed, moving time,
+# and ascent and descent are derived from consecutive trackpoints as they are parsed. Each track segment is written as a lap,
+# each trackpoint as a record, and the activity summary at the end of the file.
+#
+class GpxFileProcessor(ActivityFileProcessor):
+
+    # Fit versions that predate GPX support record GPX files as the other XML activity file type
+    file_type = getattr(Fit.FieldEnums.FileType, 'gpx', Fit.FieldEnums.FileType.tcx)
+    # slower than this, in meters per second, isn't moving, ex: GPS drift while stopped
+    moving_speed = 0.5
+    # weight of each new elevation in the moving average, GPS elevations are noisy and summing the raw changes overstates the climbing
+    altitude_smoothing = 0.25
+    # the smoothed elevation has to change by this many meters before it counts as climbing or descending
+    altitude_threshold = 2.0
+
+    def start_file(self, file_name):
+        self.file_name = file_name
+        self.activity_id = None
+        self.creator = None
+        self.name = None
+        self.type = None
+        self.activity = TrackStats()
+        self.lap = None
+        self.laps = 0
+        self.trackpoint = None
+        self.previous_trackpoint = None
+        self.smoothed_altitude = None
+        self.climb_altitude = None
+        self.records = 0
+
+    def start_lap(self):
+        self.lap = TrackStats()
+        # distance and climbing aren't counted across the gap between segments
+        self.previous_trackpoint = None
+        self.smoothed_altitude = None
+        self.climb_altitude = None
+
+    def end_lap(self):
+        lap = self.lap
+        self.lap = None
+        if lap.first_trackpoint is None:
+            return
+        lap_row = self.stats_values(lap)
+        lap_row.update({'activity_id' : self.get_activity_id(), 'lap' : self.laps})
+        self.garmin_act_buffer.insert(GarminDB.ActivityLaps, lap_row)
+        self.laps += 1
+
+    def end_trackpoint(self):
+        trackpoint = self.trackpoint
+        self.trackpoint = None
+        if trackpoint.get('timestamp') is None or trackpoint.get('position_lat') is None or trackpoint.get('position_long') is None:
+            return
+        if self.lap is None:
+            # a track without segments
+            self.start_lap()
+        distance = 0.0
+        moving_time = 0.0
+        climb = 0.0
+        previous = self.previous_trackpoint
+        if previous is not None:
+            distance = haversine(previous['position_lat'], previous['position_long'], trackpoint['position_lat'], trackpoint['position_long'])
+            seconds = (trackpoint['timestamp'] - previous['timestamp']).total_seconds()
+            if seconds > 0:
+                trackpoint['speed'] = distance / seconds
+                if trackpoint['speed'] >= self.moving_speed:
+                    moving_time = seconds
+        altitude = trackpoint.get('altitude')
+        if altitude is not None:
+            if self.smoothed_altitude is None:
+                self.smoothed_altitude = altitude
+                self.climb_altitude = altitude
+            else:
+                self.smoothed_altitude += self.altitude_smoothing * (altitude - self.smoothed_altitude)
+                if abs(self.smoothed_altitude - self.climb_altitude) >= self.altitude_threshold:
+                    climb = self.smoothed_altitude - self.climb_altitude
+                    self.climb_altitude = self.smoothed_altitude
+        self.previous_trackpoint = trackpoint
+        self.lap.add(trackpoint, distance, moving_time, climb)
+        self.activity.add(trackpoint, distance, moving_time, climb)
+        record = {
+            'activity_id'   : self.get_activity_id(),
+            'record'        : self.records,
+            'timestamp'     : trackpoint['timestamp'],
+            'position_lat'  : trackpoint['position_lat'],
+            'position_long' : trackpoint['position_long'],
+            'distance'      : self.convert_distance(self.activity.distance),
+            'cadence'       : trackpoint.get('cadence'),
+            'hr'            : trackpoint.get('hr'),
+            'alititude'     : self.convert_altitude(altitude),
+            'speed'         : self.convert_speed(trackpoint.get('speed')),
+            'temperature'   : self.convert_temperature(trackpoint.get('temperature')),
+        }
+        self.garmin_act_buffer.insert(GarminDB.ActivityRecords, record)
+        self.records += 1
+
+    def end_value(self, name, parent, text):
+        if text is None:
+            return
+        text = text.strip()
+        if self.trackpoint is not None:
+            if name == 'time':
+                self.trackpoint['timestamp'] = self.time_parser.parse(text)
+            elif name == 'ele':
+                self.trackpoint['altitude'] = float(text)
+            elif name == 'hr':
+                self.trackpoint['hr'] = int(text)
+            elif name == 'cad':
+                self.trackpoint['cadence'] = int(text)
+            elif name in ['atemp', 'temp']:
+                self.trackpoint['temperature'] = float(text)
+        elif parent == 'trk':
+            if name == 'name' and self.name is None:
+                self.name = text
+            elif name == 'type' and self.type is None:
+                self.type = text
+
+    def parse(self, gpx_file):
+        elements = []
+        for (event, element) in ElementTree.iterparse(gpx_file, events=('start', 'end')):
+            name = self.local_name(element.tag)
+            if event == 'start':
+                elements.append(element)
+                if name == 'gpx':
+                    self.creator = element.get('creator')
+                elif name == 'trkseg':
+                    self.start_lap()
+                elif name == 'trkpt':
+                    self.trackpoint = {}
+                    if element.get('lat') is not None and element.get('lon') is not None:
+                        self.trackpoint['position_lat'] = float(element.get('lat'))
+                        self.trackpoint['position_long'] = float(element.get('lon'))
+                continue
+            elements.pop()
+            if name == 'trkpt':
+                self.end_trackpoint()
+            elif name == 'trkseg' or (name == 'trk' and self.lap is not None):
+                self.end_lap()
+            elif len(element) == 0:
+                parent = self.local_name(elements[-1].tag) if len(elements) > 0 else None
+                self.end_value(name, parent, element.text)
+            # drop the parsed element from the tree
+            element.clear()
+            if name in ['trkpt', 'trkseg'] and len(elements) > 0:
+                elements[-1].remove(element)
+
+    def stats_values(self, stats):
+        moving_time = stats.moving_time
+        return {
+            'start_time'        : stats.first_trackpoint['timestamp'],
+            'stop_time'         : stats.last_trackpoint['timestamp'],
+            'elapsed_time'      : stats.elapsed_time(),
+            'moving_time'       : datetime.timedelta(0, moving_time),
+            'start_lat'         : stats.first_trackpoint['position_lat'],
+            'start_long'        : stats.first_trackpoint['position_long'],
+            'stop_lat'          : stats.last_trackpoint['position_lat'],
+            'stop_long'         : stats.last_trackpoint['position_long'],
+            'distance'          : self.convert_distance(stats.distance),
+            'avg_hr'            : stats.hr.avg(),
+            'max_hr'            : stats.hr.max,
+            'avg_cadence'       : stats.cadence.avg(),
+            'max_cadence'       : stats.cadence.max,
+            'avg_speed'         : self.convert_speed(stats.distance / moving_time) if moving_time > 0 else None,
+            'max_speed'         : self.convert_speed(stats.speed.max),
+            'ascent'            : self.convert_altitude(stats.ascent),
+            'descent'           : self.convert_altitude(stats.descent),
+            'max_temperature'   : self.convert_temperature(stats.temperature.max),
+            'min_temperature'   : self.convert_temperature(stats.temperature.min),
+            'avg_temperature'   : self.convert_temperature(stats.temperature.avg()),
+        }
+
+    def write_activity(self):
+        if self.activity.first_trackpoint is None:
+            logger.info("%s has no trackpoints", self.file_name)
+            return
+        self.write_file(self.creator, None, self.activity.first_trackpoint['timestamp'])
+        activity = self.stats_values(self.activity)
+        activity.update({
+            'activity_id'   : self.get_activity_id(),
+            'name'          : self.name,
+            'laps'          : self.laps,
+        })
+        # some exporters use a sport name for the track type, others a number
+        if self.type is not None and self.type.isalpha():
+            activity['sport'] = self.type.lower()
+        activity_not_zero = {key : value for (key, value) in activity.iteritems() if value}
+        self.assembler.add(GarminDB.Activities, activity_not_zero)
+
+    def import_file(self, file_name):
+        logger.info("Processing file: " + file_name)
+        self.start_file(file_name)
+        with FileProcessor.FileProcessor.open_file(file_name) as gpx_file:
+            self.parse(gpx_file)
+        self.write_activity()
+        logger.info("%s: %d laps %d records %.0f m", file_name, self.laps, self.records, self.activity.distance)
@@ -4,17 +4,28 @@
 # copyright Tom Goetz
 #
 
-import logging, datetime, csv
+import logging, csv
+
+from DateParser import DateParser
 
 logger = logging.getLogger(__name__)
 
 
+#
+# Reads a CSV file and passes the rows, converted to DB column names and values as described by cols_map, to write_entries_func
+# in lists of at most batch_size rows, by default all of the rows in the file at once.
+#
 class CsvImporter():
 
-    def __init__(self, filename, cols_map, write_entry_func):
+    def __init__(self, filename, cols_map, write_entries_func, batch_size=None):
         self.filename = filename
         self.cols_map = cols_map
-        self.write_entry_func = write_entry_func
+        self.write_entries_func = write_entries_func
+        self.batch_size = batch_size
+
+    ymd_date_parser = DateParser(fallback=False)
+    mdy_date_parser = DateParser(["%m/%d/%y %H:%M", "%m/%d/%y"], fallback=False)
+    time_parser = DateParser(["%M:%S"], fallback=False)
 
     @classmethod
     def map_identity(cls, english_units, value):
@@ -37,24 +48,21 @@ class CsvImporter():
     @classmethod
     def map_ymd_date(cls, english_units, date_string):
         try:
-            return datetime.datetime.strptime(date_string, "%Y-%m-%d").date()
+            return cls.ymd_date_parser.parse(date_string).date()
         except Exception as e:
             return None
 
     @classmethod
     def map_mdy_date(cls, english_units, date_string):
         try:
-            return datetime.datetime.strptime(date_string, "%m/%d/%y %H:%M")
+            return cls.mdy_date_parser.parse(date_string)
         except Exception as e:
-            try:
-                return datetime.datetime.strptime(date_string, "%m/%d/%y")
-            except Exception as e:
-                return None
+            return None
 
     @classmethod
     def map_time(cls, english_units, time_string):
         try:
-            return datetime.datetime.strptime(time_string, "%M:%S").time()
+            return cls.time_parser.parse(time_string).time()
         except Exception as e:
             return None
 
@@ -70,17 +78,37 @@ class CsvImporter():
             return float(kgs) * 2.20462
         return float(kgs)
 
-    def convert_cols(self, english_units, csv_col_dict):
-        return {
-            (self.cols_map[key][0] if key in self.cols_map else key) :
-            (self.cols_map[key][1](english_units, value) if key in self.cols_map else value) for key, value in csv_col_dict.items()
-        }
+    def compile_header(self, header):
+        # look the columns up once per file: (column index, DB column name, converter or None) for each column
+        columns = []
+        for (index, key) in enumerate(header):
+            if key in self.cols_map:
+                (name, converter) = self.cols_map[key]
+            else:
+                (name, converter) = (key, None)
+            columns.append((index, name, converter))
+        return columns
+
+    def convert_row(self, english_units, columns, row):
+        if len(row) < len(columns):
+            row = row + ([None] * (len(columns) - len(row)))
+        return {name : (converter(english_units, row[index]) if converter else row[index]) for (index, name, converter) in columns}
 
     def process_file(self, english_units):
         logger.info("Reading file: " + self.filename)
         with open(self.filename) as csv_file:
-            read_csv = csv.DictReader(csv_file, delimiter=',')
+            read_csv = csv.reader(csv_file, delimiter=',')
+            header = next(read_csv, None)
+            if header is None:
+                return
+            columns = self.compile_header(header)
+            db_entries = []
             for row in read_csv:
-                db_entry = self.convert_cols(english_units, row)
-                logger.debug("%s  -> %s" % (repr(row), repr(db_entry)))
-                self.write_entry_func(db_entry)
+                if len(row) == 0:
+                    continue
+                db_entries.append(self.convert_row(english_units, columns, row))
+                if self.batch_size and len(db_entries) >= self.batch_size:
+                    self.write_entries_func(db_entries)
+                    db_entries = []
+            if len(db_entries) > 0:
+                self.write_entries_func(db_entries)
@@ -4,7 +4,7 @@
 # copyright Tom Goetz
 #
 
-import os, logging, datetime, time
+import os, logging, datetime, time, threading, contextlib
 
 from sqlalchemy import *
 from sqlalchemy.ext.declarative import *
@@ -12,16 +12,51 @@ from sqlalchemy.exc import *
 from sqlalchemy.orm import *
 from sqlalchemy.orm.attributes import *
 
-from Fit import Conversions
-
 
 logger = logging.getLogger(__name__)
 
 
+#
+# A span of time stored as integer seconds. Unlike Time it isn't capped at 24 hours and can be aggregated directly in SQL.
+# Accepts datetime.time, datetime.timedelta, or a number of seconds and returns a datetime.timedelta.
+#
+class Duration(TypeDecorator):
+    impl = Integer
+
+    @classmethod
+    def to_secs(cls, value):
+        if value is None:
+            return None
+        if isinstance(value, datetime.timedelta):
+            return int(round(value.total_seconds()))
+        if isinstance(value, datetime.time):
+            return (value.hour * 3600) + (value.minute * 60) + value.second + int(round(value.microsecond / 1000000.0))
+        return int(round(value))
+
+    @classmethod
+    def from_secs(cls, secs):
+        if secs is None:
+            return None
+        return datetime.timedelta(0, secs)
+
+    def process_bind_param(self, value, dialect):
+        return self.to_secs(value)
+
+    def process_result_value(self, value, dialect):
+        return self.from_secs(value)
+
+
 class DB():
 
     max_commit_attempts = 5
     commit_errors = 0
+    # DB instances for the same database share one engine and its connection pool
+    engines = {}
+    engines_lock = threading.Lock()
+    # sqlite allows one writer per DB file at a time, the threads writing to the same file take turns
+    write_locks = {}
+    # when set, committed rows are also appended to this Journal
+    journal = None
 
     def __init__(self, db_params_dict, debug=False):
         logger.debug("DB %s debug %s ", repr(db_params_dict), str(debug))
@@ -30,10 +65,43 @@ class DB():
             logger.setLevel(logging.DEBUG)
         else:
             logger.setLevel(logging.INFO)
-        self.engine = create_engine(url_func(db_params_dict), echo=(debug > 1))
+        url = url_func(db_params_dict)
+        self.engine = self.get_engine(url, debug > 1)
+        self.write_lock = self.get_write_lock(url)
         self.session_maker = sessionmaker(bind=self.engine)
         self._query_session = None
 
+    @classmethod
+    def get_engine(cls, url, echo):
+        with DB.engines_lock:
+            engine = DB.engines.get((url, echo))
+            if engine is None:
+                if url.startswith('sqlite'):
+                    # a shared engine's connections may be closed by a different thread than the one that opened them
+                    engine = create_engine(url, echo=echo, connect_args={'check_same_thread' : False})
+                else:
+                    engine = create_engine(url, echo=echo)
+                DB.engines[(url, echo)] = engine
+            return engine
+
+    @classmethod
+    def get_write_lock(cls, url):
+        if not url.startswith('sqlite'):
+            return None
+        with DB.engines_lock:
+            # reentrant since a unit of work may write a row it refers to, ex: through a relational mapping
+            return DB.write_locks.setdefault(url, threading.RLock())
+
+    @contextlib.contextmanager
+    def writing(self):
+        # Writers to the same sqlite DB file from different threads wait here for each other instead of failing with 'database is
+        # locked', writers to different files don't.
+        if self.write_lock is None:
+            yield
+        else:
+            with self.write_lock:
+                yield
+
     @classmethod
     def sqlite_url(cls, db_params_dict):
         return "sqlite:///" + db_params_dict['db_path'] +  '/' + cls.db_name + '.db'
@@ -52,21 +120,112 @@ class DB():
 
     @classmethod
     def commit(cls, session):
+        # A failed commit is rolled back, which drops all of the session's pending rows, so it can't be retried on the same
+        # session. The error is raised for the caller to write the rows again or count them as lost.
+        try:
+            if DB.journal is not None and 'journal' in session.info:
+                DB.journal.commit(session)
+            else:
+                session.commit()
+            session.close()
+        except OperationalError as e:
+            logger.error("Exeption '%s' on commit %s" % (str(e), str(session)))
+            session.rollback()
+            # the rolled back rows aren't journaled
+            session.info.pop('journal', None)
+            cls.commit_errors += 1
+            raise
+
+    def write(self, write_func):
+        # Runs write_func(session) on a new session and commits it. A failed commit is rolled back, which drops the rows
+        # write_func added, so after an OperationalError, ex: the DB is locked by another import, write_func is run again on a new
+        # session after a pause, up to max_commit_attempts times. Returns what write_func returned.
         attempts = 0
-        while attempts < DB.max_commit_attempts:
+        while True:
+            session = self.session()
             try:
-                session.commit()
-                session.close()
-                return
+                with self.writing():
+                    result = write_func(session)
+                    DB.commit(session)
+                return result
             except OperationalError as e:
-                attempts += 1
-                logger.error("Exeption '%s' on commit %s attempt %d" % (str(e), str(session), attempts))
                 session.rollback()
-                cls.commit_errors += 1
+                session.info.pop('journal', None)
+                session.close()
+                attempts += 1
+                if attempts >= DB.max_commit_attempts:
+                    raise
+                logger.warning("Write to %s failed, retrying: %s", self.db_name, str(e))
                 time.sleep(attempts)
+            except:
+                session.rollback()
+                session.close()
+                raise
+
+
+#
+# Turns a values dict into attribute values for a DBObject class in a single pass. Equivalent to filtering the columns, then
+# applying the column mappings, relational mappings, and column translations in turn, but the per key work is worked out
+# once per class.
+#
+class RowMapper():
+
+    def __init__(self, cls):
+        columns = frozenset(cls.__dict__)
+        if cls._updateable_fields == cls.UPDATE_ALL_FIELDS:
+            updateable_fields = None
+        else:
+            updateable_fields = frozenset(cls._updateable_fields)
+        # a directly passed value is overwritten by a column mapped from another key
+        mapped_from = {value[0] : key for key, value in cls._col_mappings.iteritems()}
+        self.column_keys = [column_attr.key for column_attr in cls.__mapper__.column_attrs]
+        self.create_plans = {}
+        self.update_plans = {}
+        for key in columns:
+            outputs = [(key, mapped_from.get(key), None)]
+            if key in cls._col_mappings:
+                outputs.append((cls._col_mappings[key][0], None, cls._col_mappings[key][1]))
+            for (dest_key, overridden_by, map_func) in outputs:
+                relational_func = None
+                if dest_key in cls._relational_mappings:
+                    (dest_key, relational_func) = cls._relational_mappings[dest_key]
+                step = (dest_key, overridden_by, map_func, relational_func, cls._col_translations.get(dest_key))
+                if dest_key in columns:
+                    self.create_plans.setdefault(key, []).append(step)
+                if updateable_fields is None or dest_key in updateable_fields:
+                    self.update_plans.setdefault(key, []).append(step)
+
+    def column_values(self, instance):
+        # the values set on a new instance by apply, keyed by attribute name as bulk_insert_mappings takes them
+        return {key : instance.__dict__[key] for key in self.column_keys if key in instance.__dict__}
+
+    def apply(self, instance, db, values_dict, update, ignore_none):
+        plans = self.update_plans if update else self.create_plans
+        # A new instance has no history to track, all of its values are inserted when it's flushed, so they're set as committed
+        # values, which skips the change tracking that's most of the cost of mapping a row. The values of an existing instance are
+        # set as changes so they're updated.
+        set_value = set_attribute if update else set_committed_value
+        not_none_values = 0
+        for key, value in values_dict.iteritems():
+            plan = plans.get(key)
+            if plan is None:
                 continue
-            break
-        raise IOError("Failed to commit")
+            for (dest_key, overridden_by, map_func, relational_func, translate_func) in plan:
+                if overridden_by is not None and overridden_by in values_dict:
+                    continue
+                dest_value = value
+                if map_func is not None:
+                    dest_value = map_func(dest_value)
+                if relational_func is not None:
+                    dest_value = relational_func(db, dest_value)
+                if translate_func is not None:
+                    dest_value = translate_func(dest_value)
+                if dest_value is not None:
+                    not_none_values += 1
+                elif ignore_none:
+                    continue
+                set_value(instance, dest_key, dest_value)
+        return not_none_values
 
 
 class DBObject():
@@ -78,25 +237,23 @@ class DBObject():
     _col_translations = {}
     _col_mappings = {}
     min_row_values = 1
+    journaled = True
 
+    # called by declarative once the mapper for each table class is configured
+    @classmethod
+    def __declare_last__(cls):
+        cls._row_mapper = RowMapper(cls)
+
+    @classmethod
+    def row_mapper(cls):
+        row_mapper = cls.__dict__.get('_row_mapper')
+        if row_mapper is None:
+            row_mapper = RowMapper(cls)
+            cls._row_mapper = row_mapper
+        return row_mapper
 
     def _from_dict(self, db, values_dict, update=False, ignore_none=False):
-        if update:
-            if self._updateable_fields == self.UPDATE_ALL_FIELDS:
-                test_key_dict = None
-            else:
-                test_key_dict = self._updateable_fields
-        else:
-            test_key_dict = self.__class__.__dict__
-        self.not_none_values = 0
-        processed_dict = self.translate_columns(self.relational_mappings(db, self.map_columns(self.__filter_columns(values_dict))))
-        for key, value in processed_dict.iteritems():
-            if test_key_dict is None or key in test_key_dict:
-                if value is not None:
-                    self.not_none_values += 1
-                    set_attribute(self, key, value)
-                elif not ignore_none:
-                    set_attribute(self, key, value)
+        self.not_none_values = self.row_mapper().apply(self, db, values_dict, update, ignore_none)
         return self
 
     @classmethod
@@ -105,12 +262,14 @@ class DBObject():
 
     @classmethod
     def _delete_view(cls, db, view_name):
-        db.engine.execute('DROP VIEW IF EXISTS ' + view_name)
+        with db.writing():
+            db.engine.execute('DROP VIEW IF EXISTS ' + view_name)
 
     @classmethod
     def _create_view(cls, db, view_name, query_str):
-        cls._delete_view(db, view_name)
-        db.engine.execute('CREATE VIEW IF NOT EXISTS ' + view_name + ' AS ' + query_str)
+        with db.writing():
+            cls._delete_view(db, view_name)
+            db.engine.execute('CREATE VIEW IF NOT EXISTS ' + view_name + ' AS ' + query_str)
 
     @classmethod
     def create_join_view(cls, db, view_name, join_table):
@@ -134,9 +293,13 @@ class DBObject():
             raise ValueError("%s: filtered all cols for %s from %s" % (cls.__name__, cls.__tablename__, repr(values_dict)))
         return filtered_cols
 
+    @classmethod
+    def matching_columns(cls, col_names):
+        return [col_name for col_name in col_names if col_name in cls.__dict__]
+
     @classmethod
     def matches(cls, values_dict):
-        return len(cls.__filter_columns(values_dict)) >= cls.min_row_values
+        return len(cls.matching_columns(values_dict)) >= cls.min_row_values
 
     @classmethod
     def map_columns(cls, values_dict):
@@ -204,6 +367,12 @@ class DBObject():
         if instance is not None:
             return instance.id
 
+    @classmethod
+    def _journal(cls, db, session, op, values_dict, *args):
+        # the records are appended to the journal when the session is committed, see DB.commit
+        if DB.journal is not None and cls.journaled:
+            session.info.setdefault('journal', []).append((db.__class__, cls, op, values_dict, args))
+
     @classmethod
     def _create(cls, db, session, values_dict, ignore_none=False):
         logger.debug("%s::_create %s", cls.__name__, repr(values_dict))
@@ -214,21 +383,52 @@ class DBObject():
             else:
                 raise ValueError("%d not-None values: %s", instance.not_none_values, repr(values_dict))
         session.add(instance)
+        if DB.journal is not None:
+            # journaled as mapped, so replaying it is a plain insert
+            cls._journal(db, session, 'insert', cls.row_mapper().column_values(instance))
+
+    @classmethod
+    def _insert(cls, db, session, values_dicts):
+        # rows of column values, as journaled by _create, in one bulk insert
+        session.bulk_insert_mappings(cls, values_dicts)
+        for values_dict in values_dicts:
+            cls._journal(db, session, 'insert', values_dict)
 
     @classmethod
     def create(cls, db, values_dict, ignore_none=False):
         logger.debug("%s::create %s", cls.__name__, repr(values_dict))
-        session = db.session()
-        cls._create(db, session, values_dict)
-        DB.commit(session)
+        db.write(lambda session: cls._create(db, session, values_dict))
 
     @classmethod
-    def find_or_create(cls, db, values_dict):
-        logger.debug("%s::find_or_create %s" % (cls.__name__, repr(values_dict)))
-        session = db.session()
+    def _find_or_create(cls, db, session, values_dict):
         if cls._find_one(session, values_dict) is None:
             cls._create(db, session, values_dict)
-            DB.commit(session)
+            return True
+        return False
+
+    @classmethod
+    def find_or_create(cls, db, values_dict):
+        logger.debug("%s::find_or_create %s" % (cls.__name__, repr(values_dict)))
+        db.write(lambda session: cls._find_or_create(db, session, values_dict))
+
+    @classmethod
+    def _delete_matching(cls, db, session, values_dict):
+        session.query(cls).filter_by(**values_dict).delete(synchronize_session=False)
+        cls._journal(db, session, 'delete_matching', values_dict)
+
+    @classmethod
+    def _delete_period(cls, db, session, values_dict):
+        # delete the rows with time_col values from values_dict['start'] to values_dict['end'] inclusive
+        session.query(cls).filter(cls.time_col >= values_dict['start']).filter(cls.time_col <= values_dict['end']).delete(synchronize_session=False)
+        cls._journal(db, session, 'delete_period', values_dict)
+
+    @classmethod
+    def find_or_create_all(cls, db, values_dicts):
+        # all of the rows in one session and commit, returns the number of rows created
+        logger.debug("%s::find_or_create_all %d rows", cls.__name__, len(values_dicts))
+        def find_or_create_all(session):
+            return len([values_dict for values_dict in values_dicts if cls._find_or_create(db, session, values_dict)])
+        return db.write(find_or_create_all)
 
     @classmethod
     def find_or_create_id(cls, db, values_dict):
@@ -240,15 +440,21 @@ class DBObject():
         return instance.id
 
     @classmethod
-    def create_or_update(cls, db, values_dict, ignore_none=False):
-        logger.debug("%s::create_or_update %s", cls.__name__, repr(values_dict))
-        session = db.session()
+    def _create_or_update(cls, db, session, values_dict, ignore_none=False, fill_only=[]):
+        # the fill_only columns of an existing row are only written if they have no value
         instance = cls._find_one(session, values_dict)
         if instance is None:
             cls._create(db, session, values_dict, ignore_none)
         else:
+            if len(fill_only) > 0:
+                values_dict = {key : value for (key, value) in values_dict.iteritems() if key not in fill_only or getattr(instance, key) is None}
             instance._from_dict(db, values_dict, True, ignore_none)
-        DB.commit(session)
+            cls._journal(db, session, 'create_or_update', values_dict, ignore_none)
+
+    @classmethod
+    def create_or_update(cls, db, values_dict, ignore_none=False):
+        logger.debug("%s::create_or_update %s", cls.__name__, repr(values_dict))
+        db.write(lambda session: cls._create_or_update(db, session, values_dict, ignore_none))
 
     @classmethod
     def create_or_update_not_none(cls, db, values_dict):
@@ -396,14 +602,15 @@ class DBObject():
 
     @classmethod
     def get_time_col_func(cls, db, col, stat_func, start_ts=None, end_ts=None, ignore_le_zero=False):
-        query = db.query_session().query(stat_func(func.strftime('%s', col) - func.strftime('%s', '00:00')))
+        # Duration columns are integer seconds, aggregate them natively and convert the result once
+        query = db.query_session().query(stat_func(type_coerce(col, Integer)))
         if start_ts is not None:
             query = query.filter(cls.time_col >= start_ts)
         if end_ts is not None:
             query = query.filter(cls.time_col < end_ts)
         if ignore_le_zero:
             query = query.filter(col > 0)
-        return Conversions.secs_to_dt_time(query.scalar())
+        return Duration.from_secs(query.scalar())
 
     @classmethod
     def get_time_col_avg(cls, db, col, start_ts, end_ts, ignore_le_zero=False):
@@ -523,8 +730,40 @@ class KeyValueObject(DBObject):
             return None
 
 
+#
+# Input files that were skipped, because they failed validation or failed to import, and why. See FileValidator.
+#
+class QuarantineObject(DBObject):
+
+    name = Column(String, primary_key=True)
+    timestamp = Column(DateTime)
+    reason = Column(String)
+
+    min_row_values = 2
+
+    @classmethod
+    def _find_query(cls, session, values_dict):
+        return session.query(cls).filter(cls.name == values_dict['name'])
+
+    @classmethod
+    def quarantine(cls, db, name, reason):
+        cls.create_or_update(db, {'name' : name, 'timestamp' : datetime.datetime.now(), 'reason' : reason})
+
+    @classmethod
+    def release(cls, db, names):
+        # removes the named files from the quarantine, returns the number removed
+        def release(session):
+            released = set(row[0] for row in session.query(cls.name).all()).intersection(names)
+            for name in released:
+                cls._delete_matching(db, session, {'name' : name})
+            return len(released)
+        return db.write(release)
+
+
 class DbVersionObject(KeyValueObject):
     __tablename__ = 'version'
+    # written when the DB is created, including when it's rebuilt from a Journal
+    journaled = False
 
     def version_check(self, db, version_number):
         self.set_if_unset(db, 'version', version_number)
@@ -545,17 +784,17 @@ class SummaryBase(DBObject):
     weight_min = Column(Float)
     weight_max = Column(Float)
     stress_avg = Column(Float)
-    intensity_time = Column(Time)
-    moderate_activity_time = Column(Time)
-    vigorous_activity_time = Column(Time)
+    intensity_time = Column(Duration)
+    moderate_activity_time = Column(Duration)
+    vigorous_activity_time = Column(Duration)
     steps = Column(Integer)
     floors = Column(Float)
-    sleep_avg = Column(Time)
-    sleep_min = Column(Time)
-    sleep_max = Column(Time)
-    rem_sleep_avg = Column(Time)
-    rem_sleep_min = Column(Time)
-    rem_sleep_max = Column(Time)
+    sleep_avg = Column(Duration)
+    sleep_min = Column(Duration)
+    sleep_max = Column(Duration)
+    rem_sleep_avg = Column(Duration)
+    rem_sleep_min = Column(Duration)
+    rem_sleep_max = Column(Duration)
     stress_avg = Column(Integer)
     calories_avg = Column(Integer)
     calories_bmr_avg = Column(Integer)
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+
+#
+# copyright Tom Goetz
+#
+
+import logging, re, datetime, dateutil.parser
+
+logger = logging.getLogger(__name__)
+
+
+#
+# Parses the timestamps in one column of an input file. The format is found from the first value and used for the rest of
+# the values. ISO 8601 timestamps are parsed without strptime, repeated strings are looked up in a cache, and strings that
+# match none of the formats are handed to dateutil, or rejected with a ValueError if fallback is False. Returns datetimes,
+# like dateutil.parser.parse.
+#
+class DateParser():
+
+    iso_format = 'iso'
+    iso_regex = re.compile(r'^(\d{4})-(\d{2})-(\d{2})(?:[T ](\d{2}):(\d{2})(?::(\d{2})(?:\.(\d{1,6})\d*)?)?)?(Z|[+-]\d{2}:?\d{2})?$')
+
+    def __init__(self, formats=[iso_format], ignoretz=False, fallback=True, cache_size=10000):
+        self.formats = formats
+        self.ignoretz = ignoretz
+        self.fallback = fallback
+        self.cache_size = cache_size
+        self.format = None
+        self.cache = {}
+        self.fallbacks = 0
+
+    @classmethod
+    def parse_iso(cls, date_string, ignoretz=False):
+        match = cls.iso_regex.match(date_string)
+        if match is None:
+            raise ValueError("%s is not an ISO timestamp" % date_string)
+        (year, month, day, hour, minute, second, fraction, tz) = match.groups()
+        if tz is not None and not ignoretz:
+            # leave timezone aware timestamps to dateutil
+            raise ValueError("%s has a timezone" % date_string)
+        microsecond = int(fraction.ljust(6, '0')) if fraction else 0
+        return datetime.datetime(int(year), int(month), int(day), int(hour or 0), int(minute or 0), int(second or 0), microsecond)
+
+    def parse_format(self, format, date_string):
+        if format == self.iso_format:
+            return self.parse_iso(date_string, self.ignoretz)
+        return datetime.datetime.strptime(date_string, format)
+
+    def __parse(self, date_string):
+        if self.format is not None:
+            try:
+                return self.parse_format(self.format, date_string)
+            except (ValueError, TypeError):
+                pass
+        for format in self.formats:
+            if format != self.format:
+                try:
+                    value = self.parse_format(format, date_string)
+                    self.format = format
+                    return value
+                except (ValueError, TypeError):
+                    pass
+        if not self.fallback:
+            raise ValueError("%s does not match %s" % (date_string, repr(self.formats)))
+        self.fallbacks += 1
+        logger.debug("Parsing unexpected timestamp %s with dateutil", date_string)
+        return dateutil.parser.parse(date_string, ignoretz=self.ignoretz)
+
+    def parse(self, date_string):
+        value = self.cache.get(date_string)
+        if value is None:
+            value = self.__parse(date_string)
+            if len(self.cache) >= self.cache_size:
+                self.cache.clear()
+            self.cache[date_string] = value
+        return value
+
+    def __call__(self, date_string):
+        return self.parse(date_string)
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+
+#
+# copyright Tom Goetz
+#
+
+import logging, os, re, errno, gzip, threading, cPickle
+
+
+logger = logging.getLogger(__name__)
+
+
+#
+# An append-only journal of the rows written to the DBs, so the DBs can be rebuilt by replaying the journal instead of
+# importing the data files again. Each record is a (DB class, table class, op, values dict, args) tuple, where op names the
+# DBObject method that wrote the row, ex: 'insert' for a new row with its column values, 'create_or_update' for an update of an
+# existing row. The records of each commit are appended together, with the commit's number, once the commit succeeded, so rolled
+# back rows are never journaled. Records go to gzip compressed segment files numbered in the order they were started. Each
+# Journal, usually one per import run, starts a new segment and moves on to another every segment_records records, so concurrent
+# imports never append to the same segment and a segment is never modified once closed.
+#
+class Journal():
+
+    segment_regex = r'^(\d{8})\.journal\.gz$'
+
+    def __init__(self, journal_dir, segment_records=100000):
+        self.journal_dir = journal_dir
+        self.segment_records = segment_records
+        self.lock = threading.Lock()
+        self.segment = None
+        self.records = 0
+        self.total_records = 0
+        # the commits journaled, each commit's records are written with its number
+        self.commits = 0
+        if not os.path.isdir(journal_dir):
+            try:
+                os.makedirs(journal_dir)
+            except OSError:
+                # another import may have just created it
+                if not os.path.isdir(journal_dir):
+                    raise
+
+    @classmethod
+    def segments(cls, journal_dir):
+        if not os.path.isdir(journal_dir):
+            return []
+        return [journal_dir + '/' + file for file in sorted(os.listdir(journal_dir)) if re.search(cls.segment_regex, file)]
+
+    def next_segment(self):
+        segments = self.segments(self.journal_dir)
+        number = int(re.search(self.segment_regex, os.path.basename(segments[-1])).group(1)) + 1 if len(segments) > 0 else 0
+        while True:
+            path = '%s/%08d.journal.gz' % (self.journal_dir, number)
+            try:
+                # claim the segment, another import may have taken the same number
+                fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+                number += 1
+                continue
+            logger.info("Journaling to %s", path)
+            return gzip.GzipFile(path, 'wb', fileobj=os.fdopen(fd, 'wb'))
+
+    def close_segment(self):
+        if self.segment is not None:
+            # the GzipFile doesn't close a file object it was passed
+            fileobj = self.segment.fileobj
+            self.segment.close()
+            fileobj.close()
+            self.segment = None
+            self.records = 0
+
+    def write(self, records):
+        if self.segment is None:
+            self.segment = self.next_segment()
+        cPickle.dump((self.commits, records), self.segment, cPickle.HIGHEST_PROTOCOL)
+        self.commits += 1
+        self.records += len(records)
+        self.total_records += len(records)
+        if self.records >= self.segment_records:
+            self.close_segment()
+
+    def commit(self, session):
+        # Only the append is under the lock, so commits to different DBs don't wait for each other. Commits to the same sqlite DB
+        # are made one at a time, holding the DB's write lock until their records are appended (see DB.writing), so they're
+        # journaled in commit order.
+        session.commit()
+        records = session.info.pop('journal', None)
+        if records:
+            with self.lock:
+                self.write(records)
+
+    def close(self):
+        with self.lock:
+            self.close_segment()
+        logger.info("Journaled %d records to %s", self.total_records, self.journal_dir)
+
+    @classmethod
+    def read(cls, journal_dir):
+        # yields the records of all segments in the order they were journaled
+        for path in cls.segments(journal_dir):
+            segment = gzip.open(path, 'rb')
+            last_commit = None
+            try:
+                while True:
+                    try:
+                        (commit, records) = cPickle.load(segment)
+                    except EOFError:
+                        break
+                    # a segment holds consecutive commits of one Journal
+                    if last_commit is not None and commit != last_commit + 1:
+                        logger.warning("Journal segment %s is missing commits %d to %d", path, last_commit + 1, commit - 1)
+                    last_commit = commit
+                    for record in records:
+                        yield record
+            except Exception as e:
+                # an interrupted import can leave a partially written commit at the end of its segment
+                logger.warning("Journal segment %s ends early: %s", path, str(e))
+            finally:
+                segment.close()
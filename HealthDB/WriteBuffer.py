@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+
+#
+# copyright Tom Goetz
+#
+
+import logging, threading, time, Queue
+
+from DB import *
+
+
+logger = logging.getLogger(__name__)
+
+
+#
+# Collects rows for a DB and writes them in batches, one session and commit per batch, on a writer thread. At most
+# max_pending_batches full batches wait for the writer, after that adding rows blocks, so memory use stays bounded no matter
+# how many rows are written.
+#
+class WriteBuffer():
+
+    def __init__(self, db, batch_size=1000, max_pending_batches=4):
+        self.db = db
+        self.batch_size = batch_size
+        self.rows = []
+        self.batches = Queue.Queue(max_pending_batches)
+        self.rows_written = 0
+        self.write_errors = 0
+        self.writer = threading.Thread(target=self.__write_batches, name=db.db_name + '_writer')
+        self.writer.daemon = True
+        self.writer.start()
+
+    def add(self, table_func, values_dict, *args):
+        self.rows.append((table_func, values_dict, args))
+        if len(self.rows) >= self.batch_size:
+            self.flush()
+
+    def create_or_update(self, table, values_dict, ignore_none=False, fill_only=[]):
+        self.add(table._create_or_update, values_dict, ignore_none, fill_only)
+
+    def create_or_update_not_none(self, table, values_dict):
+        self.add(table._create_or_update, values_dict, True)
+
+    def find_or_create(self, table, values_dict):
+        self.add(table._find_or_create, values_dict)
+
+    def insert(self, table, values_dict):
+        # no lookup of an existing row first, the rows of a batch are inserted together when it's committed
+        self.add(table._create, values_dict, True)
+
+    def delete(self, table, values_dict):
+        # delete the rows with the given column values, ex: before inserting their replacements
+        self.add(table._delete_matching, values_dict)
+
+    def flush(self):
+        if len(self.rows) > 0:
+            self.batches.put(self.rows)
+            self.rows = []
+
+    def sync(self):
+        self.flush()
+        self.batches.join()
+
+    def close(self):
+        self.flush()
+        self.batches.put(None)
+        self.writer.join()
+        logger.info("%s: wrote %d rows with %d errors", self.db.db_name, self.rows_written, self.write_errors)
+
+    def write_row(self, session, table_func, values_dict, args):
+        try:
+            table_func(self.db, session, values_dict, *args)
+            return True
+        except ValueError as e:
+            logger.error("Row not written %s: %s", repr(values_dict), str(e))
+            self.write_errors += 1
+            return False
+
+    def write_rows_singly(self, batch):
+        for (table_func, values_dict, args) in batch:
+            session = self.db.session()
+            try:
+                with self.db.writing():
+                    if self.write_row(session, table_func, values_dict, args):
+                        DB.commit(session)
+                        self.rows_written += 1
+            except Exception as e:
+                logger.error("Row not written %s: %s", repr(values_dict), str(e))
+                session.rollback()
+                self.write_errors += 1
+            finally:
+                # also closes the session of a row that write_row skipped
+                session.close()
+
+    def try_write_batch(self, batch):
+        session = self.db.session()
+        try:
+            rows_written = 0
+            with self.db.writing():
+                for (table_func, values_dict, args) in batch:
+                    if self.write_row(session, table_func, values_dict, args):
+                        rows_written += 1
+                DB.commit(session)
+            self.rows_written += rows_written
+        except:
+            session.rollback()
+            raise
+
+    def write_batch(self, batch):
+        # A failed commit drops the whole batch, so the batch is written again. A commit that fails with an OperationalError,
+        # ex: the DB is locked, is retried after a pause. After any other error, or too many attempts, the rows are written one at
+        # a time so the bad rows are found and counted as errors.
+        write_errors = self.write_errors
+        attempts = 0
+        while True:
+            try:
+                self.try_write_batch(batch)
+                return
+            except OperationalError as e:
+                attempts += 1
+                self.write_errors = write_errors
+                if attempts >= DB.max_commit_attempts:
+                    logger.warning("Batch write to %s failed %d times, writing rows one at a time: %s", self.db.db_name, attempts, str(e))
+                    break
+                logger.warning("Batch write to %s failed, retrying: %s", self.db.db_name, str(e))
+                time.sleep(attempts)
+            except Exception as e:
+                logger.warning("Batch write to %s failed, writing rows one at a time: %s", self.db.db_name, str(e))
+                self.write_errors = write_errors
+                break
+        self.write_rows_singly(batch)
+
+    def __write_batches(self):
+        while True:
+            batch = self.batches.get()
+            try:
+                if batch is None:
+                    return
+                self.write_batch(batch)
+            except Exception as e:
+                logger.error("Failed to write batch of %d rows to %s: %s", len(batch), self.db.db_name, str(e))
+                self.write_errors += len(batch)
+            finally:
+                self.batches.task_done()
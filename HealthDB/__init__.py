@@ -1,3 +1,6 @@
 from DB import *
 from SummaryDB import *
+from DateParser import *
 from CsvImporter import *
+from WriteBuffer import *
+from Journal import *
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+
+#
+# copyright Tom Goetz
+#
+
+import logging, json
+
+import FileProcessor
+
+
+logger = logging.getLogger(__file__)
+
+
+#
+# Reads a JSON file and converts the values at the given key paths, ex: 'dailySleepDTO.calendarDate' or 'sleepLevels.*.startGMT'
+# where * is every element of a list. If the file holds an array, its elements can be read one at a time with entries()
+# without the whole array being in memory, the key paths are then relative to each element.
+#
+class JsonFileProcessor():
+
+    chunk_size = 64 * 1024
+    whitespace = ' \t\n\r'
+
+    def __init__(self, file_name, conversions={}):
+        self.file_name = file_name
+        self.conversions = [(key_path.split('.'), conversion_func) for (key_path, conversion_func) in conversions.iteritems()]
+
+    @classmethod
+    def convert_path(cls, json_data, keys, conversion_func):
+        if json_data is None or len(keys) == 0:
+            return
+        (key, rest) = (keys[0], keys[1:])
+        if key == '*':
+            if isinstance(json_data, list):
+                indexes = xrange(len(json_data))
+            else:
+                return
+        elif isinstance(json_data, dict) and key in json_data:
+            indexes = [key]
+        else:
+            return
+        for index in indexes:
+            if len(rest) == 0:
+                if json_data[index] is not None:
+                    json_data[index] = conversion_func(json_data[index])
+            else:
+                cls.convert_path(json_data[index], rest, conversion_func)
+
+    def convert(self, json_data):
+        for (keys, conversion_func) in self.conversions:
+            self.convert_path(json_data, keys, conversion_func)
+        return json_data
+
+    def document(self):
+        with FileProcessor.FileProcessor.open_file(self.file_name) as json_file:
+            return self.convert(json.load(json_file))
+
+    @classmethod
+    def iter_json_array(cls, json_file, buffer=''):
+        # Decode the array elements one at a time from a buffer that holds at most a chunk plus the element being decoded. The
+        # buffer may start with data already read from the file.
+        decoder = json.JSONDecoder()
+        pos = 0
+        eof = False
+        in_array = False
+        while True:
+            while pos < len(buffer) and buffer[pos] in cls.whitespace:
+                pos += 1
+            if pos == len(buffer):
+                if eof:
+                    if in_array:
+                        raise ValueError("Unterminated JSON array")
+                    return
+                chunk = json_file.read(cls.chunk_size)
+                eof = len(chunk) == 0
+                buffer = buffer[pos:] + chunk
+                pos = 0
+                continue
+            if not in_array:
+                if buffer[pos] != '[':
+                    raise ValueError("Not a JSON array")
+                in_array = True
+                pos += 1
+                continue
+            if buffer[pos] == ']':
+                return
+            if buffer[pos] == ',':
+                pos += 1
+                continue
+            try:
+                (element, end) = decoder.raw_decode(buffer, pos)
+                # the element isn't complete until the ',' or ']' after it has been read, ex: a number may continue in the next chunk
+                next_pos = end
+                while next_pos < len(buffer) and buffer[next_pos] in cls.whitespace:
+                    next_pos += 1
+                complete = eof or (next_pos < len(buffer) and buffer[next_pos] in ',]')
+            except ValueError:
+                if eof:
+                    raise
+                complete = False
+            if complete:
+                yield element
+                pos = end
+            else:
+                chunk = json_file.read(cls.chunk_size)
+                eof = len(chunk) == 0
+                buffer = buffer[pos:] + chunk
+                pos = 0
+
+    def entries(self):
+        with FileProcessor.FileProcessor.open_file(self.file_name) as json_file:
+            for entry in self.iter_json_array(json_file):
+                yield self.convert(entry)
@@ -25,6 +25,10 @@ class Attributes(MSHealthDB.Base, KeyValueObject):
     __tablename__ = 'attributes'
 
 
+class Quarantine(MSHealthDB.Base, QuarantineObject):
+    __tablename__ = 'quarantine'
+
+
 class DaysSummary(MSHealthDB.Base, DBObject):
     __tablename__ = 'days_summary'
 
@@ -86,7 +90,8 @@ class DaysSummary(MSHealthDB.Base, DBObject):
     def get_activity_mins_stats(cls, db, func, start_ts, end_ts):
         active_hours = func(db, cls.active_hours, start_ts, end_ts)
         if active_hours is not None:
-            intensity_time = Conversions.min_to_dt_time(active_hours * 60)
+            # a Duration, so weekly and monthly totals aren't capped at 24 hours
+            intensity_time = Duration.from_secs(active_hours * 3600)
             stats = {
                 'intensity_time' : intensity_time,
                 'moderate_activity_time' : intensity_time,
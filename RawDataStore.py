@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+
+#
+# copyright Tom Goetz
+#
+
+import logging, os, re, time, datetime, hashlib, zipfile, threading, warnings
+
+
+logger = logging.getLogger(__file__)
+
+
+#
+# Keeps downloaded data files in compressed per month zip archives (ex: 2018-10.zip) in the directory the files would
+# otherwise be saved to. Members are keyed by file name and carry the SHA1 of their content as their comment, so files that
+# are downloaded again unchanged are not stored again. If a file changes, the new version is appended and supersedes
+# the old one. Archive members are referred to by pseudo paths of the form <directory>/<archive>.zip/<file name>.
+#
+class RawDataStore():
+
+    archive_regex = r'^\d{4}-\d{2}\.zip$'
+    # members may be in folders inside the archive, ex: export.zip/DI_CONNECT/1000.fit
+    member_path_regex = r'^(.*?\.zip)/(.+)$'
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.digests = None
+
+    @classmethod
+    def member_path(cls, path):
+        # returns (archive path, member name) if path refers to an archive member
+        match = re.search(cls.member_path_regex, path)
+        if match and os.path.isfile(match.group(1)):
+            return (match.group(1), match.group(2))
+
+    @classmethod
+    def open(cls, path):
+        (archive, name) = cls.member_path(path)
+        with zipfile.ZipFile(archive, 'r') as files_zip:
+            return files_zip.open(name)
+
+    @classmethod
+    def size(cls, path):
+        (archive, name) = cls.member_path(path)
+        with zipfile.ZipFile(archive, 'r') as files_zip:
+            return files_zip.getinfo(name).file_size
+
+    @classmethod
+    def read(cls, path):
+        (archive, name) = cls.member_path(path)
+        with zipfile.ZipFile(archive, 'r') as files_zip:
+            return files_zip.read(name)
+
+    def archives(self):
+        if not os.path.isdir(self.directory):
+            return []
+        return [self.directory + '/' + file for file in sorted(os.listdir(self.directory)) if re.search(self.archive_regex, file)]
+
+    def archive_path(self, date):
+        return self.directory + '/' + date.strftime('%Y-%m') + '.zip'
+
+    def members(self):
+        # the latest version of each member: name -> (archive path, ZipInfo)
+        members = {}
+        for archive in self.archives():
+            with zipfile.ZipFile(archive, 'r') as files_zip:
+                for info in files_zip.infolist():
+                    members[info.filename] = (archive, info)
+        return members
+
+    def __digests(self):
+        if self.digests is None:
+            self.digests = {name : info.comment for (name, (archive, info)) in self.members().iteritems()}
+        return self.digests
+
+    def contains(self, name):
+        with self.lock:
+            return name in self.__digests()
+
+    def add(self, name, data, date=None):
+        # returns the path of the new member, None if the content was already stored
+        sha1 = hashlib.sha1(data).hexdigest()
+        with self.lock:
+            digests = self.__digests()
+            if digests.get(name) == sha1:
+                logger.debug("%s unchanged, not stored", name)
+                return None
+            if date is None:
+                date = datetime.date.today()
+            archive = self.archive_path(date)
+            info = zipfile.ZipInfo(name, time.localtime()[:6])
+            info.compress_type = zipfile.ZIP_DEFLATED
+            info.comment = sha1
+            with zipfile.ZipFile(archive, 'a', zipfile.ZIP_DEFLATED) as files_zip:
+                with warnings.catch_warnings():
+                    # a changed file is stored again under the same name
+                    warnings.simplefilter('ignore')
+                    files_zip.writestr(info, data)
+            digests[name] = sha1
+            return archive + '/' + name
+
+    def files(self, file_regex, since=None):
+        file_names = []
+        for (name, (archive, info)) in self.members().iteritems():
+            if re.search(file_regex, name) and (since is None or datetime.datetime(*info.date_time) > since):
+                file_names.append(archive + '/' + name)
+        return file_names
@@ -0,0 +1,219 @@
+#!/usr/bin/env python
+
+#
+# copyright Tom Goetz
+#
+
+import logging, datetime
+import xml.etree.cElementTree as ElementTree
+
+import Fit
+import GarminDB
+import FileProcessor
+from ActivityFileProcessor import ActivityFileProcessor, Stats
+
+
+logger = logging.getLogger(__file__)
+
+
+#
+# Imports TCX files in one streaming pass: laps and trackpoints are inserted into ActivityLaps and ActivityRecords, replacing
+# the ones from an earlier import of the file, as they are parsed and then dropped from the element tree, so memory use doesn't
+# grow with the length of the activity. The activity summary is accumulated along the way and written at the end of the file.
+#
+class TcxFileProcessor(ActivityFileProcessor):
+
+    file_type = Fit.FieldEnums.FileType.tcx
+
+    def start_file(self, file_name):
+        self.file_name = file_name
+        self.activity_id = None
+        self.creator = {}
+        self.lap = None
+        self.laps = 0
+        self.trackpoint = None
+        self.records = 0
+        self.calories = 0
+        self.first_trackpoint = None
+        self.last_trackpoint = None
+        self.last_distance = None
+        self.last_altitude = None
+        self.ascent = 0.0
+        self.descent = 0.0
+        # running totals rather than lists of values, so memory doesn't grow with the number of trackpoints
+        self.hr = Stats()
+        self.cadence = Stats()
+
+    def start_lap(self, element):
+        self.lap = {'start_time' : self.time_parser.parse(element.get('StartTime')), 'first_trackpoint' : None, 'last_trackpoint' : None}
+
+    def end_lap(self):
+        lap = self.lap
+        elapsed_time = lap.get('elapsed_time')
+        distance = lap.get('distance')
+        first = lap['first_trackpoint'] or {}
+        last = lap['last_trackpoint'] or {}
+        if elapsed_time is not None and elapsed_time.total_seconds() > 0 and distance is not None:
+            avg_speed = self.convert_speed(distance / elapsed_time.total_seconds())
+        else:
+            avg_speed = None
+        lap_row = {
+            'activity_id'   : self.get_activity_id(),
+            'lap'           : self.laps,
+            'start_time'    : lap['start_time'],
+            'stop_time'     : lap['start_time'] + elapsed_time if elapsed_time is not None else None,
+            'elapsed_time'  : elapsed_time,
+            'start_lat'     : first.get('position_lat'),
+            'start_long'    : first.get('position_long'),
+            'stop_lat'      : last.get('position_lat'),
+            'stop_long'     : last.get('position_long'),
+            'distance'      : self.convert_distance(distance),
+            'avg_hr'        : lap.get('avg_hr'),
+            'max_hr'        : lap.get('max_hr'),
+            'calories'      : lap.get('calories'),
+            'avg_cadence'   : lap.get('cadence'),
+            'avg_speed'     : avg_speed,
+            'max_speed'     : self.convert_speed(lap.get('max_speed')),
+        }
+        self.garmin_act_buffer.insert(GarminDB.ActivityLaps, lap_row)
+        self.calories += lap.get('calories') or 0
+        self.laps += 1
+        self.lap = None
+
+    def end_trackpoint(self):
+        trackpoint = self.trackpoint
+        self.trackpoint = None
+        if trackpoint.get('timestamp') is None:
+            return
+        if self.first_trackpoint is None:
+            self.first_trackpoint = trackpoint
+        self.last_trackpoint = trackpoint
+        if self.lap is not None:
+            if self.lap['first_trackpoint'] is None:
+                self.lap['first_trackpoint'] = trackpoint
+            self.lap['last_trackpoint'] = trackpoint
+        altitude = trackpoint.get('altitude')
+        if altitude is not None:
+            if self.last_altitude is not None:
+                if altitude > self.last_altitude:
+                    self.ascent += altitude - self.last_altitude
+                else:
+                    self.descent += self.last_altitude - altitude
+            self.last_altitude = altitude
+        if trackpoint.get('distance') is not None:
+            self.last_distance = trackpoint['distance']
+        self.hr.add(trackpoint.get('hr'))
+        self.cadence.add(trackpoint.get('cadence'))
+        record = {
+            'activity_id'   : self.get_activity_id(),
+            'record'        : self.records,
+            'timestamp'     : trackpoint['timestamp'],
+            'position_lat'  : trackpoint.get('position_lat'),
+            'position_long' : trackpoint.get('position_long'),
+            'distance'      : self.convert_distance(trackpoint.get('distance')),
+            'cadence'       : trackpoint.get('cadence'),
+            'hr'            : trackpoint.get('hr'),
+            'alititude'     : self.convert_altitude(altitude),
+            'speed'         : self.convert_speed(trackpoint.get('speed')),
+        }
+        self.garmin_act_buffer.insert(GarminDB.ActivityRecords, record)
+        self.records += 1
+
+    def end_value(self, name, parent, text):
+        if text is None:
+            return
+        text = text.strip()
+        if self.trackpoint is not None:
+            if name == 'Time':
+                self.trackpoint['timestamp'] = self.time_parser.parse(text)
+            elif name == 'LatitudeDegrees':
+                self.trackpoint['position_lat'] = float(text)
+            elif name == 'LongitudeDegrees':
+                self.trackpoint['position_long'] = float(text)
+            elif name == 'AltitudeMeters':
+                self.trackpoint['altitude'] = float(text)
+            elif name == 'DistanceMeters':
+                self.trackpoint['distance'] = float(text)
+            elif name == 'Value' and parent == 'HeartRateBpm':
+                self.trackpoint['hr'] = int(text)
+            elif name in ['Cadence', 'RunCadence']:
+                self.trackpoint['cadence'] = int(text)
+            elif name == 'Speed':
+                self.trackpoint['speed'] = float(text)
+        elif self.lap is not None:
+            if name == 'TotalTimeSeconds':
+                self.lap['elapsed_time'] = datetime.timedelta(0, float(text))
+            elif name == 'DistanceMeters':
+                self.lap['distance'] = float(text)
+            elif name == 'MaximumSpeed':
+                self.lap['max_speed'] = float(text)
+            elif name == 'Calories':
+                self.lap['calories'] = int(text)
+            elif name == 'Value' and parent == 'AverageHeartRateBpm':
+                self.lap['avg_hr'] = int(text)
+            elif name == 'Value' and parent == 'MaximumHeartRateBpm':
+                self.lap['max_hr'] = int(text)
+            elif name == 'Cadence':
+                self.lap['cadence'] = int(text)
+        elif parent == 'Creator' and name == 'Name':
+            self.creator['product'] = text
+        elif parent == 'Version' and name == 'VersionMajor':
+            self.creator['version'] = int(text)
+
+    def parse(self, tcx_file):
+        elements = []
+        for (event, element) in ElementTree.iterparse(tcx_file, events=('start', 'end')):
+            name = self.local_name(element.tag)
+            if event == 'start':
+                elements.append(element)
+                if name == 'Lap':
+                    self.start_lap(element)
+                elif name == 'Trackpoint':
+                    self.trackpoint = {}
+                continue
+            elements.pop()
+            if name == 'Trackpoint':
+                self.end_trackpoint()
+            elif name == 'Lap':
+                self.end_lap()
+            elif len(element) == 0:
+                parent = self.local_name(elements[-1].tag) if len(elements) > 0 else None
+                self.end_value(name, parent, element.text)
+            # drop the parsed element from the tree
+            element.clear()
+            if name in ['Trackpoint', 'Lap'] and len(elements) > 0:
+                elements[-1].remove(element)
+
+    def write_activity(self):
+        if self.first_trackpoint is None:
+            logger.info("%s has no trackpoints", self.file_name)
+            return
+        self.write_file(self.creator.get('product'), self.creator.get('version'), self.first_trackpoint['timestamp'])
+        activity = {
+            'activity_id'               : self.get_activity_id(),
+            'start_time'                : self.first_trackpoint['timestamp'],
+            'stop_time'                 : self.last_trackpoint['timestamp'],
+            'laps'                      : self.laps,
+            'start_lat'                 : self.first_trackpoint.get('position_lat'),
+            'start_long'                : self.first_trackpoint.get('position_long'),
+            'stop_lat'                  : self.last_trackpoint.get('position_lat'),
+            'stop_long'                 : self.last_trackpoint.get('position_long'),
+            'distance'                  : self.convert_distance(self.last_distance or 0.0),
+            'avg_hr'                    : self.hr.avg(),
+            'max_hr'                    : self.hr.max,
+            'calories'                  : self.calories,
+            'max_cadence'               : self.cadence.max,
+            'avg_cadence'               : self.cadence.avg(),
+            'ascent'                    : self.convert_altitude(self.ascent),
+            'descent'                   : self.convert_altitude(self.descent),
+        }
+        activity_not_zero = {key : value for (key, value) in activity.iteritems() if value}
+        self.assembler.add(GarminDB.Activities, activity_not_zero)
+
+    def import_file(self, file_name):
+        logger.info("Processing file: " + file_name)
+        self.start_file(file_name)
+        with FileProcessor.FileProcessor.open_file(file_name) as tcx_file:
+            self.parse(tcx_file)
+        self.write_activity()
+        logger.info("%s: %d laps %d records", file_name, self.laps, self.records)
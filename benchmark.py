@@ -0,0 +1,338 @@
+#!/usr/bin/env python
+
+#
+# copyright Tom Goetz
+#
+
+import unittest, logging, datetime, timeit, tempfile, time, os, json, csv, dateutil.parser
+
+from HealthDB import *
+import download_garmin
+import garmin_connect_standin
+from JsonFileProcessor import JsonFileProcessor
+import GarminDB
+from ActivityAssembler import ActivityAssembler
+import Fit
+from FitFileCache import FitFileCache
+from GpxFileProcessor import GpxFileProcessor
+from TcxFileProcessor import TcxFileProcessor
+from replay_journal import JournalReplay
+from FileValidator import FileValidator
+from test_healthdb import SampleDB, SampleRows, write_csv_file
+from test_file_processor import write_json_file
+from test_fit_file_processor import DecodedFitFile, monitoring_messages
+from test_activity_file_processors import write_gpx_file, write_tcx_file, activity_sources
+from test_garmindb import write_rows
+from test_file_validator import ValidatorFileSet, write_file
+
+
+logger = logging.getLogger(__name__)
+
+
+class TestRowMapper(unittest.TestCase):
+
+    iterations = 20000
+    repeats = 5
+
+    @classmethod
+    def setUpClass(cls):
+        cls.db = SampleDB({'db_type' : 'sqlite', 'db_path' : tempfile.mkdtemp()})
+        cls.values_dict = {
+            'name'          : '1234.fit',
+            'timestamp'     : datetime.datetime.now(),
+            'heart_rate'    : 60,
+            'steps'         : None,
+            'distance'      : '1.5',
+            'duration'      : datetime.time(0, 5),
+            'unknown_1'     : 1,
+            'unknown_2'     : 2,
+            'unknown_3'     : 3,
+        }
+
+    # The four pass conversion _from_dict used before row mappers.
+    def legacy_from_dict(self, instance, values_dict, ignore_none):
+        cls = instance.__class__
+        filtered = {key : value for key, value in values_dict.iteritems() if key in cls.__dict__}
+        processed_dict = cls.translate_columns(cls.relational_mappings(self.db, cls.map_columns(filtered)))
+        instance.not_none_values = 0
+        for key, value in processed_dict.iteritems():
+            if key in cls.__dict__:
+                if value is not None:
+                    instance.not_none_values += 1
+                    set_attribute(instance, key, value)
+                elif not ignore_none:
+                    set_attribute(instance, key, value)
+        return instance
+
+    def mapped_from_dict(self, instance, values_dict, ignore_none):
+        return instance._from_dict(self.db, values_dict, False, ignore_none)
+
+    def row_values(self, instance):
+        return {col.name : getattr(instance, col.name) for col in instance.__table__.columns}
+
+    def test_row_mapper_speedup(self):
+        for ignore_none in [True, False]:
+            legacy = self.legacy_from_dict(SampleRows(), dict(self.values_dict), ignore_none)
+            mapped = self.mapped_from_dict(SampleRows(), dict(self.values_dict), ignore_none)
+            self.assertEqual((legacy.not_none_values, self.row_values(legacy)), (mapped.not_none_values, self.row_values(mapped)))
+        # A new instance for each row, as from_dict makes. Best of several runs, taken in turns so both see the same load, since a
+        # single run is too noisy to compare. Creating the instance is a fixed cost of both, the row mapper measures 1.1-1.5x faster.
+        legacy_times = []
+        mapped_times = []
+        for repeat in xrange(self.repeats):
+            legacy_times.append(timeit.timeit(lambda: self.legacy_from_dict(SampleRows(), dict(self.values_dict), True), number=self.iterations))
+            mapped_times.append(timeit.timeit(lambda: self.mapped_from_dict(SampleRows(), dict(self.values_dict), True), number=self.iterations))
+        (legacy_time, mapped_time) = (min(legacy_times), min(mapped_times))
+        logger.info("_from_dict x %d: legacy %f s row mapper %f s (%.1fx)", self.iterations, legacy_time, mapped_time, legacy_time / mapped_time)
+        self.assertLess(mapped_time, legacy_time)
+
+
+class TestCsvImporter(unittest.TestCase):
+
+    rows = 5000
+    cols_map = {
+        'dateTime'          : ('day', CsvImporter.map_ymd_date),
+        'activities-steps'  : ('steps', CsvImporter.map_integer),
+        'activities-distance' : ('distance', CsvImporter.map_float),
+        'body-weight'       : ('weight', CsvImporter.map_kgs),
+        'sleep-startTime'   : ('sleep_start', CsvImporter.map_time),
+    }
+
+    @classmethod
+    def setUpClass(cls):
+        cls.filename = tempfile.mktemp(suffix='.csv')
+        write_csv_file(cls.filename, cls.rows)
+
+    # The DictReader and per row dict conversion CsvImporter used before compiled headers.
+    def legacy_entries(self, english_units):
+        entries = []
+        with open(self.filename) as csv_file:
+            for row in csv.DictReader(csv_file, delimiter=','):
+                entries.append({
+                    (self.cols_map[key][0] if key in self.cols_map else key) :
+                    (self.cols_map[key][1](english_units, value) if key in self.cols_map else value) for key, value in row.items()
+                })
+        return entries
+
+    def compiled_entries(self, english_units):
+        entries = []
+        CsvImporter(self.filename, self.cols_map, entries.extend).process_file(english_units)
+        return entries
+
+    def test_compiled_speedup(self):
+        for english_units in [True, False]:
+            self.assertEqual(self.legacy_entries(english_units), self.compiled_entries(english_units))
+        legacy_time = min(timeit.repeat(lambda: self.legacy_entries(False), number=1, repeat=3))
+        compiled_time = min(timeit.repeat(lambda: self.compiled_entries(False), number=1, repeat=3))
+        logger.info("CsvImporter x %d rows: legacy %f s compiled %f s (%.1fx)", self.rows, legacy_time, compiled_time, legacy_time / compiled_time)
+
+
+class TestWriteBuffer(unittest.TestCase):
+
+    rows = 10000
+
+    def write_rows(self):
+        write_buffer = WriteBuffer(SampleDB({'db_type' : 'sqlite', 'db_path' : tempfile.mkdtemp()}), 1000)
+        for row in xrange(self.rows):
+            write_buffer.insert(SampleRows, {'id' : row, 'heart_rate' : 60})
+        write_buffer.close()
+
+    def test_batches(self):
+        write_time = timeit.timeit(self.write_rows, number=1)
+        logger.info("WriteBuffer x %d rows: %f s", self.rows, write_time)
+
+
+class TestDateParser(unittest.TestCase):
+
+    iterations = 2000
+    repeats = 3
+    start = datetime.datetime(2018, 10, 14, 5, 37, 0, 500000)
+
+    def timestamps(self, format):
+        return [(self.start + datetime.timedelta(0, 60 * minute)).strftime(format) for minute in xrange(self.iterations)]
+
+    def compare(self, name, date_strings, legacy_func, parser):
+        self.assertEqual([legacy_func(date_string) for date_string in date_strings], [parser.parse(date_string) for date_string in date_strings])
+        parser.cache.clear()
+        legacy_time = min(timeit.repeat(lambda: [legacy_func(date_string) for date_string in date_strings], number=1, repeat=self.repeats))
+        # a fresh cache for each run, so the time is for parsing rather than cache lookups
+        parser_time = min(timeit.repeat(lambda: [parser.parse(date_string) for date_string in date_strings], setup=parser.cache.clear, number=1,
+            repeat=self.repeats))
+        logger.info("%s x %d: legacy %f s DateParser %f s (%.1fx)", name, len(date_strings), legacy_time, parser_time, legacy_time / parser_time)
+
+    def test_garmin_gmt(self):
+        self.compare('startGMT', self.timestamps('%Y-%m-%dT%H:%M:%S.0'), dateutil.parser.parse, DateParser())
+
+    def test_calendar_date(self):
+        dates = [day.split(' ')[0] for day in self.timestamps('%Y-%m-%d %H:%M:%S')]
+        self.compare('calendarDate', dates, dateutil.parser.parse, DateParser())
+
+    def test_utc(self):
+        self.compare('tcx', self.timestamps('%Y-%m-%dT%H:%M:%S.000Z'), lambda date_string: dateutil.parser.parse(date_string, ignoretz=True),
+            DateParser(ignoretz=True))
+
+    def test_mdy(self):
+        legacy_func = lambda date_string: datetime.datetime.strptime(date_string, "%m/%d/%y %H:%M")
+        self.compare('mdy', self.timestamps('%m/%d/%y %H:%M'), legacy_func, DateParser(["%m/%d/%y %H:%M", "%m/%d/%y"], fallback=False))
+
+
+class TestJsonFileProcessor(unittest.TestCase):
+
+    samples = 50000
+
+    @classmethod
+    def setUpClass(cls):
+        cls.filename = tempfile.mktemp(suffix='.json')
+        write_json_file(cls.filename, cls.samples)
+
+    def test_first_entry_latency(self):
+        # json.load has to read the whole file before the first sample is available
+        load_time = min(timeit.repeat(lambda: json.load(open(self.filename))[0], number=1, repeat=3))
+        first_time = min(timeit.repeat(lambda: next(JsonFileProcessor(self.filename).entries()), number=1, repeat=3))
+        all_time = min(timeit.repeat(lambda: sum(1 for entry in JsonFileProcessor(self.filename).entries()), number=1, repeat=3))
+        logger.info("%d samples: json.load %f s, first entry %f s, all entries %f s", self.samples, load_time, first_time, all_time)
+
+
+class TestGpxFileProcessor(unittest.TestCase):
+
+    trackpoints = 20000
+
+    def test_import(self):
+        db_dir = tempfile.mkdtemp()
+        filename = db_dir + '/1000.gpx'
+        write_gpx_file(filename, self.trackpoints)
+        gpx_processor = GpxFileProcessor({'db_type' : 'sqlite', 'db_path' : db_dir}, False, 0)
+        import_time = timeit.timeit(lambda: gpx_processor.import_file(filename), number=1)
+        gpx_processor.close()
+        logger.info("%d GPX trackpoints imported in %f s", self.trackpoints, import_time)
+
+
+class TestTcxFileProcessor(unittest.TestCase):
+
+    trackpoints = 20000
+
+    def test_import(self):
+        db_dir = tempfile.mkdtemp()
+        filename = db_dir + '/1000.tcx'
+        write_tcx_file(filename, self.trackpoints, 2)
+        tcx_processor = TcxFileProcessor({'db_type' : 'sqlite', 'db_path' : db_dir}, False, 0)
+        import_time = timeit.timeit(lambda: tcx_processor.import_file(filename), number=1)
+        tcx_processor.close()
+        logger.info("%d TCX trackpoints imported in %f s", self.trackpoints, import_time)
+
+
+class TestActivityAssembler(unittest.TestCase):
+
+    activities = 500
+
+    def upsert_each(self):
+        garmin_act_db = GarminDB.ActivitiesDB({'db_type' : 'sqlite', 'db_path' : tempfile.mkdtemp()})
+        for activity_id in xrange(self.activities):
+            for (table, values_dict, fill_only) in activity_sources(activity_id):
+                table.create_or_update_not_none(garmin_act_db, {key : value for (key, value) in values_dict.iteritems() if key not in fill_only})
+
+    def assemble(self):
+        assembler = ActivityAssembler({'db_type' : 'sqlite', 'db_path' : tempfile.mkdtemp()}, 0)
+        for activity_id in xrange(self.activities):
+            for (table, values_dict, fill_only) in activity_sources(activity_id):
+                assembler.add(table, values_dict, fill_only)
+        assembler.write()
+
+    def test_assembler_speedup(self):
+        upsert_time = timeit.timeit(self.upsert_each, number=1)
+        assemble_time = timeit.timeit(self.assemble, number=1)
+        logger.info("%d activities: upserting each source %f s, assembled %f s", self.activities, upsert_time, assemble_time)
+
+
+class TestFitFileCache(unittest.TestCase):
+
+    messages = 20000
+
+    def test_replay_time(self):
+        fit_cache = FitFileCache(tempfile.mkdtemp())
+        key = fit_cache.key(os.urandom(64 * 1024), False)
+        fit_cache.save(key, 'test.fit', DecodedFitFile(monitoring_messages(self.messages)), [Fit.MessageType.monitoring])
+        entry_size = os.path.getsize(fit_cache.path(key))
+        load_time = min(timeit.repeat(lambda: fit_cache.load(key, 'test.fit')[Fit.MessageType.monitoring], number=1, repeat=3))
+        logger.info("%d messages: cache entry %d bytes, replayed in %f s", self.messages, entry_size, load_time)
+
+
+class TestJournal(unittest.TestCase):
+
+    nights = 200
+    weights = 2000
+    records = 5000
+
+    def tearDown(self):
+        DB.journal = None
+
+    def test_replay_time(self):
+        journal_dir = tempfile.mkdtemp()
+        DB.journal = Journal(journal_dir, 10000)
+        import_time = timeit.timeit(lambda: write_rows({'db_type' : 'sqlite', 'db_path' : tempfile.mkdtemp()}, self.nights, self.weights, self.records),
+            number=1)
+        DB.journal.close()
+        DB.journal = None
+        replay_db_params_dict = {'db_type' : 'sqlite', 'db_path' : tempfile.mkdtemp()}
+        replay_time = timeit.timeit(lambda: JournalReplay(replay_db_params_dict, None, 0).replay(journal_dir), number=1)
+        records = sum(1 for record in Journal.read(journal_dir))
+        logger.info("%d journaled records in %d segments: imported in %f s, replayed in %f s", records, len(Journal.segments(journal_dir)),
+            import_time, replay_time)
+
+
+class TestFileValidator(unittest.TestCase):
+
+    json_files = 50
+    json_file_samples = 2000
+
+    def test_parallel_speedup(self):
+        file_dir = tempfile.mkdtemp()
+        samples = [{'date' : day, 'weight' : 80.0} for day in xrange(self.json_file_samples)]
+        file_names = [write_file(file_dir, '%d.json' % file, json.dumps(samples)) for file in xrange(self.json_files)]
+        serial_time = timeit.timeit(lambda: FileValidator(processes=1).validate(ValidatorFileSet(list(file_names))), number=1)
+        parallel_time = timeit.timeit(lambda: FileValidator().validate(ValidatorFileSet(list(file_names))), number=1)
+        logger.info("%d JSON files of %d samples: validated in %f s, in %f s with %d processes", self.json_files, self.json_file_samples,
+            serial_time, parallel_time, FileValidator().processes)
+
+
+class TestDownload(unittest.TestCase):
+
+    days = 30
+
+    @classmethod
+    def setUpClass(cls):
+        cls.data = garmin_connect_standin.GarminConnectData(days=cls.days, activities=40)
+        # a little latency with some server errors and rate limiting, as from the real service on a bad day
+        cls.server = garmin_connect_standin.GarminConnectStandIn(cls.data, latency=0.02, error_rate=0.05, throttle_rate=0.05)
+        cls.server.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+
+    def timed_download(self, concurrency, function, *args):
+        download = download_garmin.Download(rate=1000, concurrency=concurrency, base_url=self.server.base_url, sso_url=self.server.sso_url)
+        download.session_file = tempfile.mktemp()
+        download.backoff_base = 0.01
+        self.assertTrue(download.login('user', 'password'))
+        start = time.time()
+        getattr(download, function)(tempfile.mkdtemp(), *args)
+        elapsed = time.time() - start
+        download.close()
+        return elapsed
+
+    def test_download_monitoring(self):
+        for concurrency in [1, 4]:
+            elapsed = self.timed_download(concurrency, 'get_monitoring', self.data.first_day, self.days)
+            logger.info("monitoring x %d days concurrency %d: %f s (%.1f days/s)", self.days, concurrency, elapsed, self.days / elapsed)
+
+    def test_download_activities(self):
+        activities = len(self.data.activity_ids())
+        for concurrency in [1, 4]:
+            elapsed = self.timed_download(concurrency, 'get_activities', 1000)
+            logger.info("activities x %d concurrency %d: %f s (%.1f activities/s)", activities, concurrency, elapsed, activities / elapsed)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    unittest.main(verbosity=2)
@@ -4,11 +4,14 @@
 # copyright Tom Goetz
 #
 
-import os, sys, getopt, re, logging, datetime, time, tempfile, zipfile, json, dateutil.parser
+import os, sys, getopt, re, logging, datetime, time, tempfile, zipfile, json, threading, itertools, random, email.utils, Queue, dateutil.parser
+from multiprocessing.pool import ThreadPool
 import requests
 
 import GarminDB
 from Fit import Conversions
+from FitFileProcessor import FitFileProcessor
+from RawDataStore import RawDataStore
 
 
 logging.basicConfig(level=logging.INFO)
@@ -16,41 +19,95 @@ root_logger = logging.getLogger()
 logger = logging.getLogger()
 
 
-class Download():
-
-    garmin_connect_base_url = "https://connect.garmin.com"
-
-    garmin_connect_sso_url = 'https://sso.garmin.com/sso'
-    garmin_connect_sso_login_url = garmin_connect_sso_url + '/signin'
-
-    garmin_connect_login_url = garmin_connect_base_url + "/en-US/signin"
+#
+# Raised when part of a download that has to be complete, ex: a chunk of the weight history, failed after all retries.
+#
+class DownloadError(Exception):
+    pass
 
-    garmin_connect_css_url = 'https://static.garmincdn.com/com.garmin.connect/ui/css/gauth-custom-v1.2-min.css'
 
-    garmin_connect_modern_url = garmin_connect_base_url + "/modern"
-    garmin_connect_activities_url = garmin_connect_modern_url + "/activities"
+#
+# Token bucket shared by all download threads: on average rate requests a second, with bursts of at most burst requests.
+#
+class RateLimiter():
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.last = time.time()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.burst, self.tokens + ((now - self.last) * self.rate))
+            self.last = now
+            # take the token now, going into debt if needed, so waiting threads are served in order
+            self.tokens -= 1
+            wait = -self.tokens / self.rate
+        if wait > 0:
+            time.sleep(wait)
 
-    garmin_connect_modern_proxy_url = garmin_connect_modern_url + '/proxy'
-    garmin_connect_download_url = garmin_connect_modern_proxy_url + "/download-service/files"
-    garmin_connect_download_activity_url = garmin_connect_download_url + "/activity/"
 
-    garmin_connect_download_daily_url = garmin_connect_download_url + "/wellness"
-    garmin_connect_user_profile_url = garmin_connect_modern_proxy_url + "/userprofile-service/userprofile"
-    garmin_connect_personal_info_url = garmin_connect_user_profile_url + "/personal-information"
-    garmin_connect_wellness_url = garmin_connect_modern_proxy_url + "/wellness-service/wellness"
-    garmin_connect_hr_daily_url = garmin_connect_wellness_url + "/dailyHeartRate"
-    garmin_connect_stress_daily_url = garmin_connect_wellness_url + "/dailyStress"
-    garmin_connect_sleep_daily_url = garmin_connect_wellness_url + "/dailySleepData"
+#
+# Per endpoint request state: a semaphore bounding concurrent requests, a circuit breaker that fails requests fast after
+# repeated failures, and request metrics.
+#
+class Endpoint():
+
+    def __init__(self, url, concurrency, circuit_breaker_failures, circuit_breaker_reset):
+        self.url = url
+        self.semaphore = threading.BoundedSemaphore(concurrency)
+        self.circuit_breaker_failures = circuit_breaker_failures
+        self.circuit_breaker_reset = circuit_breaker_reset
+        self.lock = threading.Lock()
+        self.consecutive_failures = 0
+        self.open_until = 0
+        self.requests = 0
+        self.retries = 0
+        self.failures = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+    def circuit_open(self):
+        return time.time() < self.open_until
+
+    def record_request(self, latency):
+        with self.lock:
+            self.requests += 1
+            self.total_latency += latency
+            self.max_latency = max(self.max_latency, latency)
+
+    def record_success(self):
+        with self.lock:
+            self.consecutive_failures = 0
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            self.consecutive_failures += 1
+            if self.consecutive_failures >= self.circuit_breaker_failures:
+                logger.error("%s failed %d times in a row, not retrying for %d seconds", self.url, self.consecutive_failures,
+                    self.circuit_breaker_reset)
+                self.open_until = time.time() + self.circuit_breaker_reset
+
+    def record_retry(self):
+        with self.lock:
+            self.retries += 1
+
+    def log_metrics(self):
+        if self.requests > 0:
+            logger.info("%s: %d requests %d retries %d failures latency avg %.3fs max %.3fs", self.url, self.requests, self.retries,
+                self.failures, self.total_latency / self.requests, self.max_latency)
 
-    garmin_connect_rhr_url = garmin_connect_modern_proxy_url + "/userstats-service/wellness/daily"
-    garmin_connect_weight_url = garmin_connect_personal_info_url + "/weightWithOutbound/filterByDay"
 
-    garmin_connect_biometric_url = garmin_connect_modern_proxy_url + "/biometric-service/biometric"
-    garmin_connect_weight_by_date_url = garmin_connect_biometric_url + "/weightByDate"
+class Download():
 
-    garmin_connect_activity_search_url = garmin_connect_modern_proxy_url + "/activitylist-service/activities/search/activities"
+    garmin_connect_base_url = "https://connect.garmin.com"
+    garmin_connect_sso_url = 'https://sso.garmin.com/sso'
 
-    garmin_connect_course_url = garmin_connect_modern_proxy_url + "/course-service/course"
+    garmin_connect_css_url = 'https://static.garmincdn.com/com.garmin.connect/ui/css/gauth-custom-v1.2-min.css'
 
     agents = {
         'Chrome_Linux'  : 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/1337 Safari/537.36',
@@ -58,29 +115,180 @@ class Download():
     }
     agent = agents['Firefox_MacOS']
 
-    def __init__(self):
+    # failed requests with these status codes or connection errors are retried with exponential backoff
+    retry_status_codes = [429, 500, 502, 503, 504]
+    max_retries = 5
+    backoff_base = 1.0
+    backoff_max = 60.0
+    timeout = 30
+    # an endpoint is not used for circuit_breaker_reset seconds after circuit_breaker_failures failed requests in a row
+    circuit_breaker_failures = 10
+    circuit_breaker_reset = 300
+
+    # activities are listed newest first, a page at a time
+    activity_page_size = 20
+
+    # the logged in session is saved and reused by later runs until it expires
+    session_file = os.path.expanduser('~/.garmindb_session.json')
+    session_max_age = 12 * 3600
+
+    def __init__(self, rate=1.0, concurrency=4, endpoint_concurrency=2, import_queue=None, base_url=None, sso_url=None, archive=False):
+        # the URLs can be pointed at a stand-in server for testing
+        self.set_urls(base_url or self.garmin_connect_base_url, sso_url or self.garmin_connect_sso_url)
         self.temp_dir = tempfile.mkdtemp()
+        # if set, the paths of FIT files are put on the import queue as soon as they are extracted or archived
+        self.import_queue = import_queue
+        # if set, data files are saved to per month compressed archives instead of individual files
+        self.archive = archive
+        self.raw_data_stores = {}
         logger.debug("__init__: temp_dir= " + self.temp_dir)
         self.session = requests.session()
+        self.rate_limiter = RateLimiter(rate)
+        self.concurrency = concurrency
+        self.pool = ThreadPool(concurrency)
+        self.endpoint_concurrency = endpoint_concurrency
+        self.endpoints = {}
+        self.endpoint_lock = threading.Lock()
+
+    def set_urls(self, base_url, sso_url):
+        self.garmin_connect_base_url = base_url
+        self.garmin_connect_sso_url = sso_url
+        self.garmin_connect_sso_login_url = self.garmin_connect_sso_url + '/signin'
+
+        self.garmin_connect_login_url = self.garmin_connect_base_url + "/en-US/signin"
+
+        self.garmin_connect_modern_url = self.garmin_connect_base_url + "/modern"
+        self.garmin_connect_activities_url = self.garmin_connect_modern_url + "/activities"
+
+        self.garmin_connect_modern_proxy_url = self.garmin_connect_modern_url + '/proxy'
+        self.garmin_connect_download_url = self.garmin_connect_modern_proxy_url + "/download-service/files"
+        self.garmin_connect_download_activity_url = self.garmin_connect_download_url + "/activity/"
+
+        self.garmin_connect_download_daily_url = self.garmin_connect_download_url + "/wellness"
+        self.garmin_connect_user_profile_url = self.garmin_connect_modern_proxy_url + "/userprofile-service/userprofile"
+        self.garmin_connect_personal_info_url = self.garmin_connect_user_profile_url + "/personal-information"
+        self.garmin_connect_wellness_url = self.garmin_connect_modern_proxy_url + "/wellness-service/wellness"
+        self.garmin_connect_hr_daily_url = self.garmin_connect_wellness_url + "/dailyHeartRate"
+        self.garmin_connect_stress_daily_url = self.garmin_connect_wellness_url + "/dailyStress"
+        self.garmin_connect_sleep_daily_url = self.garmin_connect_wellness_url + "/dailySleepData"
+
+        self.garmin_connect_rhr_url = self.garmin_connect_modern_proxy_url + "/userstats-service/wellness/daily"
+        self.garmin_connect_weight_url = self.garmin_connect_personal_info_url + "/weightWithOutbound/filterByDay"
+
+        self.garmin_connect_biometric_url = self.garmin_connect_modern_proxy_url + "/biometric-service/biometric"
+        self.garmin_connect_weight_by_date_url = self.garmin_connect_biometric_url + "/weightByDate"
+
+        self.garmin_connect_activity_search_url = self.garmin_connect_modern_proxy_url + "/activitylist-service/activities/search/activities"
+
+        self.garmin_connect_course_url = self.garmin_connect_modern_proxy_url + "/course-service/course"
+
+        # requests are limited per endpoint, the endpoint of a URL is the longest of these it starts with
+        self.endpoint_urls = [
+            self.garmin_connect_download_daily_url, self.garmin_connect_sleep_daily_url, self.garmin_connect_download_activity_url,
+            self.garmin_connect_modern_proxy_url + '/activity-service/activity', self.garmin_connect_activity_search_url,
+            self.garmin_connect_weight_url, self.garmin_connect_rhr_url
+        ]
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+        for endpoint in self.endpoints.values():
+            endpoint.log_metrics()
+
+    def endpoint_url(self, url):
+        for endpoint_url in sorted(self.endpoint_urls, key=len, reverse=True):
+            if url.startswith(endpoint_url):
+                return endpoint_url
+        return url
+
+    def endpoint(self, url):
+        endpoint_url = self.endpoint_url(url)
+        with self.endpoint_lock:
+            endpoint = self.endpoints.get(endpoint_url)
+            if endpoint is None:
+                endpoint = Endpoint(endpoint_url, self.endpoint_concurrency, self.circuit_breaker_failures, self.circuit_breaker_reset)
+                self.endpoints[endpoint_url] = endpoint
+            return endpoint
+
+    def download_all(self, function, args_list):
+        # run function over args_list on the download threads, results are returned in args_list order
+        return self.pool.map(lambda args: function(*args), args_list)
+
+    def download_until_empty(self, function, args_iter):
+        # fetch concurrency chunks at a time, stop at the first chunk that comes back empty, a chunk that failed raises DownloadError
+        data = []
+        while True:
+            for chunk_data in self.download_all(function, list(itertools.islice(args_iter, self.concurrency))):
+                if not chunk_data:
+                    return data
+                data.extend(chunk_data)
 
     def get_activity_details_url(self, activity_id):
         return self.garmin_connect_modern_proxy_url + '/activity-service/activity/%s' % str(activity_id)
 
-    def get(self, url, params={}):
+    def retry_after(self, response):
+        # Retry-After is either a number of seconds or an HTTP date
+        retry_after = response.headers.get('Retry-After')
+        if retry_after is not None:
+            try:
+                return float(retry_after)
+            except ValueError:
+                retry_date = email.utils.parsedate_tz(retry_after)
+                if retry_date is not None:
+                    return email.utils.mktime_tz(retry_date) - time.time()
+
+    def retry_delay(self, attempt, response):
+        if response is not None and response.status_code in [429, 503]:
+            retry_after = self.retry_after(response)
+            if retry_after is not None:
+                return max(retry_after, 0) + random.uniform(0, self.backoff_base)
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+
+    def request(self, method, url, **kwargs):
         headers = {
             'User-Agent': self.agent
         }
-        response = self.session.get(url, headers=headers, params=params)
-        logger.debug("get: %s (%d)", response.url, response.status_code)
+        endpoint = self.endpoint(url)
+        for attempt in xrange(self.max_retries + 1):
+            if endpoint.circuit_open():
+                logger.error("%s: not requesting %s, too many failures", method, url)
+                return None
+            with endpoint.semaphore:
+                self.rate_limiter.acquire()
+                start = time.time()
+                try:
+                    response = self.session.request(method, url, headers=headers, timeout=self.timeout, **kwargs)
+                    logger.debug("%s: %s (%d)", method, response.url, response.status_code)
+                    error = response.status_code
+                except requests.exceptions.RequestException as e:
+                    response = None
+                    error = str(e)
+                endpoint.record_request(time.time() - start)
+            if response is not None and response.status_code not in self.retry_status_codes:
+                endpoint.record_success()
+                return response
+            endpoint.record_failure()
+            if attempt < self.max_retries and not endpoint.circuit_open():
+                delay = self.retry_delay(attempt, response)
+                logger.warning("%s: %s failed (%s), retrying in %.1f seconds", method, url, error, delay)
+                endpoint.record_retry()
+                time.sleep(delay)
+            else:
+                break
+        logger.error("%s: %s failed (%s) after %d retries", method, url, error, attempt)
         return response
 
+    def get(self, url, params={}):
+        return self.request('GET', url, params=params)
+
     def post(self, url, params, data):
-        headers = {
-            'User-Agent': self.agent
-        }
-        response = self.session.post(url, headers=headers, params=params, data=data)
-        logger.debug("post: %s (%d)", response.url, response.status_code)
-        return response
+        return self.request('POST', url, params=params, data=data)
+
+    def get_json_data(self, url, params={}):
+        response = self.get(url, params)
+        if response is not None and response.status_code == 200:
+            return response.json()
+        logger.error("get_json_data: %s failed", url)
 
     def get_json(self, page_html, key):
         found = re.search(key + r" = JSON.parse\(\"(.*)\"\);", page_html, re.M)
@@ -88,7 +296,62 @@ class Download():
             json_text = found.group(1).replace('\\"', '"')
             return json.loads(json_text)
 
+    def set_user(self, user_prefs, social_profile):
+        self.user_prefs = user_prefs
+        self.display_name = self.user_prefs['displayName']
+        self.english_units = (self.user_prefs['measurementSystem'] == 'statute_us')
+        self.social_profile = social_profile
+        self.full_name = self.social_profile['fullName']
+        logger.info("login: %s (%s) english units: %s", self.full_name, self.display_name, str(self.english_units))
+
+    def save_session(self, username):
+        session = {
+            'username'          : username,
+            'expires'           : time.time() + self.session_max_age,
+            'cookies'           : [
+                {'name' : cookie.name, 'value' : cookie.value, 'domain' : cookie.domain, 'path' : cookie.path} for cookie in self.session.cookies
+            ],
+            'user_prefs'        : self.user_prefs,
+            'social_profile'    : self.social_profile,
+        }
+        try:
+            # the cookies are credentials, keep the file private to the user
+            fd = os.open(self.session_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600)
+            with os.fdopen(fd, 'w') as file:
+                json.dump(session, file)
+        except (IOError, OSError) as e:
+            logger.warning("Failed to save session to %s: %s", self.session_file, str(e))
+
+    def resume_session(self, username):
+        try:
+            with open(self.session_file, 'r') as file:
+                session = json.load(file)
+        except (IOError, OSError, ValueError):
+            return False
+        if session.get('username') != username or session.get('expires', 0) < time.time():
+            logger.info("Saved session expired or for a different user")
+            return False
+        for cookie in session['cookies']:
+            self.session.cookies.set(cookie['name'], cookie['value'], domain=cookie['domain'], path=cookie['path'])
+        # one request checks that the session is still logged in
+        response = self.get(self.garmin_connect_modern_url)
+        if response is None or response.status_code != 200 or self.get_json(response.text, 'VIEWER_USERPREFERENCES') is None:
+            logger.info("Saved session is no longer valid")
+            self.session.cookies.clear()
+            return False
+        logger.info("Resumed saved session")
+        self.set_user(session['user_prefs'], session['social_profile'])
+        return True
+
     def login(self, username, password):
+        if self.resume_session(username):
+            return True
+        if self.sso_login(username, password):
+            self.save_session(username)
+            return True
+        return False
+
+    def sso_login(self, username, password):
         logger.debug("login: %s %s", username, password)
         params = {
             'service': self.garmin_connect_modern_url,
@@ -113,8 +376,8 @@ class Download():
             'generateExtraServiceTicket': 'false'
         }
         response = self.get(self.garmin_connect_sso_login_url, params)
-        if response.status_code != 200:
-            logger.error("Login failed: " + response.text)
+        if response is None or response.status_code != 200:
+            logger.error("Login failed")
             return False
         data = {
             'username': username,
@@ -125,6 +388,9 @@ class Download():
             'displayNameRequired': 'false'
         }
         response = self.post(self.garmin_connect_sso_login_url, params, data)
+        if response is None:
+            logger.error("Login failed")
+            return False
         found = re.search(r"\?ticket=([\w-]*)", response.text, re.M)
         if not found:
             logger.error("Login failed: " + response.text)
@@ -133,15 +399,10 @@ class Download():
             'ticket' : found.group(1)
         }
         response = self.get(self.garmin_connect_modern_url, params)
-        if response.status_code != 200:
-            logger.error("Login failed: " + response.text)
+        if response is None or response.status_code != 200:
+            logger.error("Login failed")
             return False
-        self.user_prefs = self.get_json(response.text, 'VIEWER_USERPREFERENCES')
-        self.display_name = self.user_prefs['displayName']
-        self.english_units = (self.user_prefs['measurementSystem'] == 'statute_us')
-        self.social_profile = self.get_json(response.text, 'VIEWER_SOCIAL_PROFILE')
-        self.full_name = self.social_profile['fullName']
-        logger.info("login: %s (%s) english units: %s", self.full_name, self.display_name, str(self.english_units))
+        self.set_user(self.get_json(response.text, 'VIEWER_USERPREFERENCES'), self.get_json(response.text, 'VIEWER_SOCIAL_PROFILE'))
         return True
 
     def save_binary_file(self, filename, response):
@@ -152,32 +413,65 @@ class Download():
     def convert_to_json(self, object):
         return object.__str__()
 
+    def raw_data_store(self, directory):
+        with self.endpoint_lock:
+            raw_data_store = self.raw_data_stores.get(directory)
+            if raw_data_store is None:
+                raw_data_store = RawDataStore(directory)
+                self.raw_data_stores[directory] = raw_data_store
+            return raw_data_store
+
+    def file_exists(self, filename):
+        if os.path.isfile(filename):
+            return True
+        return self.archive and self.raw_data_store(os.path.dirname(filename)).contains(os.path.basename(filename))
+
+    def save_file(self, filename, data, date=None):
+        if self.archive:
+            self.raw_data_store(os.path.dirname(filename)).add(os.path.basename(filename), data, date)
+        else:
+            with open(filename, 'wb') as file:
+                file.write(data)
+
     def save_json_file(self, json_filename, json_data):
-        with open(json_filename + '.json', 'w') as file:
-            file.write(json.dumps(json_data, default=self.convert_to_json))
-
-    def unzip_files(self, outdir):
-        logger.info("unzip_files: " + outdir)
-        for filename in os.listdir(self.temp_dir):
-            match = re.search('.*\.zip', filename)
-            if match:
-                files_zip = zipfile.ZipFile(self.temp_dir + "/" + filename, 'r')
-                files_zip.extractall(outdir)
-                files_zip.close()
-
-    def get_monitoring_day(self, date):
+        self.save_file(json_filename + '.json', json.dumps(json_data, default=self.convert_to_json))
+
+    def save_zip_file(self, zip_filename, response, outdir, date=None):
+        # download to the temp dir, check it, then extract it straight to outdir or add its files to the raw data store
+        temp_filename = self.temp_dir + '/' + zip_filename
+        self.save_binary_file(temp_filename, response)
+        try:
+            with zipfile.ZipFile(temp_filename, 'r') as files_zip:
+                bad_file = files_zip.testzip()
+                if bad_file is not None:
+                    logger.error("save_zip_file: %s failed CRC check on %s", zip_filename, bad_file)
+                    return False
+                for member in files_zip.namelist():
+                    if self.archive:
+                        file_name = self.raw_data_store(outdir).add(os.path.basename(member), files_zip.read(member), date)
+                        if file_name is None:
+                            continue
+                    else:
+                        file_name = files_zip.extract(member, outdir)
+                    logger.debug("save_zip_file: %s -> %s", zip_filename, file_name)
+                    if self.import_queue is not None and file_name.lower().endswith('.fit'):
+                        self.import_queue.put(file_name)
+            return True
+        except zipfile.BadZipfile as e:
+            logger.error("save_zip_file: %s is not a zip file: %s", zip_filename, str(e))
+            return False
+        finally:
+            os.remove(temp_filename)
+
+    def get_monitoring_day(self, outdir, date):
         logger.info("get_monitoring_day: %s", str(date))
         response = self.get(self.garmin_connect_download_daily_url + '/' + date.strftime("%Y-%m-%d"))
-        if response and response.status_code == 200:
-            self.save_binary_file(self.temp_dir + '/' + str(date) + '.zip', response)
+        if response is not None and response.status_code == 200:
+            self.save_zip_file(str(date) + '.zip', response, outdir, date)
 
-    def get_monitoring(self, date, days):
+    def get_monitoring(self, outdir, date, days):
         logger.info("get_monitoring: %s : %d", str(date), days)
-        for day in xrange(0, days):
-            day_date = date + datetime.timedelta(day)
-            self.get_monitoring_day(day_date)
-            # pause for a second between every page access
-            time.sleep(1)
+        self.download_all(self.get_monitoring_day, [(outdir, date + datetime.timedelta(day)) for day in xrange(0, days)])
 
     def get_weight_chunk(self, start, end):
         logger.info("get_weight_chunk: %d - %d", start, end)
@@ -185,24 +479,27 @@ class Download():
             'from' : str(start),
             "until" : str(end)
         }
-        response = self.get(self.garmin_connect_weight_url, params)
-        return response.json()
-
-    def get_weight(self):
-        logger.info("get_weight")
-        data = []
+        json_data = self.get_json_data(self.garmin_connect_weight_url, params)
+        if json_data is None:
+            raise DownloadError("weight %d - %d failed" % (start, end))
+        return json_data
+
+    def get_weight_history_chunk(self, start, end):
+        chunk_data = self.get_weight_chunk(start, end)
+        if len(chunk_data) > 1:
+            return chunk_data
+
+    def get_weight(self, start=None):
+        logger.info("get_weight: %s", str(start))
         chunk_size = int((86400 * 365) * 1000)
-        end = Conversions.dt_to_epoch_ms(datetime.datetime.now())
-        while True:
-            start = end - chunk_size
-            chunk_data = self.get_weight_chunk(start, end)
-            if len(chunk_data) <= 1:
-                break
-            data.extend(chunk_data)
-            end -= chunk_size
-            # pause for a second between every page access
-            time.sleep(1)
-        return data
+        now = Conversions.dt_to_epoch_ms(datetime.datetime.now())
+        if start is None:
+            # walk back until there's no more data
+            chunks = ((end - chunk_size, end) for end in itertools.count(now, -chunk_size))
+            return self.download_until_empty(self.get_weight_history_chunk, chunks)
+        start_ms = Conversions.dt_to_epoch_ms(start)
+        chunks = [(max(end - chunk_size, start_ms), end) for end in range(now, start_ms, -chunk_size)]
+        return [entry for chunk_data in self.download_all(self.get_weight_chunk, chunks) for entry in chunk_data]
 
     def get_activity_summaries(self, start, count):
         logger.info("get_activity_summaries")
@@ -210,57 +507,95 @@ class Download():
             'start' : str(start),
             "limit" : str(count)
         }
-        response = self.get(self.garmin_connect_activity_search_url, params)
-        if response.status_code == 200:
-            return response.json()
+        return self.get_json_data(self.garmin_connect_activity_search_url, params)
 
     def save_activity_details(self, directory, activity_id_str):
         logger.debug("save_activity_details")
-        response = self.get(self.get_activity_details_url(activity_id_str))
-        if response.status_code == 200:
-            json_filename = directory + '/activity_details_' + activity_id_str
-            self.save_json_file(json_filename, response.json())
+        json_data = self.get_json_data(self.get_activity_details_url(activity_id_str))
+        if json_data is None:
+            return False
+        json_filename = directory + '/activity_details_' + activity_id_str
+        self.save_json_file(json_filename, json_data)
+        return True
 
-    def save_activity_file(self, activity_id_str):
+    def save_activity_file(self, directory, activity_id_str):
         logger.debug("save_activity_file: " + activity_id_str)
         response = self.get(self.garmin_connect_download_activity_url + activity_id_str)
-        if response.status_code == 200:
-            self.save_binary_file(self.temp_dir + '/activity_' + activity_id_str + '.zip', response)
+        if response is None or response.status_code != 200:
+            return False
+        return self.save_zip_file('activity_' + activity_id_str + '.zip', response, directory)
+
+    def get_activity(self, directory, activity):
+        # returns True if the activity's details and FIT files were saved, the summary is saved by get_activities
+        activity_id_str = str(activity['activityId'])
+        logger.debug("get_activity: %s <- %s" % (activity_id_str, repr(activity)))
+        details_saved = self.save_activity_details(directory, activity_id_str)
+        file_saved = self.save_activity_file(directory, activity_id_str)
+        return details_saved and file_saved
+
+    def save_activity_summary(self, directory, activity):
+        self.save_json_file(directory + '/activity_' + str(activity['activityId']), activity)
+
+    def known_activity(self, directory, activity_id_str, activities_db):
+        if self.file_exists(directory + '/activity_' + activity_id_str + '.json'):
+            return True
+        return activities_db is not None and GarminDB.Activities.get_id(activities_db, int(activity_id_str)) is not None
+
+    def get_new_activity_summaries(self, directory, count, overwite, activities_db, scan_all=False):
+        # page through the activity list until the first activity we already have, or with scan_all through the whole list
+        # skipping the ones we have
+        new_activities = []
+        start = 0
+        while start < count:
+            limit = min(self.activity_page_size, count - start)
+            activities = self.get_activity_summaries(start, limit)
+            if not activities:
+                break
+            for activity in activities:
+                activity_id_str = str(activity['activityId'])
+                activity_name_str = Conversions.printable(activity['activityName'])
+                if not overwite and self.known_activity(directory, activity_id_str, activities_db):
+                    if scan_all:
+                        logger.debug("get_activities: skipping known activity %s (%s)" % (activity_name_str, activity_id_str))
+                        continue
+                    logger.info("get_activities: stopping at known activity %s (%s)" % (activity_name_str, activity_id_str))
+                    return new_activities
+                logger.info("get_activities: %s (%s)" % (activity_name_str, activity_id_str))
+                new_activities.append(activity)
+            if len(activities) < limit:
+                break
+            start += len(activities)
+        return new_activities
 
-    def get_activities(self, directory, count, overwite=False):
+    def get_activities(self, directory, count, overwite=False, activities_db=None, scan_all=False):
         logger.info("get_activities: '%s' (%d)" % (directory, count))
-        activities = self.get_activity_summaries(0, count)
-        for activity in activities:
-            activity_id_str = str(activity['activityId'])
-            activity_name_str = Conversions.printable(activity['activityName'])
-            logger.info("get_activities: %s (%s)" % (activity_name_str, activity_id_str))
-            json_filename = directory + '/activity_' + activity_id_str
-            if not os.path.isfile(json_filename + '.json') or overwite:
-                logger.debug("get_activities: %s <- %s" % (json_filename, repr(activity)))
-                self.save_activity_details(directory, activity_id_str)
-                self.save_json_file(json_filename, activity)
-                self.save_activity_file(activity_id_str)
-                # pause for a second between every page access
-                time.sleep(1)
+        new_activities = self.get_new_activity_summaries(directory, count, overwite, activities_db, scan_all)
+        logger.info("get_activities: downloading %d new activities" % len(new_activities))
+        saved = self.download_all(self.get_activity, [(directory, activity) for activity in new_activities])
+        # Saving the summary marks an activity as known and the next scan stops at the first known activity, so an activity is
+        # only marked once it and all of the older new activities were saved. The ones after the oldest failure are downloaded
+        # again next time.
+        for index in reversed(xrange(len(new_activities))):
+            if not saved[index]:
+                logger.error("get_activities: failed to download %s, the %d newer activities will be downloaded again",
+                    new_activities[index]['activityId'], index)
+                break
+            self.save_activity_summary(directory, new_activities[index])
 
     def get_sleep_day(self, directory, date):
         filename = directory + '/sleep_' + str(date) + '.json'
-        if not os.path.isfile(filename):
+        if not self.file_exists(filename):
             logger.info("get_sleep_day: %s -> %s", str(date), filename)
             params = {
                 'date' : date.strftime("%Y-%m-%d")
             }
             response = self.get(self.garmin_connect_sleep_daily_url + '/' + self.display_name, params)
-            if response.status_code == 200:
-                self.save_binary_file(filename, response)
+            if response is not None and response.status_code == 200:
+                self.save_file(filename, response.content, date)
 
     def get_sleep(self, directory, date, days):
         logger.info("get_sleep: %s : %d" % (str(date), days))
-        for day in xrange(0, days):
-            day_date = date + datetime.timedelta(day)
-            self.get_sleep_day(directory, day_date)
-            # pause for a second between every page access
-            time.sleep(1)
+        self.download_all(self.get_sleep_day, [(directory, date + datetime.timedelta(day)) for day in xrange(0, days)])
 
     def get_rhr_chunk(self, start, end):
         start_str = start.strftime("%Y-%m-%d")
@@ -271,31 +606,88 @@ class Download():
             'untilDate' : end_str,
             'metricId' : 60
         }
-        response = self.get(self.garmin_connect_rhr_url + '/' + self.display_name, params)
-        json_data = response.json()
+        json_data = self.get_json_data(self.garmin_connect_rhr_url + '/' + self.display_name, params)
+        if json_data is None:
+            raise DownloadError("rhr %s - %s failed" % (start_str, end_str))
         try:
             rhr_data = json_data['allMetrics']['metricsMap']['WELLNESS_RESTING_HEART_RATE']
             return [entry for entry in rhr_data if entry['value'] is not None]
         except Exception:
-            logger.error("get_rhr_chunk: unexpected format - %s", repr(json_data))
+            raise DownloadError("rhr %s - %s unexpected format: %s" % (start_str, end_str, repr(json_data)))
 
-    def get_rhr(self):
-        logger.info("get_rhr")
-        data = []
+    def get_rhr(self, start=None):
+        logger.info("get_rhr: %s", str(start))
         chunk_size = datetime.timedelta(30)
-        end = datetime.datetime.now()
-        while True:
-            start = end - chunk_size
-            chunk_data = self.get_rhr_chunk(start, end)
-            if chunk_data is None or len(chunk_data) == 0:
-                break
-            data.extend(chunk_data)
-            end -= chunk_size
-            # pause for a second between every page access
-            time.sleep(1)
-        return data
+        now = datetime.datetime.now()
+        chunks = ((now - (chunk_size * (chunk + 1)), now - (chunk_size * chunk)) for chunk in itertools.count())
+        if start is None:
+            # walk back until there's no more data
+            return self.download_until_empty(self.get_rhr_chunk, chunks)
+        start = datetime.datetime.combine(start, datetime.time.min)
+        chunks = [(max(chunk_start, start), chunk_end) for (chunk_start, chunk_end) in itertools.takewhile(lambda chunk: chunk[1] > start, chunks)]
+        return [entry for chunk_data in self.download_all(self.get_rhr_chunk, chunks) for entry in chunk_data]
+
+    def save_weight(self, directory, last_ts=None):
+        # nothing is saved if any of the data failed to download, a partial file would leave gaps the next update doesn't fill
+        try:
+            if last_ts is None:
+                self.save_json_file(directory + '/weight_' + str(int(time.time())), self.get_weight())
+            else:
+                # fetch and save just the data since the last update, starting with the last day to pick up changes to it
+                logger.info("Automatically downloading weight data from: " + str(last_ts))
+                weight_data = self.get_weight(last_ts)
+                if len(weight_data) > 0:
+                    self.save_json_file(directory + '/weight_%s_%s' % (str(last_ts.date()), str(datetime.datetime.now().date())), weight_data)
+        except DownloadError as e:
+            logger.error("Weight data not saved, download failed: %s", str(e))
+
+    def save_rhr(self, directory, last_day=None):
+        try:
+            if last_day is None:
+                self.save_json_file(directory + '/rhr_' + str(int(time.time())), self.get_rhr())
+            else:
+                logger.info("Automatically downloading rhr data from: " + str(last_day))
+                rhr_data = self.get_rhr(last_day)
+                if len(rhr_data) > 0:
+                    self.save_json_file(directory + '/rhr_%s_%s' % (str(last_day), str(datetime.datetime.now().date())), rhr_data)
+        except DownloadError as e:
+            logger.error("Resting heart rate data not saved, download failed: %s", str(e))
+
+
+def days_since(last_day, name):
+    # the days after the last one in the DB up to today, or the last month if the DB has none
+    if last_day is None:
+        days = 31
+        date = datetime.datetime.now().date() - datetime.timedelta(days)
+        logger.info("Automatic date not found, using: " + str(date))
+    else:
+        # start from the day after the last day in the DB
+        logger.info("Automatically downloading %s data from: %s", name, str(last_day))
+        date = last_day + datetime.timedelta(1)
+        days = (datetime.datetime.now().date() - date).days
+    return (date, days)
 
 
+def latest_monitoring_days(mondb):
+    last_ts = GarminDB.Monitoring.latest_time(mondb)
+    return days_since(last_ts.date() if last_ts is not None else None, 'monitoring')
+
+
+def latest_sleep_days(garmindb):
+    return days_since(GarminDB.Sleep.latest_time(garmindb), 'sleep')
+
+
+def import_fit_files(import_queue, db_params_dict, english_units, debug):
+    fp = FitFileProcessor(db_params_dict, english_units, debug)
+    try:
+        for file_name in iter(import_queue.get, None):
+            try:
+                fp.import_file(file_name)
+            except Exception as e:
+                logger.error("Failed to import %s: %s", file_name, str(e))
+    finally:
+        fp.close()
+
 
 def usage(program):
     print '%s -d [<date> -n <days> | -l <path to dbs>] -u <username> -p <password> [-m <outdir> | -w ]' % program
@@ -303,6 +695,15 @@ def usage(program):
     print '  -l check the garmin DB and find out what the most recent date is and fetch monitoring data from that date on'
     print '  -m <outdir> fetches the daily monitoring FIT files for each day specified, unzips them, and puts them in outdit'
     print '  -w <outdit> fetches the daily weight data for each day specified and puts them in the DB'
+    print '  -r <outdir> fetches the daily resting heart rate data and puts them in outdir'
+    print '     with -l weight and resting heart rate are only fetched from the latest date in the garmin DB on'
+    print '  -i import downloaded FIT files into the DBs as they are extracted or archived'
+    print '  -z save downloaded JSON and FIT files to compressed per month archives in the output directories'
+    print '  --rate <requests per second> limit the request rate, defaults to 1'
+    print '  --base_url <url> --sso_url <url> download from somewhere other than Garmin Connect, ex: garmin_connect_standin.py'
+    print '  --concurrency <n> number of requests that may be in progress at once, defaults to 4'
+    print '  --scan_all page through the whole activity list and download the activities that are missing, instead of stopping at the'
+    print '     first activity that was already downloaded'
     sys.exit()
 
 def main(argv):
@@ -316,15 +717,22 @@ def main(argv):
     activity_count = 1000
     monitoring = None
     overwite = False
+    scan_all = False
     weight = None
     rhr = None
     sleep = None
     debug = 0
+    rate = 1.0
+    concurrency = 4
+    import_files = False
+    archive = False
+    base_url = None
+    sso_url = None
 
     try:
-        opts, args = getopt.getopt(argv,"a:c:d:n:lm:op:r:S:s:t:u:w:",
-            ["activities=", "activity_count=", "date=", "days=", "username=", "password=", "latest", "monitoring=", "mysql=",
-             "overwrite", "rhr=", "sqlite=", "sleep=", "trace=", "weight="])
+        opts, args = getopt.getopt(argv,"a:c:d:in:lm:op:r:S:s:t:u:w:z",
+            ["activities=", "activity_count=", "archive", "date=", "days=", "import", "username=", "password=", "latest", "monitoring=", "mysql=",
+             "overwrite", "rate=", "concurrency=", "base_url=", "scan_all", "sso_url=", "rhr=", "sqlite=", "sleep=", "trace=", "weight="])
     except getopt.GetoptError:
         usage(sys.argv[0])
 
@@ -342,6 +750,12 @@ def main(argv):
         elif opt in ("-d", "--date"):
             logger.debug("Date: " + arg)
             date = dateutil.parser.parse(arg).date()
+        elif opt in ("-z", "--archive"):
+            logger.debug("Archive")
+            archive = True
+        elif opt in ("-i", "--import"):
+            logger.debug("Import")
+            import_files = True
         elif opt in ("-n", "--days"):
             logger.debug("Days: " + arg)
             days = int(arg)
@@ -359,6 +773,9 @@ def main(argv):
             monitoring = arg
         elif opt in ("-o", "--overwite"):
             overwite = True
+        elif opt == "--scan_all":
+            logger.debug("Scan all activities")
+            scan_all = True
         elif opt in ("-S", "--sleep"):
             logger.debug("Sleep: " + arg)
             sleep = arg
@@ -368,6 +785,18 @@ def main(argv):
         elif opt in ("-r", "--rhr"):
             logger.debug("Resting heart rate")
             rhr = arg
+        elif opt == "--rate":
+            logger.debug("Rate: " + arg)
+            rate = float(arg)
+        elif opt == "--concurrency":
+            logger.debug("Concurrency: " + arg)
+            concurrency = int(arg)
+        elif opt == "--base_url":
+            logger.debug("Base URL: " + arg)
+            base_url = arg
+        elif opt == "--sso_url":
+            logger.debug("SSO URL: " + arg)
+            sso_url = arg
         elif opt in ("-s", "--sqlite"):
             logging.debug("Sqlite DB path: %s" % arg)
             db_params_dict['db_type'] = 'sqlite'
@@ -391,60 +820,67 @@ def main(argv):
     if not username or not password:
         print "Missing arguments: need username and password"
         usage(sys.argv[0])
-    if len(db_params_dict) == 0 and monitoring and latest:
+    if len(db_params_dict) == 0 and (((monitoring or sleep or weight or rhr) and latest) or import_files):
         print "Missing arguments: must specify <db params> with --sqlite or --mysql"
         usage(sys.argv[0])
 
-    download = Download()
-    download.login(username, password)
-
-    if activities and activity_count > 0:
-        logger.info("Fetching %d activities" % activity_count)
-        download.get_activities(activities, activity_count, overwite)
-        download.unzip_files(activities)
-
-    if latest and monitoring:
-        mondb = GarminDB.MonitoringDB(db_params_dict)
-        last_ts = GarminDB.Monitoring.latest_time(mondb)
-        if last_ts is None:
-            days = 31
-            date = datetime.datetime.now().date() - datetime.timedelta(days)
-            logger.info("Automatic date not found, using: " + str(date))
-        else:
-            # start from the day after the last day in the DB
-            logger.info("Automatically downloading monitoring data from: " + str(last_ts))
-            date = last_ts.date() + datetime.timedelta(1)
-            days = (datetime.datetime.now().date() - date).days
-
-    if latest and sleep:
-        garmindb = GarminDB.GarminDB(db_params_dict)
-        last_ts = GarminDB.Sleep.latest_time(garmindb)
-        if last_ts is None:
-            days = 31
-            date = datetime.datetime.now().date() - datetime.timedelta(days)
-            logger.info("Automatic date not found, using: " + str(date))
-        else:
-            # start from the day after the last day in the DB
-            logger.info("Automatically downloading sleep data from: " + str(last_ts))
-            date = last_ts + datetime.timedelta(1)
-            days = (datetime.datetime.now().date() - date).days
-
-    if monitoring and days > 0:
-        logger.info("Date range to update: %s (%d)" % (str(date), days))
-        download.get_monitoring(date, days)
-        download.unzip_files(monitoring)
-        logger.info("Saved monitoring files for %s (%d) to %s for processing" % (str(date), days, monitoring))
-
-    if sleep and days > 0:
-        logger.info("Date range to update: %s (%d)" % (str(date), days))
-        download.get_sleep(sleep, date, days)
-        logger.info("Saved sleep files for %s (%d) to %s for processing" % (str(date), days, sleep))
-
-    if weight:
-       download.save_json_file(weight + '/weight_' + str(int(time.time())), download.get_weight())
-
-    if rhr:
-        download.save_json_file(rhr + '/rhr_' + str(int(time.time())), download.get_rhr())
+    if import_files:
+        import_queue = Queue.Queue()
+    else:
+        import_queue = None
+    download = Download(rate, concurrency, import_queue=import_queue, base_url=base_url, sso_url=sso_url, archive=archive)
+    if not download.login(username, password):
+        download.close()
+        print "Failed to log in to Garmin Connect"
+        sys.exit(1)
+    if import_files:
+        # import FIT files while the rest are still downloading
+        importer = threading.Thread(target=import_fit_files, name='importer', args=(import_queue, db_params_dict, download.english_units, debug))
+        importer.start()
+    try:
+        if activities and activity_count > 0:
+            logger.info("Fetching %d activities" % activity_count)
+            if len(db_params_dict) > 0:
+                activities_db = GarminDB.ActivitiesDB(db_params_dict)
+            else:
+                activities_db = None
+            download.get_activities(activities, activity_count, overwite, activities_db, scan_all)
+
+        if latest and monitoring:
+            (date, days) = latest_monitoring_days(GarminDB.MonitoringDB(db_params_dict))
+
+        if latest and sleep:
+            (date, days) = latest_sleep_days(GarminDB.GarminDB(db_params_dict))
+
+        if monitoring and days > 0:
+            logger.info("Date range to update: %s (%d)" % (str(date), days))
+            download.get_monitoring(monitoring, date, days)
+            logger.info("Saved monitoring files for %s (%d) to %s for processing" % (str(date), days, monitoring))
+
+        if sleep and days > 0:
+            logger.info("Date range to update: %s (%d)" % (str(date), days))
+            download.get_sleep(sleep, date, days)
+            logger.info("Saved sleep files for %s (%d) to %s for processing" % (str(date), days, sleep))
+
+        if weight:
+            if latest:
+                last_ts = GarminDB.Weight.latest_time(GarminDB.GarminDB(db_params_dict))
+            else:
+                last_ts = None
+            download.save_weight(weight, last_ts)
+
+        if rhr:
+            if latest:
+                last_day = GarminDB.RestingHeartRate.latest_time(GarminDB.GarminDB(db_params_dict))
+            else:
+                last_day = None
+            download.save_rhr(rhr, last_day)
+    finally:
+        download.close()
+        if import_files:
+            # the importer isn't a daemon thread, it has to be told to stop even if the downloads failed
+            import_queue.put(None)
+            importer.join()
 
 
 if __name__ == "__main__":
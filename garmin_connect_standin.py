@@ -0,0 +1,325 @@
+#!/usr/bin/env python
+
+#
+# copyright Tom Goetz
+#
+
+import sys, getopt, logging, datetime, time, json, random, threading, zipfile, StringIO, urlparse, Cookie
+import BaseHTTPServer, SocketServer
+
+
+logger = logging.getLogger(__file__)
+
+
+#
+# A local stand-in for the parts of Garmin Connect that download_garmin.py uses, serving synthetic data. Latency, server
+# errors and rate limiting can be injected to exercise and benchmark the downloader without an account or network.
+#
+class GarminConnectData():
+
+    display_name = 'standin'
+    full_name = 'Stand In'
+    session_id = 'standin-session'
+    ticket = 'ST-0000000-standin'
+
+    def __init__(self, days=365, activities=50, monitoring_files_per_day=3, seed=0):
+        self.days = days
+        self.activities = activities
+        self.monitoring_files_per_day = monitoring_files_per_day
+        self.seed = seed
+        self.today = datetime.date.today()
+        self.first_day = self.today - datetime.timedelta(days - 1)
+
+    def random(self, *args):
+        return random.Random(repr((self.seed,) + args))
+
+    def in_range(self, day):
+        return self.first_day <= day <= self.today
+
+    def epoch_ms(self, dt):
+        return int(time.mktime(dt.timetuple())) * 1000
+
+    def zip_file(self, files):
+        buffer = StringIO.StringIO()
+        files_zip = zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED)
+        for (name, data) in files:
+            files_zip.writestr(name, data)
+        files_zip.close()
+        return buffer.getvalue()
+
+    def fit_data(self, *args):
+        rand = self.random(*args)
+        return ''.join(chr(rand.randint(0, 255)) for _ in xrange(rand.randint(2048, 4096)))
+
+    def monitoring_file_names(self, day):
+        return ['%d.fit' % ((day.toordinal() * 10) + index) for index in xrange(self.monitoring_files_per_day)]
+
+    def monitoring_zip(self, day):
+        return self.zip_file([(name, self.fit_data('monitoring', name)) for name in self.monitoring_file_names(day)])
+
+    def user_prefs(self):
+        return {'displayName' : self.display_name, 'measurementSystem' : 'metric'}
+
+    def social_profile(self):
+        return {'displayName' : self.display_name, 'fullName' : self.full_name}
+
+    def sleep(self, day):
+        rand = self.random('sleep', day)
+        start = datetime.datetime.combine(day - datetime.timedelta(1), datetime.time(22)) + datetime.timedelta(minutes=rand.randint(0, 90))
+        levels = []
+        level_start = start
+        for index in xrange(rand.randint(8, 16)):
+            level_end = level_start + datetime.timedelta(minutes=rand.randint(10, 60))
+            levels.append({'startGMT' : level_start.isoformat(), 'endGMT' : level_end.isoformat(), 'activityLevel' : float(rand.randint(0, 2))})
+            level_start = level_end
+        return {
+            'dailySleepDTO' : {
+                'calendarDate'              : day.isoformat(),
+                'sleepStartTimestampGMT'    : self.epoch_ms(start),
+                'sleepEndTimestampGMT'      : self.epoch_ms(level_start),
+                'sleepTimeSeconds'          : int((level_start - start).total_seconds()),
+                'deepSleepSeconds'          : rand.randint(3600, 7200),
+                'lightSleepSeconds'         : rand.randint(7200, 14400),
+                'remSleepSeconds'           : None,
+                'awakeSleepSeconds'         : rand.randint(0, 1800),
+            },
+            'sleepLevels' : levels,
+        }
+
+    def weight(self, start_ms, end_ms):
+        weights = []
+        for day_index in xrange(self.days):
+            day = self.today - datetime.timedelta(day_index)
+            timestamp = self.epoch_ms(datetime.datetime.combine(day, datetime.time(7)))
+            if start_ms <= timestamp < end_ms:
+                weights.append({'date' : timestamp, 'weight' : self.random('weight', day).randint(70000, 75000)})
+        return weights
+
+    def rhr(self, start_day, end_day):
+        days = (end_day - start_day).days + 1
+        entries = []
+        for day in (start_day + datetime.timedelta(index) for index in xrange(days)):
+            if self.in_range(day):
+                entries.append({'calendarDate' : day.isoformat(), 'value' : float(self.random('rhr', day).randint(45, 60))})
+        return {'allMetrics' : {'metricsMap' : {'WELLNESS_RESTING_HEART_RATE' : entries}}}
+
+    def activity_ids(self):
+        # newest first
+        return [1000 + index for index in reversed(xrange(self.activities))]
+
+    def activity(self, activity_id):
+        index = activity_id - 1000
+        start = datetime.datetime.combine(self.today, datetime.time(12)) - datetime.timedelta(days=(self.activities - index))
+        return {
+            'activityId'        : activity_id,
+            'activityName'      : 'Stand in activity %d' % activity_id,
+            'startTimeLocal'    : start.strftime('%Y-%m-%d %H:%M:%S'),
+            'activityType'      : {'typeKey' : 'running'},
+            'distance'          : float(self.random('distance', activity_id).randint(1000, 20000)),
+            'duration'          : float(self.random('duration', activity_id).randint(600, 7200)),
+        }
+
+    def activity_search(self, start, limit):
+        return [self.activity(activity_id) for activity_id in self.activity_ids()[start:start + limit]]
+
+    def activity_details(self, activity_id):
+        return {'activityId' : activity_id, 'summaryDTO' : self.activity(activity_id)}
+
+    def activity_zip(self, activity_id):
+        return self.zip_file([('%d.fit' % activity_id, self.fit_data('activity', activity_id))])
+
+
+class GarminConnectHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+    def send(self, status, body='', content_type='application/json', headers={}):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for header, value in headers.iteritems():
+            self.send_header(header, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_json(self, json_data):
+        self.send(200, json.dumps(json_data))
+
+    def logged_in(self):
+        cookie = Cookie.SimpleCookie(self.headers.get('Cookie', ''))
+        return 'SESSIONID' in cookie and cookie['SESSIONID'].value == self.server.data.session_id
+
+    def json_parse_script(self, key, json_data):
+        return '%s = JSON.parse("%s");\n' % (key, json.dumps(json_data).replace('"', '\\"'))
+
+    def inject(self):
+        # returns True if a fault was injected instead of handling the request
+        server = self.server
+        if server.latency > 0:
+            time.sleep(server.latency)
+        fault = server.random.random()
+        if fault < server.throttle_rate:
+            server.count('throttled')
+            self.send(429, headers={'Retry-After' : str(server.retry_after)})
+            return True
+        if fault < server.throttle_rate + server.error_rate:
+            server.count('errors')
+            self.send(server.random.choice([500, 503]))
+            return True
+        return False
+
+    def do_GET(self):
+        self.handle_request('GET')
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.handle_request('POST')
+
+    def handle_request(self, method):
+        url = urlparse.urlparse(self.path)
+        path = url.path
+        params = dict(urlparse.parse_qsl(url.query))
+        self.server.count(method + ' ' + path)
+        if path in self.server.failing_paths:
+            self.server.count('errors')
+            self.send(500)
+            return
+        if self.inject():
+            return
+        data = self.server.data
+        try:
+            if path == '/sso/signin':
+                if method == 'GET':
+                    self.send(200, '<html>sign in</html>', 'text/html')
+                else:
+                    self.send(200, '<html>var response_url = "%s/modern?ticket=%s";</html>' % (self.server.base_url, data.ticket), 'text/html')
+            elif path == '/modern':
+                if params.get('ticket') == data.ticket or self.logged_in():
+                    page = self.json_parse_script('VIEWER_USERPREFERENCES', data.user_prefs())
+                    page += self.json_parse_script('VIEWER_SOCIAL_PROFILE', data.social_profile())
+                    self.send(200, page, 'text/html', {'Set-Cookie' : 'SESSIONID=%s; Path=/' % data.session_id})
+                else:
+                    self.send(200, '<html>sign in</html>', 'text/html')
+            elif not path.startswith('/modern/proxy/'):
+                self.send(404)
+            elif not self.logged_in():
+                self.send(403)
+            else:
+                self.handle_proxy_request(data, path[len('/modern/proxy'):], params)
+        except ValueError as e:
+            logger.warning("Bad request %s: %s", self.path, str(e))
+            self.send(400)
+
+    def handle_proxy_request(self, data, path, params):
+        parts = path.strip('/').split('/')
+        if path.startswith('/download-service/files/wellness/'):
+            day = datetime.datetime.strptime(parts[-1], '%Y-%m-%d').date()
+            if data.in_range(day):
+                self.send(200, data.monitoring_zip(day), 'application/zip')
+            else:
+                self.send(404)
+        elif path.startswith('/download-service/files/activity/'):
+            activity_id = int(parts[-1])
+            if activity_id in data.activity_ids():
+                self.send(200, data.activity_zip(activity_id), 'application/zip')
+            else:
+                self.send(404)
+        elif path.startswith('/activity-service/activity/'):
+            self.send_json(data.activity_details(int(parts[-1])))
+        elif path == '/activitylist-service/activities/search/activities':
+            self.send_json(data.activity_search(int(params.get('start', 0)), int(params.get('limit', 20))))
+        elif path.startswith('/wellness-service/wellness/dailySleepData/'):
+            day = datetime.datetime.strptime(params['date'], '%Y-%m-%d').date()
+            self.send_json(data.sleep(day) if data.in_range(day) else {})
+        elif path == '/userprofile-service/userprofile/personal-information/weightWithOutbound/filterByDay':
+            self.send_json(data.weight(int(params['from']), int(params['until'])))
+        elif path.startswith('/userstats-service/wellness/daily/'):
+            start_day = datetime.datetime.strptime(params['fromDate'], '%Y-%m-%d').date()
+            end_day = datetime.datetime.strptime(params['untilDate'], '%Y-%m-%d').date()
+            self.send_json(data.rhr(start_day, end_day))
+        else:
+            self.send(404)
+
+
+class GarminConnectStandIn(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self, data=None, port=0, latency=0.0, error_rate=0.0, throttle_rate=0.0, retry_after=0, seed=0):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', port), GarminConnectHandler)
+        self.data = data or GarminConnectData(seed=seed)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        # requests for these paths always fail, ex: to test a download that keeps failing
+        self.failing_paths = set()
+        self.base_url = 'http://127.0.0.1:%d' % self.server_port
+        self.sso_url = self.base_url + '/sso'
+        self.counts_lock = threading.Lock()
+        self.counts = {}
+        self.thread = None
+
+    def count(self, name):
+        with self.counts_lock:
+            self.counts[name] = self.counts.get(name, 0) + 1
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, name='garmin_connect_standin')
+        self.thread.daemon = True
+        self.thread.start()
+        logger.info("Garmin Connect stand in serving %s", self.base_url)
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        self.thread.join()
+
+
+def usage(program):
+    print '%s [-p <port>] [-l <latency secs>] [-e <error rate>] [-r <429 rate>] [-d <days>] [-a <activities>]' % program
+    print '  serves synthetic Garmin Connect data, point download_garmin.py at it with --base_url'
+    sys.exit()
+
+def main(argv):
+    port = 8080
+    latency = 0.0
+    error_rate = 0.0
+    throttle_rate = 0.0
+    days = 365
+    activities = 50
+
+    try:
+        opts, args = getopt.getopt(argv,"a:d:e:hl:p:r:", ["activities=", "days=", "errors=", "latency=", "port=", "rate_limit="])
+    except getopt.GetoptError:
+        usage(sys.argv[0])
+
+    for opt, arg in opts:
+        if opt == '-h':
+            usage(sys.argv[0])
+        elif opt in ("-a", "--activities"):
+            activities = int(arg)
+        elif opt in ("-d", "--days"):
+            days = int(arg)
+        elif opt in ("-e", "--errors"):
+            error_rate = float(arg)
+        elif opt in ("-l", "--latency"):
+            latency = float(arg)
+        elif opt in ("-p", "--port"):
+            port = int(arg)
+        elif opt in ("-r", "--rate_limit"):
+            throttle_rate = float(arg)
+
+    logging.basicConfig(level=logging.INFO)
+    server = GarminConnectStandIn(GarminConnectData(days, activities), port, latency, error_rate, throttle_rate)
+    logger.info("Garmin Connect stand in serving %s", server.base_url)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -6,9 +6,11 @@
 
 import os, sys, getopt, re, string, logging, datetime, time, traceback
 
+import HealthDB
 from HealthDB import CsvImporter
 import FitBitDB
 import FileProcessor
+from FileValidator import FileValidator
 
 
 logger = logging.getLogger(__file__)
@@ -43,10 +45,13 @@ class FitBitData():
         'body-fat': ('body_fat', CsvImporter.map_float),
         'sleep-awakeningsCount': ('awakenings_count', CsvImporter.map_integer),
     }
+    # checked by FileValidator
+    required_columns = ['dateTime']
 
-    def __init__(self, input_file, input_dir, db_params_dict, english_units, debug):
+    def __init__(self, input_file, input_dir, db_params_dict, english_units, debug, validator=None):
         self.english_units = english_units
         self.fitbitdb = FitBitDB.FitBitDB(db_params_dict, debug)
+        self.validator = validator if validator is not None else FileValidator()
         if input_file:
             self.file_names = FileProcessor.FileProcessor.match_file(input_file, '.*.csv')
         if input_dir:
@@ -55,19 +60,22 @@ class FitBitData():
     def file_count(self):
         return len(self.file_names)
 
-    def write_entry(self, db_entry):
-        FitBitDB.DaysSummary.find_or_create(self.fitbitdb, db_entry)
+    def write_entries(self, db_entries):
+        created = FitBitDB.DaysSummary.find_or_create_all(self.fitbitdb, db_entries)
+        logger.info("Wrote %d new of %d entries", created, len(db_entries))
 
     def process_files(self):
         for file_name in self.file_names:
             logger.info("Processing file: " + file_name)
-            self.csvimporter = CsvImporter(file_name, self.cols_map, self.write_entry)
-            self.csvimporter.process_file(self.english_units)
+            with self.validator.importing(file_name):
+                self.csvimporter = CsvImporter(file_name, self.cols_map, self.write_entries)
+                self.csvimporter.process_file(self.english_units)
 
 
 
 def usage(program):
     print '%s -o <dbpath> -i <inputfile> ...' % program
+    print '    --journal_dir <dir> : journal the rows written to the DBs in dir, so the DBs can be rebuilt with replay_journal.py'
     sys.exit()
 
 def main(argv):
@@ -75,10 +83,11 @@ def main(argv):
     english_units = False
     input_file = None
     input_dir = None
+    journal_dir = None
     db_params_dict = {}
 
     try:
-        opts, args = getopt.getopt(argv,"dD:ei:m:s:", ["debug", "english", "input_dir=", "input_file=", "mysql=", "sqlite="])
+        opts, args = getopt.getopt(argv,"dD:ei:m:s:", ["debug", "english", "input_dir=", "input_file=", "journal_dir=", "mysql=", "sqlite="])
     except getopt.GetoptError:
         usage(sys.argv[0])
 
@@ -95,6 +104,9 @@ def main(argv):
         elif opt in ("-D", "--input_dir"):
             logging.debug("Input dir: %s" % arg)
             input_dir = arg
+        elif opt == "--journal_dir":
+            logging.debug("Journal dir: %s" % arg)
+            journal_dir = arg
         elif opt in ("-s", "--sqlite"):
             logging.debug("Sqlite DB path: %s" % arg)
             db_params_dict['db_type'] = 'sqlite'
@@ -116,9 +128,18 @@ def main(argv):
         print "Missing arguments:"
         usage(sys.argv[0])
 
-    fd = FitBitData(input_file, input_dir, db_params_dict, english_units, debug)
-    if fd.file_count() > 0:
-        fd.process_files()
+    if journal_dir:
+        HealthDB.DB.journal = HealthDB.Journal(journal_dir)
+    try:
+        validator = FileValidator(FitBitDB.FitBitDB(db_params_dict, debug), FitBitDB.Quarantine)
+        fd = FitBitData(input_file, input_dir, db_params_dict, english_units, debug, validator)
+        validator.validate(fd)
+        if fd.file_count() > 0:
+            fd.process_files()
+        validator.log_summary()
+    finally:
+        if HealthDB.DB.journal is not None:
+            HealthDB.DB.journal.close()
 
 
 if __name__ == "__main__":
@@ -4,33 +4,27 @@
 # copyright Tom Goetz
 #
 
-import os, sys, getopt, string, logging, datetime, traceback, json, dateutil.parser, enum
+import os, sys, getopt, string, logging, datetime, traceback, enum, itertools, multiprocessing
 
 import Fit
 import FileProcessor
 import FitFileProcessor
+from JsonFileProcessor import JsonFileProcessor
+from FileValidator import FileValidator
 import GarminDB
+import HealthDB
 
 
 root_logger = logging.getLogger()
 logger = logging.getLogger(__file__)
 
 
-def parse_json_file(filename, conversions):
-    def json_parser(entry):
-        for (conversion_key, conversion_func) in conversions.iteritems():
-            entry_value = entry.get(conversion_key, None)
-            if entry_value is not None:
-                entry[conversion_key] = conversion_func(entry_value)
-        return entry
-    return json.load(open(filename), object_hook=json_parser)
-
-
 class GarminWeightData():
 
-    def __init__(self, input_file, input_dir, latest, english_units, debug):
+    def __init__(self, input_file, input_dir, latest, english_units, debug, validator=None):
         self.english_units = english_units
         self.debug = debug
+        self.validator = validator if validator is not None else FileValidator()
         logger.info("Debug: %s English units: %s", str(debug), str(english_units))
         if input_file:
             self.file_names = FileProcessor.FileProcessor.match_file(input_file, 'weight_.*\.json')
@@ -42,28 +36,36 @@ class GarminWeightData():
 
     def process_files(self, db_params_dict):
         garmindb = GarminDB.GarminDB(db_params_dict)
-        for file_name in self.file_names:
-            json_data = parse_json_file(file_name, {'timestamp' : dateutil.parser.parse})
-            for sample in json_data:
-                timestamp_ms = sample.get('date', None)
-                if timestamp_ms is None:
-                    break
-                weight = sample['weight'] / 1000.0
-                if self.english_units:
-                    weight *= 2.204623
-                point = {
-                    'timestamp' : Fit.Conversions.epoch_ms_to_dt(timestamp_ms),
-                    'weight' : weight
-                }
-                GarminDB.Weight.create_or_update_not_none(garmindb, point)
-            logger.info("DB updated with %d weight entries", len(json_data))
+        write_buffer = HealthDB.WriteBuffer(garmindb)
+        try:
+            for file_name in self.file_names:
+                with self.validator.importing(file_name):
+                    entries = 0
+                    for sample in JsonFileProcessor(file_name, {'date' : Fit.Conversions.epoch_ms_to_dt}).entries():
+                        timestamp = sample.get('date', None)
+                        if timestamp is None:
+                            break
+                        weight = sample['weight'] / 1000.0
+                        if self.english_units:
+                            weight *= 2.204623
+                        point = {
+                            'timestamp' : timestamp,
+                            'weight' : weight
+                        }
+                        write_buffer.create_or_update_not_none(GarminDB.Weight, point)
+                        entries += 1
+                    logger.info("Read %d weight entries from %s", entries, file_name)
+        finally:
+            write_buffer.close()
 
 
 class GarminFitData():
 
-    def __init__(self, input_file, input_dir, latest, english_units, debug):
+    def __init__(self, input_file, input_dir, latest, english_units, debug, fit_cache_dir=None, validator=None):
         self.english_units = english_units
         self.debug = debug
+        self.fit_cache_dir = fit_cache_dir
+        self.validator = validator if validator is not None else FileValidator()
         logger.info("Debug: %s English units: %s", str(debug), str(english_units))
         if input_file:
             self.file_names = FileProcessor.FileProcessor.match_file(input_file, '.*\.fit')
@@ -74,9 +76,13 @@ class GarminFitData():
         return len(self.file_names)
 
     def process_files(self, db_params_dict):
-        fp = FitFileProcessor.FitFileProcessor(db_params_dict, self.english_units, self.debug)
-        for file_name in self.file_names:
-            fp.write_file(Fit.File(file_name, self.english_units))
+        fp = FitFileProcessor.FitFileProcessor(db_params_dict, self.english_units, self.debug, fit_cache_dir=self.fit_cache_dir)
+        try:
+            for file_name in self.file_names:
+                with self.validator.importing(file_name):
+                    fp.import_file(file_name)
+        finally:
+            fp.close()
 
 
 class SleepActivityLevels(enum.Enum):
@@ -93,10 +99,28 @@ class RemSleepActivityLevels(enum.Enum):
     awake = 3.0
 
 
+def decode_sleep_file(file_name):
+    # module level so it can be run in a multiprocessing pool, returns the file name, the decoded night, and the error if it failed
+    try:
+        return (file_name, GarminSleepData.decode_file(file_name), None)
+    except Exception as e:
+        return (file_name, None, str(e))
+
+
 class GarminSleepData():
 
-    def __init__(self, input_file, input_dir, latest, debug):
+    conversions = {
+        'dailySleepDTO.calendarDate'            : HealthDB.DateParser(),
+        'dailySleepDTO.sleepStartTimestampGMT'  : Fit.Conversions.epoch_ms_to_dt,
+        'dailySleepDTO.sleepEndTimestampGMT'    : Fit.Conversions.epoch_ms_to_dt,
+        'sleepLevels.*.startGMT'                : HealthDB.DateParser(),
+        'sleepLevels.*.endGMT'                  : HealthDB.DateParser()
+    }
+
+    def __init__(self, input_file, input_dir, latest, debug, processes=1, validator=None):
         self.debug = debug
+        self.processes = processes
+        self.validator = validator if validator is not None else FileValidator()
         logger.info("Debug: %s" % str(debug))
         if input_file:
             self.file_names = FileProcessor.FileProcessor.match_file(input_file, 'sleep_.*\.json')
@@ -106,68 +130,68 @@ class GarminSleepData():
     def file_count(self):
         return len(self.file_names)
 
+    @classmethod
+    def decode_file(cls, file_name):
+        # returns the night's sleep row and its (timestamp, event, duration) events, None if the file has no sleep data
+        json_data = JsonFileProcessor(file_name, cls.conversions).document()
+        daily_sleep = json_data.get('dailySleepDTO', None)
+        if daily_sleep is None:
+            return None
+        date = daily_sleep.get('calendarDate', None)
+        if date is None:
+            return None
+        day_data = {
+            'day' : date.date(),
+            'start' : daily_sleep.get('sleepStartTimestampGMT', None),
+            'end' : daily_sleep.get('sleepEndTimestampGMT', None),
+            'total_sleep' : daily_sleep.get('sleepTimeSeconds', None),
+            'deep_sleep' : daily_sleep.get('deepSleepSeconds', None),
+            'light_sleep' : daily_sleep.get('lightSleepSeconds', None),
+            'rem_sleep' : daily_sleep.get('remSleepSeconds', None),
+            'awake' : daily_sleep.get('awakeSleepSeconds', None)
+        }
+        if json_data.get('remSleepData', None):
+            activity_levels = RemSleepActivityLevels
+        else:
+            activity_levels = SleepActivityLevels
+        # one event per timestamp, the last one wins
+        events = {}
+        for sleep_level in json_data.get('sleepLevels', None) or []:
+            start = sleep_level['startGMT']
+            events[start] = (start, activity_levels(sleep_level['activityLevel']).name, sleep_level['endGMT'] - start)
+        return (day_data, sorted(events.values()))
+
     def process_files(self, db_params_dict):
         garmindb = GarminDB.GarminDB(db_params_dict)
-        for file_name in self.file_names:
-            conversions = {
-                'calendarDate'              : dateutil.parser.parse,
-                'sleepTimeSeconds'          : Fit.Conversions.secs_to_dt_time,
-                'sleepStartTimestampGMT'    : Fit.Conversions.epoch_ms_to_dt,
-                'sleepEndTimestampGMT'      : Fit.Conversions.epoch_ms_to_dt,
-                'deepSleepSeconds'          : Fit.Conversions.secs_to_dt_time,
-                'lightSleepSeconds'         : Fit.Conversions.secs_to_dt_time,
-                'remSleepSeconds'           : Fit.Conversions.secs_to_dt_time,
-                'awakeSleepSeconds'         : Fit.Conversions.secs_to_dt_time,
-                'startGMT'                  : dateutil.parser.parse,
-                'endGMT'                    : dateutil.parser.parse
-            }
-            json_data = parse_json_file(file_name, conversions)
-            daily_sleep = json_data.get('dailySleepDTO', None)
-            if daily_sleep is None:
-                continue
-            date = daily_sleep.get('calendarDate', None)
-            if date is None:
-                continue
-            logger.debug("Importing %s" % file_name)
-            day = date.date()
-            day_data = {
-                'day' : day,
-                'start' : daily_sleep.get('sleepStartTimestampGMT', None),
-                'end' : daily_sleep.get('sleepEndTimestampGMT', None),
-                'total_sleep' : daily_sleep.get('sleepTimeSeconds', None),
-                'deep_sleep' : daily_sleep.get('deepSleepSeconds', None),
-                'light_sleep' : daily_sleep.get('lightSleepSeconds', None),
-                'rem_sleep' : daily_sleep.get('remSleepSeconds', None),
-                'awake' : daily_sleep.get('awakeSleepSeconds', None)
-            }
-            GarminDB.Sleep.create_or_update_not_none(garmindb, day_data)
-            sleep_levels = json_data.get('sleepLevels', None)
-            if sleep_levels is None:
-                continue
-            for sleep_level in sleep_levels:
-                start = sleep_level['startGMT']
-                end = sleep_level['endGMT']
-                if json_data.get('remSleepData', None):
-                    event = RemSleepActivityLevels(sleep_level['activityLevel'])
-                    logger.info("Importing %s (%s) with REM data", file_name, day_data['day'])
-                else:
-                    logger.info("Importing %s (%s) without REM data", file_name, day_data['day'])
-                    event = SleepActivityLevels(sleep_level['activityLevel'])
-                duration = (datetime.datetime.min + (end - start)).time()
-                level_data = {
-                    'timestamp' : start,
-                    'event' : event.name,
-                    'duration' : duration
-                }
-                GarminDB.SleepEvents.create_or_update_not_none(garmindb, level_data)
-            logger.info("DB updated %s with %d sleep level entries", str(day), len(sleep_levels))
-        logger.info("DB updated with %d sleep entries", self.file_count())
+        if self.processes > 1:
+            pool = multiprocessing.Pool(self.processes)
+            nights = pool.imap(decode_sleep_file, self.file_names, 16)
+        else:
+            pool = None
+            nights = itertools.imap(decode_sleep_file, self.file_names)
+        try:
+            imported = 0
+            for (file_name, night, error) in nights:
+                if error is not None:
+                    self.validator.quarantine(file_name, "import failed: %s" % error)
+                elif night is not None:
+                    (day_data, events) = night
+                    with self.validator.importing(file_name):
+                        GarminDB.Sleep.replace_night(garmindb, day_data, events)
+                        logger.debug("DB updated %s with %d sleep level entries", str(day_data['day']), len(events))
+                        imported += 1
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
+        logger.info("DB updated with %d of %d sleep files", imported, self.file_count())
 
 
 class GarminRhrData():
 
-    def __init__(self, input_file, input_dir, latest, debug):
+    def __init__(self, input_file, input_dir, latest, debug, validator=None):
         self.debug = debug
+        self.validator = validator if validator is not None else FileValidator()
         logger.info("Debug: %s" % str(debug))
         if input_file:
             self.file_names = FileProcessor.FileProcessor.match_file(input_file, 'rhr_.*\.json')
@@ -179,21 +203,31 @@ class GarminRhrData():
 
     def process_files(self, db_params_dict):
         garmindb = GarminDB.GarminDB(db_params_dict)
-        for file_name in self.file_names:
-            json_data = parse_json_file(file_name, {'calendarDate' : dateutil.parser.parse})
-            for sample in json_data:
-                data = {
-                    'day' : sample['calendarDate'].date(),
-                    'resting_heart_rate' : sample['value']
-                }
-                GarminDB.RestingHeartRate.create_or_update_not_none(garmindb, data)
-            logger.info("DB updated with %d rhr entries", len(json_data))
+        conversions = {'calendarDate' : HealthDB.DateParser()}
+        write_buffer = HealthDB.WriteBuffer(garmindb)
+        try:
+            for file_name in self.file_names:
+                with self.validator.importing(file_name):
+                    entries = 0
+                    for sample in JsonFileProcessor(file_name, conversions).entries():
+                        data = {
+                            'day' : sample['calendarDate'].date(),
+                            'resting_heart_rate' : sample['value']
+                        }
+                        write_buffer.create_or_update_not_none(GarminDB.RestingHeartRate, data)
+                        entries += 1
+                    logger.info("Read %d rhr entries from %s", entries, file_name)
+        finally:
+            write_buffer.close()
 
 
 def usage(program):
     print '%s [-s <sqlite db path> | -m <user,password,host>] [-i <fit_inputfile> | -d <fit_input_dir>] ...' % program
     print '    --trace : turn on debug tracing'
     print '    --english : units - use feet, lbs, etc'
+    print '    --processes <n> : decode sleep files in n processes'
+    print '    --fit_cache_dir <dir> : keep the decoded FIT messages in dir and reuse them when the same files are imported again'
+    print '    --journal_dir <dir> : journal the rows written to the DBs in dir, so the DBs can be rebuilt with replay_journal.py'
     print '    '
     sys.exit()
 
@@ -208,13 +242,17 @@ def main(argv):
     rhr_input_file = None
     sleep_input_dir = None
     sleep_input_file = None
+    processes = 1
+    fit_cache_dir = None
+    journal_dir = None
     latest = False
     db_params_dict = {}
 
     try:
         opts, args = getopt.getopt(argv,"f:F:elm:r:R:s:t:w:W:",
             ["trace=", "english", "fit_input_dir=", "fit_input_file=", "latest", "mysql=", "sqlite=",
-             "rhr_input_dir=", "rhr_input_file=", "sleep_input_dir=", "sleep_input_file=", "weight_input_dir=", "weight_input_file="])
+             "rhr_input_dir=", "rhr_input_file=", "sleep_input_dir=", "sleep_input_file=", "weight_input_dir=", "weight_input_file=",
+             "processes=", "fit_cache_dir=", "journal_dir="])
     except getopt.GetoptError:
         usage(sys.argv[0])
 
@@ -245,6 +283,15 @@ def main(argv):
         elif opt in ("--sleep_input_file"):
             logging.debug("Sleep input file: %s" % arg)
             sleep_input_file = arg
+        elif opt == "--processes":
+            logging.debug("Processes: %s" % arg)
+            processes = int(arg)
+        elif opt == "--fit_cache_dir":
+            logging.debug("FIT cache dir: %s" % arg)
+            fit_cache_dir = arg
+        elif opt == "--journal_dir":
+            logging.debug("Journal dir: %s" % arg)
+            journal_dir = arg
         elif opt in ("-w", "--weight_input_dir"):
             logging.debug("Weight input dir: %s" % arg)
             weight_input_dir = arg
@@ -276,25 +323,29 @@ def main(argv):
         print "Missing or incorrect arguments: db params"
         usage(sys.argv[0])
 
-    if weight_input_file or weight_input_dir:
-        gwd = GarminWeightData(weight_input_file, weight_input_dir, latest, english_units, debug)
-        if gwd.file_count() > 0:
-            gwd.process_files(db_params_dict)
-
-    if fit_input_file or fit_input_dir:
-        gfd = GarminFitData(fit_input_file, fit_input_dir, latest, english_units, debug)
-        if gfd.file_count() > 0:
-            gfd.process_files(db_params_dict)
-
-    if sleep_input_file or sleep_input_dir:
-        gsd = GarminSleepData(sleep_input_file, sleep_input_dir, latest, debug)
-        if gsd.file_count() > 0:
-            gsd.process_files(db_params_dict)
-
-    if rhr_input_file or rhr_input_dir:
-        grhrd = GarminRhrData(rhr_input_file, rhr_input_dir, latest, debug)
-        if grhrd.file_count() > 0:
-            grhrd.process_files(db_params_dict)
+    if journal_dir:
+        HealthDB.DB.journal = HealthDB.Journal(journal_dir)
+    try:
+        # all of the files are checked up front, the bad ones are skipped
+        validator = FileValidator(GarminDB.GarminDB(db_params_dict), GarminDB.Quarantine)
+        file_sets = []
+        if weight_input_file or weight_input_dir:
+            file_sets.append(GarminWeightData(weight_input_file, weight_input_dir, latest, english_units, debug, validator))
+        if fit_input_file or fit_input_dir:
+            file_sets.append(GarminFitData(fit_input_file, fit_input_dir, latest, english_units, debug, fit_cache_dir, validator))
+        if sleep_input_file or sleep_input_dir:
+            file_sets.append(GarminSleepData(sleep_input_file, sleep_input_dir, latest, debug, processes, validator))
+        if rhr_input_file or rhr_input_dir:
+            file_sets.append(GarminRhrData(rhr_input_file, rhr_input_dir, latest, debug, validator))
+        validator.validate(*file_sets)
+
+        for file_set in file_sets:
+            if file_set.file_count() > 0:
+                file_set.process_files(db_params_dict)
+        validator.log_summary()
+    finally:
+        if HealthDB.DB.journal is not None:
+            HealthDB.DB.journal.close()
 
 
 if __name__ == "__main__":
@@ -4,14 +4,20 @@
 # copyright Tom Goetz
 #
 
-import os, sys, getopt, re, string, logging, datetime, traceback, json, tcxparser, dateutil.parser
+import os, sys, getopt, re, string, logging, datetime, traceback, json
 
 import Fit
 import FileProcessor
 from FitFileProcessor import FitFileProcessor
+from TcxFileProcessor import TcxFileProcessor
+from GpxFileProcessor import GpxFileProcessor
 from GarminJsonData import GarminJsonData
+from ActivityAssembler import ActivityAssembler
+from FileValidator import FileValidator
 import GarminDB
+import HealthDB
 import GarminConnectEnums
+from HealthDB import DateParser
 
 
 root_logger = logging.getLogger()
@@ -26,9 +32,11 @@ def pace_to_time(pace):
 
 class GarminFitData():
 
-    def __init__(self, input_file, input_dir, latest, english_units, debug):
+    def __init__(self, input_file, input_dir, latest, english_units, debug, fit_cache_dir=None, validator=None):
         self.english_units = english_units
         self.debug = debug
+        self.fit_cache_dir = fit_cache_dir
+        self.validator = validator if validator is not None else FileValidator()
         logger.info("Debug: %s English units: %s", str(debug), str(english_units))
         if input_file:
             self.file_names = FileProcessor.FileProcessor.match_file(input_file, '.*\.fit')
@@ -38,21 +46,22 @@ class GarminFitData():
     def file_count(self):
         return len(self.file_names)
 
-    def process_files(self, db_params_dict):
-        fp = FitFileProcessor(db_params_dict, self.english_units, self.debug)
-        for file_name in self.file_names:
-            try:
-                fp.write_file(Fit.File(file_name, self.english_units))
-            except Exception as e:
-                logger.error("Failed to parse %s: %s", file_name, str(e))
-                raise
+    def process_files(self, db_params_dict, assembler=None):
+        fp = FitFileProcessor(db_params_dict, self.english_units, self.debug, assembler, self.fit_cache_dir)
+        try:
+            for file_name in self.file_names:
+                with self.validator.importing(file_name, fp.discard_file):
+                    fp.import_file(file_name)
+        finally:
+            fp.close()
 
 
 class GarminTcxData():
 
-    def __init__(self, input_file, input_dir, latest, english_units, debug):
+    def __init__(self, input_file, input_dir, latest, english_units, debug, validator=None):
         self.english_units = english_units
         self.debug = debug
+        self.validator = validator if validator is not None else FileValidator()
         logger.info("Debug: %s English units: %s", str(debug), str(english_units))
         if input_file:
             self.file_names = FileProcessor.FileProcessor.match_file(input_file, '.*\.tcx')
@@ -62,74 +71,63 @@ class GarminTcxData():
     def file_count(self):
         return len(self.file_names)
 
-    def process_files(self, db_params_dict):
-        garmin_db = GarminDB.GarminDB(db_params_dict, self.debug - 1)
-        garmin_act_db = GarminDB.ActivitiesDB(db_params_dict, self.debug)
-        for file_name in self.file_names:
-            logger.info("Processing file: " + file_name)
-            tcx = tcxparser.TCXParser(file_name)
-            end_time = dateutil.parser.parse(tcx.completed_at, ignoretz=True)
-            start_time = dateutil.parser.parse(tcx.started_at, ignoretz=True)
-            manufacturer = 'Unknown'
-            product = tcx.creator
-            if product is not None:
-                match = re.search('Microsoft', product)
-                if match:
-                    manufacturer = Fit.FieldEnums.Manufacturer.Microsoft
-            serial_number = tcx.creator_version
-            if serial_number is None or serial_number == 0:
-                serial_number = GarminDB.Device.unknown_device_serial_number
-            device = {
-                'serial_number'     : serial_number,
-                'timestamp'         : start_time,
-                'manufacturer'      : manufacturer,
-                'product'           : product,
-                'hardware_version'  : None,
-            }
-            GarminDB.Device.create_or_update_not_none(garmin_db, device)
-            file = {
-                'name'          : file_name,
-                'type'          : Fit.FieldEnums.FileType.tcx,
-                'serial_number' : serial_number,
-            }
-            GarminDB.File.find_or_create(garmin_db, file)
-            activity_id = GarminDB.File.get(garmin_db, file_name)
-            if self.english_units and tcx.distance_units == 'meters':
-                distance = Fit.Conversions.meters_to_miles(tcx.distance)
-                ascent = Fit.Conversions.meters_to_feet(tcx.ascent)
-                descent = Fit.Conversions.meters_to_feet(tcx.descent)
-            else:
-                distance = tcx.distance / 1000.0
-                ascent = tcx.ascent / 1000.0
-                descent = tcx.descent / 1000.0
-            activity = {
-                'activity_id'               : activity_id,
-                'start_time'                : start_time,
-                'stop_time'                 : end_time,
-                'laps'                      : len(tcx.activity.Lap),
-                # 'sport'                     : tcx.activity_type,
-                'start_lat'                 : tcx.start_latitude,
-                'start_long'                : tcx.start_longitude,
-                'stop_lat'                  : tcx.end_latitude,
-                'stop_long'                 : tcx.end_longitude,
-                'distance'                  : distance,
-                'avg_hr'                    : tcx.hr_avg,
-                'max_hr'                    : tcx.hr_max,
-                'calories'                  : tcx.calories,
-                'max_cadence'               : tcx.cadence_max,
-                'avg_cadence'               : tcx.cadence_avg,
-                #'ascent'                    : ascent,
-                #'descent'                   : descent
-            }
-            activity_not_zero = {key : value for (key,value) in activity.iteritems() if value}
-            GarminDB.Activities.create_or_update_not_none(garmin_act_db, activity_not_zero)
+    def process_files(self, db_params_dict, assembler=None):
+        tp = TcxFileProcessor(db_params_dict, self.english_units, self.debug, assembler)
+        try:
+            for file_name in self.file_names:
+                with self.validator.importing(file_name, tp.discard_file):
+                    tp.import_file(file_name)
+        finally:
+            tp.close()
+
+
+class GarminGpxData():
+
+    def __init__(self, input_file, input_dir, latest, english_units, debug, validator=None):
+        self.english_units = english_units
+        self.debug = debug
+        self.validator = validator if validator is not None else FileValidator()
+        logger.info("Debug: %s English units: %s", str(debug), str(english_units))
+        if input_file:
+            self.file_names = FileProcessor.FileProcessor.match_file(input_file, '.*\.gpx')
+        if input_dir:
+            self.file_names = FileProcessor.FileProcessor.dir_to_files(input_dir, '.*\.gpx', latest)
 
+    def file_count(self):
+        return len(self.file_names)
+
+    def process_files(self, db_params_dict, assembler=None):
+        gp = GpxFileProcessor(db_params_dict, self.english_units, self.debug, assembler)
+        try:
+            for file_name in self.file_names:
+                with self.validator.importing(file_name, gp.discard_file):
+                    gp.import_file(file_name)
+        finally:
+            gp.close()
 
-class GarminJsonSummaryData(GarminJsonData):
 
-    def __init__(self, db_params_dict, input_file, input_dir, latest, english_units, debug):
-        GarminJsonData.__init__(self, input_file, input_dir, 'activity_\\d*\.json', latest, english_units, debug)
-        self.garmin_act_db = GarminDB.ActivitiesDB(db_params_dict, self.debug - 1)
+class GarminJsonActivityData(GarminJsonData):
+
+    def __init__(self, db_params_dict, input_file, input_dir, file_regex, latest, english_units, debug, assembler, validator):
+        GarminJsonData.__init__(self, input_file, input_dir, file_regex, latest, english_units, debug, validator)
+        # the activity rows are written by the caller if it passed in the assembler
+        self.own_assembler = assembler is None
+        self.assembler = ActivityAssembler(db_params_dict, debug) if self.own_assembler else assembler
+
+    def process_files(self):
+        try:
+            GarminJsonData.process_files(self)
+        finally:
+            if self.own_assembler:
+                self.assembler.write()
+
+
+class GarminJsonSummaryData(GarminJsonActivityData):
+
+    def __init__(self, db_params_dict, input_file, input_dir, latest, english_units, debug, assembler=None, validator=None):
+        GarminJsonActivityData.__init__(self, db_params_dict, input_file, input_dir, 'activity_\\d*\.json', latest, english_units, debug, assembler,
+            validator)
+        self.start_time_parser = DateParser(ignoretz=True)
 
     def process_running(self, activity_id, activity_summary):
         avg_vertical_oscillation = Fit.Conversions.centimeters_to_meters(self.get_garmin_json_data(activity_summary, 'avgVerticalOscillation', float))
@@ -148,7 +146,7 @@ class GarminJsonSummaryData(GarminJsonData):
                 'avg_ground_contact_time'   : Fit.Conversions.ms_to_dt_time(self.get_garmin_json_data(activity_summary, 'avgGroundContactTime', float)),
                 'vo2_max'                   : self.get_garmin_json_data(activity_summary, 'vO2MaxValue', float),
         }
-        GarminDB.RunActivities.create_or_update_not_none(self.garmin_act_db, run)
+        self.assembler.add(GarminDB.RunActivities, run)
 
     def process_treadmill_running(self, activity_id, activity_summary):
         return self.process_running(activity_id, activity_summary)
@@ -159,7 +157,7 @@ class GarminJsonSummaryData(GarminJsonData):
                 'steps'                     : self.get_garmin_json_data(activity_summary, 'steps', float),
                 'vo2_max'                   : self.get_garmin_json_data(activity_summary, 'vO2MaxValue', float),
         }
-        GarminDB.WalkActivities.create_or_update_not_none(self.garmin_act_db, walk)
+        self.assembler.add(GarminDB.WalkActivities, walk)
 
     def process_hiking(self, activity_id, activity_summary):
         return self.process_walking(activity_id, activity_summary)
@@ -170,7 +168,7 @@ class GarminJsonSummaryData(GarminJsonData):
                 'avg_cadence'               : self.get_garmin_json_data(activity_summary, 'avgStrokeCadence', float),
                 'max_cadence'               : self.get_garmin_json_data(activity_summary, 'maxStrokeCadence', float),
         }
-        GarminDB.Activities.create_or_update_not_none(self.garmin_act_db, activity)
+        self.assembler.add(GarminDB.Activities, activity)
         avg_stroke_distance = self.get_garmin_json_data(activity_summary, 'avgStrokeDistance', float)
         if self.english_units:
             avg_stroke_distance = Fit.Conversions.meters_to_feet(avg_stroke_distance)
@@ -179,7 +177,7 @@ class GarminJsonSummaryData(GarminJsonData):
                 'strokes'                   : self.get_garmin_json_data(activity_summary, 'strokes', float),
                 'avg_stroke_distance'       : avg_stroke_distance,
         }
-        GarminDB.PaddleActivities.create_or_update_not_none(self.garmin_act_db, paddle)
+        self.assembler.add(GarminDB.PaddleActivities, paddle)
 
     def process_cycling(self, activity_id, activity_summary):
         activity = {
@@ -187,13 +185,13 @@ class GarminJsonSummaryData(GarminJsonData):
                 'avg_cadence'               : self.get_garmin_json_data(activity_summary, 'averageBikingCadenceInRevPerMinute', float),
                 'max_cadence'               : self.get_garmin_json_data(activity_summary, 'maxBikingCadenceInRevPerMinute', float),
         }
-        GarminDB.Activities.create_or_update_not_none(self.garmin_act_db, activity)
+        self.assembler.add(GarminDB.Activities, activity)
         ride = {
                 'activity_id'               : activity_id,
                 'strokes'                   : self.get_garmin_json_data(activity_summary, 'strokes', float),
                 'vo2_max'                   : self.get_garmin_json_data(activity_summary, 'vO2MaxValue', float),
         }
-        GarminDB.CycleActivities.create_or_update_not_none(self.garmin_act_db, ride)
+        self.assembler.add(GarminDB.CycleActivities, ride)
 
     def process_mountain_biking(self, activity_id, activity_summary):
         return self.process_cycling(activity_id, activity_summary)
@@ -205,12 +203,12 @@ class GarminJsonSummaryData(GarminJsonData):
                     'avg_cadence'               : self.get_garmin_json_data(activity_summary, 'averageRunningCadenceInStepsPerMinute', float),
                     'max_cadence'               : self.get_garmin_json_data(activity_summary, 'maxRunningCadenceInStepsPerMinute', float),
             }
-            GarminDB.Activities.create_or_update_not_none(self.garmin_act_db, activity)
+            self.assembler.add(GarminDB.Activities, activity)
             workout = {
                     'activity_id'               : activity_id,
                     'steps'                     : self.get_garmin_json_data(activity_summary, 'steps', float),
             }
-            GarminDB.EllipticalActivities.create_or_update_not_none(self.garmin_act_db, workout)
+            self.assembler.add(GarminDB.EllipticalActivities, workout)
 
     def process_json(self, json_data):
         activity_id = json_data['activityId']
@@ -250,9 +248,9 @@ class GarminJsonSummaryData(GarminJsonData):
             'type'                      : event.name,
             'sport'                     : sport.name,
             'sub_sport'                 : sub_sport.name,
-            'start_time'                : dateutil.parser.parse(self.get_garmin_json_data(json_data, 'startTimeLocal'), ignoretz=True),
-            'elapsed_time'              : Fit.Conversions.secs_to_dt_time(self.get_garmin_json_data(json_data, 'elapsedDuration', int)),
-            'moving_time'               : Fit.Conversions.secs_to_dt_time(self.get_garmin_json_data(json_data, 'movingDuration', int)),
+            'start_time'                : self.start_time_parser.parse(self.get_garmin_json_data(json_data, 'startTimeLocal')),
+            'elapsed_time'              : self.get_garmin_json_data(json_data, 'elapsedDuration', int),
+            'moving_time'               : self.get_garmin_json_data(json_data, 'movingDuration', int),
             'start_lat'                 : self.get_garmin_json_data(json_data, 'startLatitude', float),
             'start_long'                : self.get_garmin_json_data(json_data, 'startLongitude', float),
             'stop_lat'                  : self.get_garmin_json_data(json_data, 'endLatitude', float),
@@ -271,7 +269,7 @@ class GarminJsonSummaryData(GarminJsonData):
             'training_effect'           : self.get_garmin_json_data(json_data, 'aerobicTrainingEffect', float),
             'anaerobic_training_effect' : self.get_garmin_json_data(json_data, 'anaerobicTrainingEffect', float),
         }
-        GarminDB.Activities.create_or_update_not_none(self.garmin_act_db, activity)
+        self.assembler.add(GarminDB.Activities, activity)
         try:
             function = getattr(self, 'process_' + sub_sport.name)
             function(activity_id, json_data)
@@ -279,11 +277,11 @@ class GarminJsonSummaryData(GarminJsonData):
             logger.info("No sport handler for type %s from %s", sub_sport, activity_id)
 
 
-class GarminJsonDetailsData(GarminJsonData):
+class GarminJsonDetailsData(GarminJsonActivityData):
 
-    def __init__(self, db_params_dict, input_file, input_dir, latest, english_units, debug):
-        GarminJsonData.__init__(self, input_file, input_dir, 'activity_details_\\d*\.json', latest, english_units, debug)
-        self.garmin_act_db = GarminDB.ActivitiesDB(db_params_dict, self.debug - 1)
+    def __init__(self, db_params_dict, input_file, input_dir, latest, english_units, debug, assembler=None, validator=None):
+        GarminJsonActivityData.__init__(self, db_params_dict, input_file, input_dir, 'activity_details_\\d*\.json', latest, english_units, debug,
+            assembler, validator)
 
     def process_running(self, activity_id, json_data):
         summary_dto = json_data['summaryDTO']
@@ -294,7 +292,7 @@ class GarminJsonDetailsData(GarminJsonData):
             'avg_moving_pace'           : Fit.Conversions.speed_to_pace(avg_moving_speed),
         }
         logger.info("process_running for %d: %s", activity_id, repr(run))
-        GarminDB.RunActivities.create_or_update_not_none(self.garmin_act_db, run)
+        self.assembler.add(GarminDB.RunActivities, run)
 
 
     def process_json(self, json_data):
@@ -315,7 +313,7 @@ class GarminJsonDetailsData(GarminJsonData):
             'course_id'                 : self.get_garmin_json_data(metadata_dto, 'associatedCourseId', int),
             'avg_temperature'           : avg_temperature,
         }
-        GarminDB.Activities.create_or_update_not_none(self.garmin_act_db, activity)
+        self.assembler.add(GarminDB.Activities, activity)
         try:
             function = getattr(self, 'process_' + sub_sport.name)
             function(activity_id, json_data)
@@ -327,6 +325,8 @@ def usage(program):
     print '%s [-s <sqlite db path> | -m <user,password,host>] [-i <inputfile> | -d <input_dir>] ...' % program
     print '    --trace : turn on debug tracing'
     print '    --english : units - use feet, lbs, etc'
+    print '    --fit_cache_dir <dir> : keep the decoded FIT messages in dir and reuse them when the same files are imported again'
+    print '    --journal_dir <dir> : journal the rows written to the DBs in dir, so the DBs can be rebuilt with replay_journal.py'
     print '    '
     sys.exit()
 
@@ -336,10 +336,12 @@ def main(argv):
     input_dir = None
     input_file = None
     latest = False
+    fit_cache_dir = None
+    journal_dir = None
     db_params_dict = {}
 
     try:
-        opts, args = getopt.getopt(argv,"d:eilm::s:t:", ["trace=", "english", "latest", "input_dir=", "input_file=", "mysql=", "sqlite="])
+        opts, args = getopt.getopt(argv,"d:eilm::s:t:", ["trace=", "english", "fit_cache_dir=", "journal_dir=", "latest", "input_dir=", "input_file=", "mysql=", "sqlite="])
     except getopt.GetoptError:
         usage(sys.argv[0])
 
@@ -357,6 +359,12 @@ def main(argv):
             input_file = arg
         elif opt in ("-l", "--latest"):
             latest = True
+        elif opt == "--fit_cache_dir":
+            logging.debug("FIT cache dir: %s" % arg)
+            fit_cache_dir = arg
+        elif opt == "--journal_dir":
+            logging.debug("Journal dir: %s" % arg)
+            journal_dir = arg
         elif opt in ("-s", "--sqlite"):
             logging.debug("Sqlite DB path: %s" % arg)
             db_params_dict['db_type'] = 'sqlite'
@@ -378,21 +386,40 @@ def main(argv):
         print "Missing arguments:"
         usage(sys.argv[0])
 
-    gjsd = GarminJsonSummaryData(db_params_dict, input_file, input_dir, latest, english_units, debug)
-    if gjsd.file_count() > 0:
-        gjsd.process_files()
-
-    gdjd = GarminJsonDetailsData(db_params_dict, input_file, input_dir, latest, english_units, debug)
-    if gdjd.file_count() > 0:
-        gdjd.process_files()
-
-    gtd = GarminTcxData(input_file, input_dir, latest, english_units, debug)
-    if gtd.file_count() > 0:
-        gtd.process_files(db_params_dict)
-
-    gfd = GarminFitData(input_file, input_dir, latest, english_units, debug)
-    if gfd.file_count() > 0:
-        gfd.process_files(db_params_dict)
+    if journal_dir:
+        HealthDB.DB.journal = HealthDB.Journal(journal_dir)
+    # the activity rows from all of the files are merged and written once at the end
+    assembler = ActivityAssembler(db_params_dict, debug)
+    try:
+        # all of the files are checked up front, the bad ones are skipped
+        validator = FileValidator(GarminDB.GarminDB(db_params_dict), GarminDB.Quarantine)
+
+        gjsd = GarminJsonSummaryData(db_params_dict, input_file, input_dir, latest, english_units, debug, assembler, validator)
+        gdjd = GarminJsonDetailsData(db_params_dict, input_file, input_dir, latest, english_units, debug, assembler, validator)
+        gtd = GarminTcxData(input_file, input_dir, latest, english_units, debug, validator)
+        ggd = GarminGpxData(input_file, input_dir, latest, english_units, debug, validator)
+        gfd = GarminFitData(input_file, input_dir, latest, english_units, debug, fit_cache_dir, validator)
+        validator.validate(gjsd, gdjd, gtd, ggd, gfd)
+
+        if gjsd.file_count() > 0:
+            gjsd.process_files()
+        if gdjd.file_count() > 0:
+            gdjd.process_files()
+        if gtd.file_count() > 0:
+            gtd.process_files(db_params_dict, assembler)
+        if ggd.file_count() > 0:
+            ggd.process_files(db_params_dict, assembler)
+        if gfd.file_count() > 0:
+            gfd.process_files(db_params_dict, assembler)
+
+        validator.log_summary()
+    finally:
+        try:
+            # the laps and records of the imported files are already written, so are their activity rows if the import ends early
+            assembler.write()
+        finally:
+            if HealthDB.DB.journal is not None:
+                HealthDB.DB.journal.close()
 
 
 if __name__ == "__main__":
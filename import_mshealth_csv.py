@@ -6,9 +6,11 @@
 
 import os, sys, getopt, re, string, logging, datetime, time, traceback
 
+import HealthDB
 from HealthDB import CsvImporter
 import MSHealthDB
 import FileProcessor
+from FileValidator import FileValidator
 
 
 logger = logging.getLogger(__file__)
@@ -55,10 +57,13 @@ class MSHealthData():
         'Guided_Workout_Total_Calories': ('guided_workout_calories', CsvImporter.map_integer),
         'Guided_Workout_Total_Seconds': ('guided_workout_secs', CsvImporter.map_integer),
     }
+    # checked by FileValidator
+    required_columns = ['Date']
 
-    def __init__(self, input_file, input_dir, db_params_dict, english_units, debug):
+    def __init__(self, input_file, input_dir, db_params_dict, english_units, debug, validator=None):
         self.english_units = english_units
         self.mshealthdb = MSHealthDB.MSHealthDB(db_params_dict, debug)
+        self.validator = validator if validator is not None else FileValidator()
         if input_file:
             self.file_names = FileProcessor.FileProcessor.match_file(input_file, 'Daily_Summary_.*.csv')
         if input_dir:
@@ -67,21 +72,27 @@ class MSHealthData():
     def file_count(self):
         return len(self.file_names)
 
-    def write_entry(self, db_entry):
-        MSHealthDB.DaysSummary.find_or_create(self.mshealthdb, db_entry)
+    def write_entries(self, db_entries):
+        created = MSHealthDB.DaysSummary.find_or_create_all(self.mshealthdb, db_entries)
+        logger.info("Wrote %d new of %d entries", created, len(db_entries))
 
     def process_files(self):
         for file_name in self.file_names:
             logger.info("Processing file: " + file_name)
-            csvimporter = CsvImporter(file_name, self.cols_map, self.write_entry)
-            csvimporter.process_file(self.english_units)
+            with self.validator.importing(file_name):
+                csvimporter = CsvImporter(file_name, self.cols_map, self.write_entries)
+                csvimporter.process_file(self.english_units)
 
 
 class MSVaultData():
 
-    def __init__(self, input_file, input_dir, db_params_dict, english_units, debug):
+    # checked by FileValidator
+    required_columns = ['Date', 'Weight']
+
+    def __init__(self, input_file, input_dir, db_params_dict, english_units, debug, validator=None):
         self.english_units = english_units
         self.mshealthdb = MSHealthDB.MSHealthDB(db_params_dict, debug)
+        self.validator = validator if validator is not None else FileValidator()
         self.cols_map = {
             'Date': ('timestamp', CsvImporter.map_mdy_date),
             'Weight': ('weight', MSVaultData.map_weight),
@@ -94,14 +105,16 @@ class MSVaultData():
     def file_count(self):
         return len(self.file_names)
 
-    def write_entry(self, db_entry):
-        MSHealthDB.MSVaultWeight.find_or_create(self.mshealthdb, db_entry)
+    def write_entries(self, db_entries):
+        created = MSHealthDB.MSVaultWeight.find_or_create_all(self.mshealthdb, db_entries)
+        logger.info("Wrote %d new of %d entries", created, len(db_entries))
 
     def process_files(self):
         for file_name in self.file_names:
             logger.info("Processing file: " + file_name)
-            csvimporter = CsvImporter(file_name, self.cols_map, self.write_entry)
-            csvimporter.process_file(self.english_units)
+            with self.validator.importing(file_name):
+                csvimporter = CsvImporter(file_name, self.cols_map, self.write_entries)
+                csvimporter.process_file(self.english_units)
 
     @classmethod
     def map_weight(cls, english_units, value):
@@ -116,6 +129,7 @@ class MSVaultData():
 
 def usage(program):
     print '%s -o <dbpath> -i <inputfile> [-m | -v]' % program
+    print '    --journal_dir <dir> : journal the rows written to the DBs in dir, so the DBs can be rebuilt with replay_journal.py'
     sys.exit()
 
 def main(argv):
@@ -123,11 +137,12 @@ def main(argv):
     english_units = False
     input_file = None
     input_dir = None
+    journal_dir = None
     db_params_dict = {}
 
     try:
         opts, args = getopt.getopt(argv,"d:ehi:s:",
-            ["help", "input_dir=", "trace", "english", "input_file=", "mysql=", "sqlite="])
+            ["help", "input_dir=", "trace", "english", "input_file=", "journal_dir=", "mysql=", "sqlite="])
     except getopt.GetoptError:
         print "Bad argument"
         usage(sys.argv[0])
@@ -146,6 +161,9 @@ def main(argv):
             input_file = arg
         elif opt in ("-d", "--input_dir"):
             input_dir = arg
+        elif opt == "--journal_dir":
+            logging.debug("Journal dir: %s" % arg)
+            journal_dir = arg
         elif opt in ("-s", "--sqlite"):
             logging.debug("Sqlite DB path: %s" % arg)
             db_params_dict['db_type'] = 'sqlite'
@@ -167,13 +185,22 @@ def main(argv):
         print "Missing arguments:"
         usage(sys.argv[0])
 
-    msd = MSHealthData(input_file, input_dir, db_params_dict, english_units, debug)
-    if msd.file_count() > 0:
-        msd.process_files()
-
-    mshv = MSVaultData(input_file, input_dir, db_params_dict, english_units, debug)
-    if mshv.file_count() > 0:
-        mshv.process_files()
+    if journal_dir:
+        HealthDB.DB.journal = HealthDB.Journal(journal_dir)
+    try:
+        validator = FileValidator(MSHealthDB.MSHealthDB(db_params_dict, debug), MSHealthDB.Quarantine)
+        msd = MSHealthData(input_file, input_dir, db_params_dict, english_units, debug, validator)
+        mshv = MSVaultData(input_file, input_dir, db_params_dict, english_units, debug, validator)
+        validator.validate(msd, mshv)
+
+        if msd.file_count() > 0:
+            msd.process_files()
+        if mshv.file_count() > 0:
+            mshv.process_files()
+        validator.log_summary()
+    finally:
+        if HealthDB.DB.journal is not None:
+            HealthDB.DB.journal.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+
+#
+# copyright Tom Goetz
+#
+
+import os, sys, getopt, logging, time
+
+import HealthDB
+
+
+logging.basicConfig(level=logging.INFO)
+root_logger = logging.getLogger()
+logger = logging.getLogger(__file__)
+
+
+#
+# Applies the journaled writes to one DB. Runs of inserts into the same table are written with bulk inserts, the other ops
+# by the DBObject method that journaled them. Commits every batch_size ops.
+#
+class DbReplay():
+
+    def __init__(self, db, batch_size):
+        self.db = db
+        self.batch_size = batch_size
+        self.session = None
+        self.ops = 0
+        self.insert_table = None
+        self.inserts = []
+        self.records = 0
+
+    def get_session(self):
+        if self.session is None:
+            self.session = self.db.session()
+        return self.session
+
+    def write_inserts(self):
+        if len(self.inserts) > 0:
+            self.insert_table._insert(self.db, self.get_session(), self.inserts)
+            self.ops += len(self.inserts)
+            self.inserts = []
+
+    def commit(self):
+        self.write_inserts()
+        if self.session is not None:
+            HealthDB.DB.commit(self.session)
+            self.session = None
+        self.ops = 0
+
+    def apply(self, table, op, values_dict, args):
+        if op == 'insert':
+            if table is not self.insert_table:
+                self.write_inserts()
+                self.insert_table = table
+            self.inserts.append(values_dict)
+            if len(self.inserts) >= self.batch_size:
+                self.write_inserts()
+        else:
+            self.write_inserts()
+            session = self.get_session()
+            # the deletes don't see rows still pending in the session
+            session.flush()
+            getattr(table, '_' + op)(self.db, session, values_dict, *args)
+            self.ops += 1
+        self.records += 1
+        if self.ops >= self.batch_size:
+            self.commit()
+
+
+#
+# Rebuilds DBs from a Journal of the rows written when the data files were imported, without reading the data files again.
+# The DBs should be new, ex: deleted before replaying, since the journaled inserts aren't looked up first.
+#
+class JournalReplay():
+
+    def __init__(self, db_params_dict, db_names, debug, batch_size=10000):
+        self.db_params_dict = db_params_dict
+        self.db_names = db_names
+        self.debug = debug
+        self.batch_size = batch_size
+        self.db_replays = {}
+        self.skipped = 0
+
+    def replays_db(self, db_class):
+        # the short names are accepted for the garmin DBs, ex: monitoring for garmin_monitoring
+        return self.db_names is None or db_class.db_name in self.db_names or db_class.db_name.replace('garmin_', '') in self.db_names
+
+    def db_replay(self, db_class):
+        db_replay = self.db_replays.get(db_class)
+        if db_replay is None:
+            db_replay = DbReplay(db_class(self.db_params_dict, self.debug - 1), self.batch_size)
+            self.db_replays[db_class] = db_replay
+        return db_replay
+
+    def replay(self, journal_dir):
+        start = time.time()
+        for (db_class, table, op, values_dict, args) in HealthDB.Journal.read(journal_dir):
+            if self.replays_db(db_class):
+                self.db_replay(db_class).apply(table, op, values_dict, args)
+            else:
+                self.skipped += 1
+        for db_replay in self.db_replays.values():
+            db_replay.commit()
+            logger.info("%s: replayed %d records", db_replay.db.db_name, db_replay.records)
+        logger.info("Replayed %s in %ds, skipped %d records", journal_dir, time.time() - start, self.skipped)
+
+
+def usage(program):
+    print '%s [-s <sqlite db path> | -m <user,password,host>] -j <journal dir> ...' % program
+    print '    --trace : turn on debug tracing'
+    print '    --dbs <name,...> : only rebuild these DBs, ex: garmin,monitoring,activities,fitbit,mshealth'
+    print '    '
+    sys.exit()
+
+def main(argv):
+    debug = 0
+    journal_dir = None
+    db_names = None
+    db_params_dict = {}
+
+    try:
+        opts, args = getopt.getopt(argv,"b:j:m:s:t:", ["trace=", "dbs=", "journal_dir=", "mysql=", "sqlite="])
+    except getopt.GetoptError:
+        usage(sys.argv[0])
+
+    for opt, arg in opts:
+        if opt == '-h':
+            usage(sys.argv[0])
+        elif opt in ("-t", "--trace"):
+            debug = int(arg)
+        elif opt in ("-b", "--dbs"):
+            logging.debug("DBs: %s" % arg)
+            db_names = arg.split(',')
+        elif opt in ("-j", "--journal_dir"):
+            logging.debug("Journal dir: %s" % arg)
+            journal_dir = arg
+        elif opt in ("-s", "--sqlite"):
+            logging.debug("Sqlite DB path: %s" % arg)
+            db_params_dict['db_type'] = 'sqlite'
+            db_params_dict['db_path'] = arg
+        elif opt in ("-m", "--mysql"):
+            logging.debug("Mysql DB string: %s" % arg)
+            db_args = arg.split(',')
+            db_params_dict['db_type'] = 'mysql'
+            db_params_dict['db_username'] = db_args[0]
+            db_params_dict['db_password'] = db_args[1]
+            db_params_dict['db_host'] = db_args[2]
+
+    if debug > 0:
+        root_logger.setLevel(logging.DEBUG)
+    else:
+        root_logger.setLevel(logging.INFO)
+
+    if journal_dir is None or not os.path.isdir(journal_dir):
+        print "Missing or incorrect arguments: journal dir"
+        usage(sys.argv[0])
+    if len(db_params_dict) == 0:
+        print "Missing or incorrect arguments: db params"
+        usage(sys.argv[0])
+
+    JournalReplay(db_params_dict, db_names, debug).replay(journal_dir)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
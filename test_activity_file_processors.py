@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+
+#
+# copyright Tom Goetz
+#
+
+import unittest, logging, datetime, tempfile, math
+
+import GarminDB
+from ActivityAssembler import ActivityAssembler
+from GpxFileProcessor import GpxFileProcessor, haversine
+from TcxFileProcessor import TcxFileProcessor
+from FileValidator import FileValidator
+
+
+logger = logging.getLogger(__name__)
+
+meters_per_degree = 111194.9
+
+
+def write_gpx_file(filename, trackpoints):
+    # two segments at 3 m/s, stopped for a minute in each, over a 20 m hill with a meter of noise on the elevations
+    start = datetime.datetime(2018, 10, 1, 12)
+    points = trackpoints / 2
+    lat = 47.0
+    with open(filename, 'w') as gpx_file:
+        gpx_file.write('<?xml version="1.0"?>\n<gpx creator="test" version="1.1" xmlns="http://www.topografix.com/GPX/1/1" '
+            'xmlns:gpxtpx="http://www.garmin.com/xmlschemas/TrackPointExtension/v1"><trk><name>Test</name><type>running</type>\n')
+        for segment in xrange(2):
+            gpx_file.write('<trkseg>\n')
+            for point in xrange(points):
+                if point > 0 and not (100 <= point < 160):
+                    lat += 3.0 / meters_per_degree
+                ele = 100 + 20 * math.sin(math.pi * point / points) + (1 if point % 2 else -1)
+                timestamp = start + datetime.timedelta(0, (segment * 2 * points) + point)
+                gpx_file.write('<trkpt lat="%.7f" lon="-122.0"><ele>%.1f</ele><time>%sZ</time><extensions><gpxtpx:TrackPointExtension>'
+                    '<gpxtpx:hr>%d</gpxtpx:hr></gpxtpx:TrackPointExtension></extensions></trkpt>\n' % (lat, ele, timestamp.isoformat(), 120 + point % 50))
+            gpx_file.write('</trkseg>\n')
+        gpx_file.write('</trk></gpx>\n')
+
+
+def write_tcx_file(filename, trackpoints, laps):
+    # laps of trackpoints a second and 3 meters apart
+    start = datetime.datetime(2018, 10, 1, 12)
+    points = trackpoints / laps
+    with open(filename, 'w') as tcx_file:
+        tcx_file.write('<?xml version="1.0"?>\n<TrainingCenterDatabase xmlns="http://www.garmin.com/xmlschemas/TrainingCenterDatabase/v2">'
+            '<Activities><Activity Sport="Running"><Id>%sZ</Id>\n' % start.isoformat())
+        for lap in xrange(laps):
+            lap_start = start + datetime.timedelta(0, lap * points)
+            tcx_file.write('<Lap StartTime="%sZ"><TotalTimeSeconds>%d</TotalTimeSeconds><DistanceMeters>%d</DistanceMeters><Calories>100</Calories>'
+                '<AverageHeartRateBpm><Value>130</Value></AverageHeartRateBpm><Track>\n' % (lap_start.isoformat(), points, points * 3))
+            for point in xrange(points):
+                record = lap * points + point
+                tcx_file.write('<Trackpoint><Time>%sZ</Time><Position><LatitudeDegrees>47.0</LatitudeDegrees><LongitudeDegrees>-122.0'
+                    '</LongitudeDegrees></Position><AltitudeMeters>%.1f</AltitudeMeters><DistanceMeters>%d</DistanceMeters>'
+                    '<HeartRateBpm><Value>%d</Value></HeartRateBpm></Trackpoint>\n' %
+                    ((start + datetime.timedelta(0, record)).isoformat(), 100 + (record % 10), record * 3, 120 + record % 50))
+            tcx_file.write('</Track></Lap>\n')
+        tcx_file.write('</Activity></Activities><Creator><Name>Test</Name><Version><VersionMajor>1</VersionMajor></Version></Creator>'
+            '</TrainingCenterDatabase>\n')
+
+
+def activity_sources(activity_id):
+    # the rows for an activity in the order that the summary JSON, details JSON, and FIT file produce them
+    start_time = datetime.datetime(2018, 1, 1) + datetime.timedelta(activity_id)
+    return [
+        (GarminDB.Activities, {'activity_id' : activity_id, 'name' : 'run %d' % activity_id, 'sport' : 'running', 'sub_sport' : 'trail',
+            'start_time' : start_time, 'distance' : 10.0, 'avg_hr' : 140}, []),
+        (GarminDB.RunActivities, {'activity_id' : activity_id, 'steps' : 10000, 'vo2_max' : 50.0}, []),
+        (GarminDB.Activities, {'activity_id' : activity_id, 'course_id' : None, 'avg_temperature' : 20.0}, []),
+        (GarminDB.RunActivities, {'activity_id' : activity_id, 'avg_moving_pace' : datetime.time(0, 5)}, []),
+        (GarminDB.Activities, {'activity_id' : activity_id, 'start_time' : start_time, 'stop_time' : start_time + datetime.timedelta(0, 3600),
+            'distance' : 10.1, 'avg_temperature' : 21.0, 'sport' : 'generic', 'sub_sport' : 'generic'}, ['sport', 'sub_sport']),
+        (GarminDB.RunActivities, {'activity_id' : activity_id, 'steps' : 10010}, []),
+    ]
+
+
+class TestGpxFileProcessor(unittest.TestCase):
+
+    trackpoints = 2000
+
+    @classmethod
+    def setUpClass(cls):
+        db_dir = tempfile.mkdtemp()
+        cls.filename = db_dir + '/1000.gpx'
+        write_gpx_file(cls.filename, cls.trackpoints)
+        cls.db_params_dict = {'db_type' : 'sqlite', 'db_path' : db_dir}
+        cls.import_file()
+        cls.garmin_act_db = GarminDB.ActivitiesDB(cls.db_params_dict)
+
+    @classmethod
+    def import_file(cls):
+        gpx_processor = GpxFileProcessor(cls.db_params_dict, False, 0)
+        gpx_processor.import_file(cls.filename)
+        gpx_processor.close()
+
+    def test_haversine(self):
+        self.assertAlmostEqual(haversine(47.0, -122.0, 48.0, -122.0), meters_per_degree, delta=1.0)
+
+    def test_rows(self):
+        self.assertEqual(GarminDB.ActivityRecords.row_count(self.garmin_act_db), self.trackpoints)
+        self.assertEqual(GarminDB.ActivityLaps.row_count(self.garmin_act_db), 2)
+
+    def test_reimport(self):
+        self.import_file()
+        self.test_rows()
+
+    def test_summary(self):
+        activity = GarminDB.Activities.get_id(self.garmin_act_db, 1000)
+        moving_points = self.trackpoints - 2 - 120
+        self.assertEqual(activity.name, 'Test')
+        self.assertEqual(activity.laps, 2)
+        self.assertAlmostEqual(activity.distance, moving_points * 3.0 / 1000, places=1)
+        self.assertEqual(activity.moving_time, datetime.timedelta(0, moving_points))
+        self.assertAlmostEqual(activity.avg_speed, 3.0 * 3.6, places=1)
+        # the noise on the elevations isn't counted as climbing
+        self.assertAlmostEqual(activity.ascent, 40.0, delta=4.0)
+        self.assertAlmostEqual(activity.descent, 40.0, delta=4.0)
+
+
+class TestTcxFileProcessor(unittest.TestCase):
+
+    trackpoints = 2000
+    laps = 2
+
+    def setUp(self):
+        db_dir = tempfile.mkdtemp()
+        self.filename = db_dir + '/1000.tcx'
+        self.db_params_dict = {'db_type' : 'sqlite', 'db_path' : db_dir}
+        self.garmin_act_db = GarminDB.ActivitiesDB(self.db_params_dict)
+
+    def import_file(self):
+        tcx_processor = TcxFileProcessor(self.db_params_dict, False, 0)
+        tcx_processor.import_file(self.filename)
+        tcx_processor.close()
+
+    def test_rows(self):
+        write_tcx_file(self.filename, self.trackpoints, self.laps)
+        self.import_file()
+        self.assertEqual(GarminDB.ActivityRecords.row_count(self.garmin_act_db), self.trackpoints)
+        self.assertEqual(GarminDB.ActivityLaps.row_count(self.garmin_act_db), self.laps)
+        activity = GarminDB.Activities.get_id(self.garmin_act_db, 1000)
+        self.assertEqual(activity.laps, self.laps)
+        self.assertEqual(activity.calories, 100 * self.laps)
+        self.assertEqual(activity.max_hr, 169)
+        self.assertAlmostEqual(activity.distance, (self.trackpoints - 1) * 3 / 1000.0)
+
+    def test_failed_import(self):
+        # a bad value near the end of the file, the rows already written or queued for it are removed
+        write_tcx_file(self.filename, self.trackpoints, self.laps)
+        with open(self.filename) as tcx_file:
+            tcx_data = tcx_file.read()
+        with open(self.filename, 'w') as tcx_file:
+            tcx_file.write('<Value>x</Value>'.join(tcx_data.rsplit('<Value>149</Value>', 1)))
+        validator = FileValidator(GarminDB.GarminDB(self.db_params_dict), GarminDB.Quarantine)
+        tcx_processor = TcxFileProcessor(self.db_params_dict, False, 0)
+        with validator.importing(self.filename, tcx_processor.discard_file):
+            tcx_processor.import_file(self.filename)
+        tcx_processor.close()
+        self.assertEqual(GarminDB.ActivityRecords.row_count(self.garmin_act_db), 0)
+        self.assertEqual(GarminDB.ActivityLaps.row_count(self.garmin_act_db), 0)
+        self.assertEqual([file_name for (file_name, reason) in validator.skipped], [self.filename])
+
+    def test_reimport_shorter(self):
+        # the rows of the earlier import are replaced, not updated in place
+        write_tcx_file(self.filename, self.trackpoints, self.laps)
+        self.import_file()
+        write_tcx_file(self.filename, self.trackpoints / 2, self.laps)
+        self.import_file()
+        self.assertEqual(GarminDB.ActivityRecords.row_count(self.garmin_act_db), self.trackpoints / 2)
+        self.assertEqual(GarminDB.ActivityLaps.row_count(self.garmin_act_db), self.laps)
+
+
+class TestActivityAssembler(unittest.TestCase):
+
+    activities = 10
+
+    def setUp(self):
+        self.db_params_dict = {'db_type' : 'sqlite', 'db_path' : tempfile.mkdtemp()}
+        self.garmin_act_db = GarminDB.ActivitiesDB(self.db_params_dict)
+
+    def test_precedence(self):
+        assembler = ActivityAssembler(self.db_params_dict, 0)
+        for activity_id in xrange(self.activities):
+            for (table, values_dict, fill_only) in activity_sources(activity_id):
+                assembler.add(table, values_dict, fill_only)
+        assembler.write()
+        activity = GarminDB.Activities.get_id(self.garmin_act_db, 1)
+        # later sources win, except that the FIT sport doesn't replace the JSON sport
+        self.assertEqual((activity.name, activity.sport, activity.sub_sport), ('run 1', 'running', 'trail'))
+        self.assertEqual((activity.distance, activity.avg_temperature, activity.avg_hr), (10.1, 21.0, 140))
+        run = GarminDB.RunActivities.find_one(self.garmin_act_db, {'activity_id' : 1})
+        self.assertEqual((run.steps, run.vo2_max, run.avg_moving_pace), (10010, 50.0, datetime.time(0, 5)))
+        self.assertEqual(GarminDB.Activities.row_count(self.garmin_act_db), self.activities)
+
+    def test_fill_only(self):
+        assembler = ActivityAssembler(self.db_params_dict, 0)
+        start_time = datetime.datetime(2018, 1, 1)
+        GarminDB.Activities.create_or_update_not_none(self.garmin_act_db, {'activity_id' : 1, 'start_time' : start_time, 'sport' : 'walking'})
+        assembler.add(GarminDB.Activities, {'activity_id' : 1, 'start_time' : start_time, 'sport' : 'generic', 'sub_sport' : 'generic'},
+            ['sport', 'sub_sport'])
+        assembler.write()
+        activity = GarminDB.Activities.get_id(self.garmin_act_db, 1)
+        self.assertEqual((activity.sport, activity.sub_sport), ('walking', 'generic'))
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
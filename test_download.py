@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+
+#
+# copyright Tom Goetz
+#
+
+import unittest, logging, datetime, tempfile, os, json
+
+import download_garmin
+import garmin_connect_standin
+import FileProcessor
+from RawDataStore import RawDataStore
+
+
+logger = logging.getLogger(__name__)
+
+
+class TestDownload(unittest.TestCase):
+
+    days = 10
+
+    @classmethod
+    def setUpClass(cls):
+        cls.data = garmin_connect_standin.GarminConnectData(days=cls.days, activities=40)
+        # some server errors and rate limiting, as from the real service on a bad day
+        cls.server = garmin_connect_standin.GarminConnectStandIn(cls.data, latency=0.0, error_rate=0.05, throttle_rate=0.05)
+        cls.server.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+
+    def download(self, concurrency, archive=False):
+        download = download_garmin.Download(rate=1000, concurrency=concurrency, base_url=self.server.base_url, sso_url=self.server.sso_url,
+            archive=archive)
+        download.session_file = tempfile.mktemp()
+        download.backoff_base = 0.01
+        self.assertTrue(download.login('user', 'password'))
+        return download
+
+    def activity_files(self, outdir, activity_id):
+        return [outdir + '/' + (file_name % activity_id) for file_name in ['activity_%d.json', 'activity_details_%d.json', '%d.fit']]
+
+    def test_download_monitoring(self):
+        start_date = self.data.first_day
+        download = self.download(4)
+        outdir = tempfile.mkdtemp()
+        download.get_monitoring(outdir, start_date, self.days)
+        download.close()
+        expected = [name for day in xrange(self.days) for name in self.data.monitoring_file_names(start_date + datetime.timedelta(day))]
+        self.assertEqual(sorted(os.listdir(outdir)), sorted(expected))
+
+    def test_download_activities(self):
+        download = self.download(4)
+        outdir = tempfile.mkdtemp()
+        download.get_activities(outdir, 1000)
+        download.close()
+        self.assertTrue(all(os.path.isfile(file_name) for activity_id in self.data.activity_ids() for file_name in self.activity_files(outdir, activity_id)))
+
+    def test_download_failed_activity(self):
+        activity_ids = self.data.activity_ids()
+        failing_id = activity_ids[10]
+        outdir = tempfile.mkdtemp()
+        self.server.failing_paths.add('/modern/proxy/download-service/files/activity/%d' % failing_id)
+        try:
+            download = self.download(4)
+            download.get_activities(outdir, 1000)
+            download.close()
+        finally:
+            self.server.failing_paths.clear()
+        # the failed activity and the newer ones aren't marked as known, the older ones are
+        self.assertFalse(any(os.path.isfile(self.activity_files(outdir, activity_id)[0]) for activity_id in activity_ids[:11]))
+        self.assertTrue(all(os.path.isfile(file_name) for activity_id in activity_ids[11:] for file_name in self.activity_files(outdir, activity_id)))
+        download = self.download(4)
+        download.get_activities(outdir, 1000)
+        download.close()
+        self.assertTrue(all(os.path.isfile(file_name) for activity_id in activity_ids for file_name in self.activity_files(outdir, activity_id)))
+
+    def test_download_scan_all(self):
+        activity_ids = self.data.activity_ids()
+        outdir = tempfile.mkdtemp()
+        download = self.download(4)
+        download.get_activities(outdir, 1000)
+        missing_id = activity_ids[20]
+        for file_name in self.activity_files(outdir, missing_id):
+            os.remove(file_name)
+        # a scan for new activities stops at the newest one, a full scan fills in the gap
+        download.get_activities(outdir, 1000)
+        self.assertFalse(os.path.isfile(self.activity_files(outdir, missing_id)[0]))
+        download.get_activities(outdir, 1000, scan_all=True)
+        download.close()
+        self.assertTrue(all(os.path.isfile(file_name) for file_name in self.activity_files(outdir, missing_id)))
+
+    def test_download_sleep_weight_rhr(self):
+        download = self.download(4)
+        outdir = tempfile.mkdtemp()
+        download.get_sleep(outdir, self.data.first_day, self.days)
+        self.assertEqual(len(os.listdir(outdir)), self.days)
+        self.assertEqual(len(download.get_weight()), self.days)
+        self.assertEqual(len(download.get_rhr()), self.days)
+        since = datetime.datetime.combine(self.data.today - datetime.timedelta(4), datetime.time.min)
+        self.assertEqual(len(download.get_weight(since)), 5)
+        self.assertEqual(len(download.get_rhr(since.date())), 5)
+        download.close()
+
+    def test_download_failed_chunk(self):
+        outdir = tempfile.mkdtemp()
+        self.server.failing_paths.update(['/modern/proxy/userprofile-service/userprofile/personal-information/weightWithOutbound/filterByDay',
+            '/modern/proxy/userstats-service/wellness/daily/standin'])
+        try:
+            download = self.download(4)
+            self.assertRaises(download_garmin.DownloadError, download.get_weight)
+            self.assertRaises(download_garmin.DownloadError, download.get_rhr)
+            # a partial history isn't saved
+            download.save_weight(outdir)
+            download.save_rhr(outdir)
+            download.close()
+        finally:
+            self.server.failing_paths.clear()
+        self.assertEqual(os.listdir(outdir), [])
+
+    def test_download_archive(self):
+        outdir = tempfile.mkdtemp()
+        for run in xrange(2):
+            download = self.download(4, True)
+            download.get_sleep(outdir, self.data.first_day, self.days)
+            download.get_activities(outdir, 1000)
+            download.get_monitoring(outdir, self.data.first_day, self.days)
+            download.close()
+        self.assertTrue(all(file.endswith('.zip') for file in os.listdir(outdir)))
+        fit_files = FileProcessor.FileProcessor.dir_to_files(outdir, r'.*\.fit')
+        self.assertEqual(len(fit_files), (self.days * self.data.monitoring_files_per_day) + len(self.data.activity_ids()))
+        for file_name in fit_files:
+            name = os.path.basename(file_name)
+            if len(name) > len('1000.fit'):
+                self.assertEqual(RawDataStore.read(file_name), self.data.fit_data('monitoring', name))
+        sleep_files = FileProcessor.FileProcessor.dir_to_files(outdir, r'sleep_.*\.json')
+        self.assertEqual(len(sleep_files), self.days)
+        activity_files = FileProcessor.FileProcessor.dir_to_files(outdir, r'activity_\d*\.json')
+        self.assertEqual(len(activity_files), len(self.data.activity_ids()))
+        for file_name in sleep_files:
+            json_data = json.load(FileProcessor.FileProcessor.open_file(file_name))
+            self.assertEqual(json_data, self.data.sleep(datetime.datetime.strptime(json_data['dailySleepDTO']['calendarDate'], '%Y-%m-%d').date()))
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+
+#
+# copyright Tom Goetz
+#
+
+import unittest, logging, tempfile, os, json, zipfile
+
+import FileProcessor
+from RawDataStore import RawDataStore
+from JsonFileProcessor import JsonFileProcessor
+
+
+logger = logging.getLogger(__name__)
+
+
+class TestZipFiles(unittest.TestCase):
+
+    def setUp(self):
+        self.input_dir = tempfile.mkdtemp()
+        self.members = {'1000.fit' : os.urandom(1000), 'DI_CONNECT/DI-Connect-Fitness/2000.fit' : os.urandom(2000)}
+        with zipfile.ZipFile(self.input_dir + '/export.zip', 'w') as files_zip:
+            for (name, data) in self.members.iteritems():
+                files_zip.writestr(name, data)
+
+    def test_members(self):
+        file_names = FileProcessor.FileProcessor.dir_to_files(self.input_dir, r'.*\.fit$')
+        self.assertEqual(sorted(file_names), sorted(self.input_dir + '/export.zip/' + name for name in self.members))
+        for file_name in file_names:
+            name = file_name[len(self.input_dir + '/export.zip/'):]
+            self.assertEqual(FileProcessor.FileProcessor.open_file(file_name).read(), self.members[name])
+            self.assertEqual(FileProcessor.FileProcessor.file_size(file_name), len(self.members[name]))
+
+    def test_plain_file(self):
+        file_name = self.input_dir + '/3000.fit'
+        with open(file_name, 'wb') as fit_file:
+            fit_file.write(os.urandom(100))
+        self.assertIsNone(RawDataStore.member_path(file_name))
+        self.assertEqual(FileProcessor.FileProcessor.file_size(file_name), 100)
+        self.assertIn(file_name, FileProcessor.FileProcessor.dir_to_files(self.input_dir, r'.*\.fit$'))
+
+
+def write_json_file(filename, samples):
+    json_data = [{'date' : 1500000000000 + (sample * 60000), 'weight' : 80000.0 + sample, 'nested' : {'values' : [sample, -1.5e3]}}
+        for sample in xrange(samples)]
+    with open(filename, 'w') as json_file:
+        json.dump(json_data, json_file, indent=4)
+    return json_data
+
+
+class TestJsonFileProcessor(unittest.TestCase):
+
+    samples = 5000
+
+    @classmethod
+    def setUpClass(cls):
+        cls.filename = tempfile.mktemp(suffix='.json')
+        cls.json_data = write_json_file(cls.filename, cls.samples)
+
+    def test_entries_match_json_load(self):
+        self.assertEqual(list(JsonFileProcessor(self.filename).entries()), self.json_data)
+
+    def test_conversions(self):
+        first = next(JsonFileProcessor(self.filename, {'date' : str, 'nested.values.*' : int}).entries())
+        self.assertEqual(first, {'date' : '1500000000000', 'weight' : 80000.0, 'nested' : {'values' : [0, -1500]}})
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+
+#
+# copyright Tom Goetz
+#
+
+import unittest, logging, tempfile, os, json, struct, StringIO
+
+import GarminDB
+from JsonFileProcessor import JsonFileProcessor
+from FileValidator import FileValidator, fit_crc
+
+
+logger = logging.getLogger(__name__)
+
+
+class ValidatorFileSet():
+
+    def __init__(self, file_names, required_columns=[]):
+        self.file_names = file_names
+        self.required_columns = required_columns
+
+
+def fit_file_data(data):
+    header = struct.pack('<BBHI4s', 14, 0x10, 2000, len(data), '.FIT')
+    header += struct.pack('<H', fit_crc(header))
+    return header + data + struct.pack('<H', fit_crc(header + data))
+
+
+def write_file(file_dir, name, data):
+    file_name = file_dir + '/' + name
+    with open(file_name, 'wb') as output_file:
+        output_file.write(data)
+    return file_name
+
+
+class TestFileValidator(unittest.TestCase):
+
+    def setUp(self):
+        self.file_dir = tempfile.mkdtemp()
+        self.garmin_db = GarminDB.GarminDB({'db_type' : 'sqlite', 'db_path' : tempfile.mkdtemp()})
+
+    def test_checks(self):
+        fit_data = fit_file_data(os.urandom(1000))
+        self.assertIsNone(FileValidator.check_fit(StringIO.StringIO(fit_data), len(fit_data)))
+        self.assertIsNotNone(FileValidator.check_fit(StringIO.StringIO(fit_data), len(fit_data) - 10))
+        self.assertIsNotNone(FileValidator.check_fit(StringIO.StringIO(fit_data[:5] + chr(ord(fit_data[5]) ^ 1) + fit_data[6:]), len(fit_data)))
+        self.assertIsNotNone(FileValidator.check_fit(StringIO.StringIO('<html>Not Found</html>'), 22))
+        self.assertIsNone(FileValidator.check_json(StringIO.StringIO('{"weight" : 80.0}')))
+        self.assertIsNotNone(FileValidator.check_json(StringIO.StringIO('{"weight" : 80.0')))
+        self.assertIsNone(FileValidator.check_json(StringIO.StringIO(' [{"weight" : 80.0}, 1.5]')))
+        self.assertIsNotNone(FileValidator.check_json(StringIO.StringIO('[{"weight" : 80.0}, ')))
+        self.assertIsNone(FileValidator.check_csv('Date,Steps\n2018-01-01,1000\n', ['Date']))
+        self.assertIsNotNone(FileValidator.check_csv('Day,Steps\n2018-01-01,1000\n', ['Date']))
+        self.assertIsNotNone(FileValidator.check_csv('', ['Date']))
+        self.assertIsNone(FileValidator.check_xml(StringIO.StringIO('<gpx xmlns="http://www.topografix.com/GPX/1/1"><trk/></gpx>'), 'gpx'))
+        self.assertIsNotNone(FileValidator.check_xml(StringIO.StringIO('<gpx><trk></gpx>'), 'gpx'))
+        self.assertIsNotNone(FileValidator.check_xml(StringIO.StringIO('<html>Not Found</html>'), 'gpx'))
+        self.assertIsNotNone(FileValidator.check_xml(StringIO.StringIO(''), 'TrainingCenterDatabase'))
+
+    def test_quarantine(self):
+        good = [write_file(self.file_dir, 'good.fit', fit_file_data(os.urandom(1000))), write_file(self.file_dir, 'good.json', '[]')]
+        bad = [write_file(self.file_dir, 'truncated.fit', fit_file_data(os.urandom(1000))[:-100]), write_file(self.file_dir, 'bad.json', '[{')]
+        file_set = ValidatorFileSet(good + bad)
+        validator = FileValidator(self.garmin_db, GarminDB.Quarantine, 2)
+        validator.validate(file_set)
+        self.assertEqual(file_set.file_names, good)
+        with validator.importing(good[1]):
+            raise ValueError('no samples')
+        self.assertEqual(sorted(file_name for (file_name, reason) in validator.skipped), sorted(bad + [good[1]]))
+        self.assertEqual(GarminDB.Quarantine.row_count(self.garmin_db), 3)
+        validator.log_summary()
+        # a file that's fixed is released when it's imported again
+        write_file(self.file_dir, 'bad.json', '[{}]')
+        validator.validate(ValidatorFileSet(good + bad))
+        self.assertIsNone(GarminDB.Quarantine.find_one(self.garmin_db, {'name' : bad[1]}))
+        self.assertEqual(GarminDB.Quarantine.find_one(self.garmin_db, {'name' : bad[0]}).reason, 'truncated FIT file, 916 of 1016 bytes')
+
+    def test_json_memory(self):
+        # a JSON array is checked a chunk at a time, the whole file is never read at once
+        file_name = write_file(self.file_dir, 'weight.json', json.dumps([{'date' : day, 'weight' : 80.0} for day in xrange(20000)]))
+        reads = []
+        class TrackedFile(file):
+            def read(self, *args):
+                data = file.read(self, *args)
+                reads.append(len(data))
+                return data
+        self.assertIsNone(FileValidator.check_json(TrackedFile(file_name)))
+        self.assertEqual(sum(reads), os.path.getsize(file_name))
+        self.assertLessEqual(max(reads), JsonFileProcessor.chunk_size)
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
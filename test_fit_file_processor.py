@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+
+#
+# copyright Tom Goetz
+#
+
+import unittest, logging, datetime, tempfile, os, zipfile
+
+import Fit
+from FitFileCache import FitFileCache
+from FitFileProcessor import FitFileProcessor
+
+
+logger = logging.getLogger(__name__)
+
+
+class TestLocalFile(unittest.TestCase):
+
+    def setUp(self):
+        self.input_dir = tempfile.mkdtemp()
+
+    def test_member(self):
+        data = os.urandom(1000)
+        with zipfile.ZipFile(self.input_dir + '/export.zip', 'w') as files_zip:
+            files_zip.writestr('1000.fit', data)
+        # FIT files are decoded from a temporary copy
+        with FitFileProcessor.local_file(self.input_dir + '/export.zip/1000.fit') as local_file_name:
+            with open(local_file_name, 'rb') as local_file:
+                self.assertEqual(local_file.read(), data)
+        self.assertFalse(os.path.exists(local_file_name))
+
+    def test_plain_file(self):
+        file_name = self.input_dir + '/3000.fit'
+        with open(file_name, 'wb') as fit_file:
+            fit_file.write(os.urandom(100))
+        with FitFileProcessor.local_file(file_name) as local_file_name:
+            self.assertEqual(local_file_name, file_name)
+        self.assertTrue(os.path.exists(file_name))
+
+
+class DecodedMessage():
+
+    def __init__(self, message_dict):
+        self.message_dict = message_dict
+
+    def to_dict(self):
+        return dict(self.message_dict)
+
+
+class DecodedFitFile():
+    # what Fit.File gives FitFileProcessor for a decoded monitoring file
+
+    def __init__(self, messages):
+        self.filename = 'decoded.fit'
+        self.messages = {Fit.MessageType.monitoring : [DecodedMessage(message_dict) for message_dict in messages]}
+
+    def time_created(self):
+        return datetime.datetime(2018, 1, 1)
+
+    def type(self):
+        return Fit.FieldEnums.FileType.monitoring_b
+
+    def message_types(self):
+        return [Fit.MessageType.monitoring, Fit.MessageType.event]
+
+    def __getitem__(self, message_type):
+        return self.messages.get(message_type, [])
+
+
+def monitoring_messages(messages):
+    return [{'timestamp' : datetime.datetime(2018, 1, 1) + datetime.timedelta(0, 60 * message), 'steps' : message,
+        'activity_type' : Fit.FieldEnums.ActivityType.walking, 'heart_rate' : 60 + message % 100} for message in xrange(messages)]
+
+
+class TestFitFileCache(unittest.TestCase):
+
+    def setUp(self):
+        self.fit_cache = FitFileCache(tempfile.mkdtemp())
+        self.file_data = os.urandom(64 * 1024)
+        self.message_dicts = monitoring_messages(1000)
+        self.decoded_file = DecodedFitFile(self.message_dicts)
+
+    def test_key(self):
+        self.assertEqual(self.fit_cache.key(self.file_data, False), self.fit_cache.key(bytes(self.file_data), False))
+        self.assertNotEqual(self.fit_cache.key(self.file_data, False), self.fit_cache.key(self.file_data, True))
+        self.assertNotEqual(self.fit_cache.key(self.file_data, False), self.fit_cache.key(self.file_data[1:], False))
+        self.assertNotEqual(self.fit_cache.key(self.file_data, False), self.fit_cache.key(self.file_data, False, [Fit.MessageType.event]))
+        self.assertEqual(self.fit_cache.key(self.file_data, False, [Fit.MessageType.event, Fit.MessageType.sport]),
+            self.fit_cache.key(self.file_data, False, [Fit.MessageType.sport, Fit.MessageType.event]))
+
+    def test_round_trip(self):
+        key = self.fit_cache.key(self.file_data, False)
+        self.assertIsNone(self.fit_cache.load(key, 'test.fit'))
+        self.fit_cache.save(key, 'test.fit', self.decoded_file, [Fit.MessageType.monitoring])
+        cached_file = self.fit_cache.load(key, 'test.fit')
+        self.assertEqual((self.fit_cache.hits, self.fit_cache.misses), (1, 1))
+        self.assertEqual(cached_file.filename, 'test.fit')
+        self.assertEqual(cached_file.time_created(), self.decoded_file.time_created())
+        self.assertEqual(cached_file.type(), self.decoded_file.type())
+        self.assertEqual(cached_file.message_types(), self.decoded_file.message_types())
+        self.assertEqual([message.to_dict() for message in cached_file[Fit.MessageType.monitoring]], self.message_dicts)
+        self.assertEqual(cached_file[Fit.MessageType.event], [])
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
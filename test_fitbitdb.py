@@ -0,0 +1,30 @@
+#!/usr/bin/env python
+
+#
+# copyright Tom Goetz
+#
+
+import unittest, logging, datetime, tempfile
+
+import FitBitDB
+
+
+logger = logging.getLogger(__name__)
+
+
+class TestFitBitStats(unittest.TestCase):
+
+    def test_weekly_intensity(self):
+        # a week of activity minutes totals more than 24 hours
+        fitbit_db = FitBitDB.FitBitDB({'db_type' : 'sqlite', 'db_path' : tempfile.mkdtemp()})
+        first_day = datetime.date(2018, 1, 1)
+        for day in xrange(7):
+            FitBitDB.DaysSummary.create_or_update(fitbit_db, {'day' : first_day + datetime.timedelta(day), 'fairly_active_mins' : 200, 'very_active_mins' : 100})
+        stats = FitBitDB.DaysSummary.get_activity_mins_stats(fitbit_db, FitBitDB.DaysSummary.get_col_sum, first_day, first_day + datetime.timedelta(7))
+        self.assertEqual(stats['moderate_activity_time'], datetime.timedelta(minutes=1400))
+        self.assertEqual(stats['vigorous_activity_time'], datetime.timedelta(minutes=700))
+        self.assertEqual(stats['intensity_time'], datetime.timedelta(minutes=2800))
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
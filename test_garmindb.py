@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+
+#
+# copyright Tom Goetz
+#
+
+import unittest, logging, datetime, tempfile, threading, os
+
+from HealthDB import *
+import GarminDB
+from replay_journal import JournalReplay
+
+
+logger = logging.getLogger(__name__)
+
+
+def write_night(garmin_db, night, events, total_sleep=datetime.time(7)):
+    start = datetime.datetime(2018, 1, 1, 22) + datetime.timedelta(night)
+    day_data = {'day' : start.date(), 'start' : start, 'end' : start + datetime.timedelta(0, 8 * 3600), 'total_sleep' : total_sleep}
+    GarminDB.Sleep.replace_night(garmin_db, day_data, [(start + datetime.timedelta(0, 600 * event), 'deep_sleep', datetime.time(0, 10))
+        for event in events])
+
+
+def write_nights(db_params_dict, nights, total_sleep):
+    garmin_db = GarminDB.GarminDB(db_params_dict)
+    for night in xrange(nights):
+        write_night(garmin_db, night, xrange(48), total_sleep)
+
+
+def write_records(activities_buffer, records, hr):
+    activities_buffer.delete(GarminDB.ActivityRecords, {'activity_id' : 1})
+    for record in xrange(records):
+        activities_buffer.insert(GarminDB.ActivityRecords, {'activity_id' : 1, 'record' : record, 'hr' : hr,
+            'timestamp' : datetime.datetime(2018, 1, 1) + datetime.timedelta(0, record)})
+
+
+def write_rows(db_params_dict, nights, weights, records):
+    # rows from each of the ways the imports write them
+    write_nights(db_params_dict, nights, datetime.time(7))
+    # importing some of the files again updates rows and replaces the events
+    write_nights(db_params_dict, nights / 4, datetime.time(7, 30))
+    garmin_buffer = WriteBuffer(GarminDB.GarminDB(db_params_dict))
+    for weight in xrange(weights):
+        garmin_buffer.create_or_update(GarminDB.Weight, {'timestamp' : datetime.datetime(2018, 1, 1) + datetime.timedelta(0, 3600 * weight), 'weight' : 80.0})
+    garmin_buffer.sync()
+    garmin_buffer.create_or_update(GarminDB.Weight, {'timestamp' : datetime.datetime(2018, 1, 1), 'weight' : 79.0})
+    garmin_buffer.close()
+    activities_buffer = WriteBuffer(GarminDB.ActivitiesDB(db_params_dict))
+    write_records(activities_buffer, records, 120)
+    activities_buffer.sync()
+    write_records(activities_buffer, records, 130)
+    activities_buffer.close()
+
+
+class TestReplaceNight(unittest.TestCase):
+
+    def setUp(self):
+        self.garmin_db = GarminDB.GarminDB({'db_type' : 'sqlite', 'db_path' : tempfile.mkdtemp()})
+
+    def events(self, night):
+        start = datetime.datetime(2018, 1, 1, 22) + datetime.timedelta(night)
+        return GarminDB.SleepEvents.row_count_for_period(self.garmin_db, start, start + datetime.timedelta(0, 12 * 3600))
+
+    def test_replace(self):
+        for night in xrange(3):
+            write_night(self.garmin_db, night, xrange(48))
+        # events covering less of the night replace all of the earlier ones, the other nights are left alone
+        write_night(self.garmin_db, 1, xrange(10, 20))
+        self.assertEqual([self.events(night) for night in xrange(3)], [48, 10, 48])
+        write_night(self.garmin_db, 1, [])
+        self.assertEqual([self.events(night) for night in xrange(3)], [48, 0, 48])
+
+
+class TestJournal(unittest.TestCase):
+
+    nights = 40
+    weights = 400
+    records = 1000
+
+    def setUp(self):
+        self.journal_dir = tempfile.mkdtemp()
+        self.db_params_dict = {'db_type' : 'sqlite', 'db_path' : tempfile.mkdtemp()}
+        self.replay_db_params_dict = {'db_type' : 'sqlite', 'db_path' : tempfile.mkdtemp()}
+
+    def tearDown(self):
+        DB.journal = None
+
+    def journal_rows(self):
+        DB.journal = Journal(self.journal_dir, 10000)
+        write_rows(self.db_params_dict, self.nights, self.weights, self.records)
+        DB.journal.close()
+        DB.journal = None
+
+    def rows(self, db, table):
+        column_keys = table.row_mapper().column_keys
+        return sorted(tuple(getattr(row, key) for key in column_keys) for row in db.query_session().query(table).all())
+
+    def assertReplayed(self, db_class, table):
+        self.assertEqual(self.rows(db_class(self.replay_db_params_dict), table), self.rows(db_class(self.db_params_dict), table))
+
+    def test_replay(self):
+        self.journal_rows()
+        JournalReplay(self.replay_db_params_dict, None, 0).replay(self.journal_dir)
+        for table in [GarminDB.Sleep, GarminDB.SleepEvents, GarminDB.Weight]:
+            self.assertReplayed(GarminDB.GarminDB, table)
+        self.assertReplayed(GarminDB.ActivitiesDB, GarminDB.ActivityRecords)
+        garmin_db = GarminDB.GarminDB(self.replay_db_params_dict)
+        self.assertEqual(GarminDB.Sleep.find_one(garmin_db, {'day' : datetime.date(2018, 1, 1)}).total_sleep, datetime.timedelta(0, 7.5 * 3600))
+        self.assertEqual(GarminDB.Weight.find_one(garmin_db, {'timestamp' : datetime.datetime(2018, 1, 1)}).weight, 79.0)
+
+    def test_replay_db(self):
+        self.journal_rows()
+        JournalReplay(self.replay_db_params_dict, ['activities'], 0).replay(self.journal_dir)
+        self.assertEqual(GarminDB.Weight.row_count(GarminDB.GarminDB(self.replay_db_params_dict)), 0)
+        self.assertEqual(GarminDB.ActivityRecords.row_count(GarminDB.ActivitiesDB(self.replay_db_params_dict)), self.records)
+
+    def test_concurrent_commits(self):
+        # commits to different DBs from different threads, their records are journaled as they're committed
+        DB.journal = Journal(self.journal_dir, 10000)
+        def write_activity_records():
+            activities_buffer = WriteBuffer(GarminDB.ActivitiesDB(self.db_params_dict), 100)
+            write_records(activities_buffer, self.records, 120)
+            activities_buffer.sync()
+            write_records(activities_buffer, self.records, 130)
+            activities_buffer.close()
+        threads = [threading.Thread(target=write_nights, args=(self.db_params_dict, self.nights, datetime.time(7))),
+            threading.Thread(target=write_activity_records)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        DB.journal.close()
+        DB.journal = None
+        JournalReplay(self.replay_db_params_dict, None, 0).replay(self.journal_dir)
+        self.assertReplayed(GarminDB.GarminDB, GarminDB.SleepEvents)
+        self.assertReplayed(GarminDB.ActivitiesDB, GarminDB.ActivityRecords)
+        self.assertEqual(GarminDB.ActivityRecords.row_count(GarminDB.ActivitiesDB(self.replay_db_params_dict)), self.records)
+
+    def test_truncated_segment(self):
+        self.journal_rows()
+        segment = Journal.segments(self.journal_dir)[-1]
+        records = sum(1 for record in Journal.read(self.journal_dir))
+        with open(segment, 'r+b') as segment_file:
+            segment_file.truncate(os.path.getsize(segment) / 2)
+        truncated_records = sum(1 for record in Journal.read(self.journal_dir))
+        self.assertTrue(0 < truncated_records < records)
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
@@ -0,0 +1,249 @@
+#!/usr/bin/env python
+
+#
+# copyright Tom Goetz
+#
+
+import unittest, logging, datetime, tempfile, threading, csv, dateutil.parser
+
+from HealthDB import *
+
+
+logger = logging.getLogger(__name__)
+
+
+class SampleDB(DB):
+    Base = declarative_base()
+    db_name = 'sample'
+
+    def __init__(self, db_params_dict, debug=False):
+        DB.__init__(self, db_params_dict, debug)
+        SampleDB.Base.metadata.create_all(self.engine)
+
+
+def id_from_name(name):
+    return int(name.split('.')[0])
+
+
+class SampleRows(SampleDB.Base, DBObject):
+    __tablename__ = 'sample_rows'
+
+    id = Column(Integer, primary_key=True)
+    name = Column(String)
+    timestamp = Column(DateTime)
+    heart_rate = Column(Integer)
+    steps = Column(Integer)
+    distance = Column(Float)
+    duration = Column(Duration)
+
+    _col_mappings = {
+        'name' : ('id', id_from_name)
+    }
+    _col_translations = {
+        'distance' : float
+    }
+
+    @classmethod
+    def _find_query(cls, session, values_dict):
+        return session.query(cls).filter(cls.id == values_dict['id'])
+
+
+class TestRowMapper(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.db = SampleDB({'db_type' : 'sqlite', 'db_path' : tempfile.mkdtemp()})
+        cls.values_dict = {
+            'id'            : 1,
+            'timestamp'     : datetime.datetime.now(),
+            'heart_rate'    : 60,
+            'steps'         : None,
+            'distance'      : '1.5',
+            'duration'      : datetime.time(0, 5),
+            'unknown_1'     : 1,
+        }
+
+    def test_from_dict(self):
+        row = SampleRows.from_dict(self.db, {'name' : '1234.fit', 'steps' : None, 'distance' : '1.5', 'unknown_1' : 1})
+        # the name is kept as well as mapped to the id, unknown keys are dropped
+        self.assertEqual((row.id, row.name, row.steps, row.distance), (1234, '1234.fit', None, 1.5))
+        self.assertEqual(row.not_none_values, 3)
+
+    def test_new_rows_inserted(self):
+        # the values of new rows are set as committed values, check they're still inserted, and updated
+        SampleRows.create_or_update(self.db, self.values_dict)
+        row = self.db.session().query(SampleRows).get(1)
+        self.assertEqual((row.heart_rate, row.distance, row.duration), (60, 1.5, datetime.timedelta(0, 300)))
+        SampleRows.create_or_update(self.db, dict(self.values_dict, heart_rate=70))
+        self.assertEqual(self.db.session().query(SampleRows).get(1).heart_rate, 70)
+
+
+def write_csv_file(filename, rows):
+    # a FitBit style export
+    with open(filename, 'w') as csv_file:
+        writer = csv.writer(csv_file)
+        writer.writerow(['dateTime', 'activities-steps', 'activities-distance', 'body-weight', 'sleep-startTime', 'unmapped'])
+        day = datetime.date(2010, 1, 1)
+        for row in xrange(rows):
+            writer.writerow([str(day + datetime.timedelta(row)), row * 10, '%.2f' % (row / 100.0), '80.5', '23:%02d' % (row % 60), 'x'])
+        writer.writerow(['2030-01-01', '10', '1.0', '80'])
+
+
+class TestCsvImporter(unittest.TestCase):
+
+    rows = 5000
+    cols_map = {
+        'dateTime'          : ('day', CsvImporter.map_ymd_date),
+        'activities-steps'  : ('steps', CsvImporter.map_integer),
+        'activities-distance' : ('distance', CsvImporter.map_float),
+        'body-weight'       : ('weight', CsvImporter.map_kgs),
+        'sleep-startTime'   : ('sleep_start', CsvImporter.map_time),
+    }
+
+    @classmethod
+    def setUpClass(cls):
+        cls.filename = tempfile.mktemp(suffix='.csv')
+        write_csv_file(cls.filename, cls.rows)
+
+    def test_entries(self):
+        entries = []
+        CsvImporter(self.filename, self.cols_map, entries.extend).process_file(False)
+        self.assertEqual(len(entries), self.rows + 1)
+        self.assertEqual(entries[1], {'day' : datetime.date(2010, 1, 2), 'steps' : 10, 'distance' : 0.01, 'weight' : 80.5,
+            'sleep_start' : datetime.time(0, 23, 1), 'unmapped' : 'x'})
+        # a short row, the missing values are None
+        self.assertEqual(entries[-1], {'day' : datetime.date(2030, 1, 1), 'steps' : 10, 'distance' : 1.0, 'weight' : 80.0, 'sleep_start' : None,
+            'unmapped' : None})
+
+    def test_batches(self):
+        batches = []
+        CsvImporter(self.filename, self.cols_map, batches.append, 1000).process_file(False)
+        self.assertEqual([len(batch) for batch in batches], [1000] * 5 + [1])
+
+    def test_find_or_create_all(self):
+        db = SampleDB({'db_type' : 'sqlite', 'db_path' : tempfile.mkdtemp()})
+        values_dicts = [{'id' : id, 'heart_rate' : 60} for id in xrange(1000)]
+        self.assertEqual(SampleRows.find_or_create_all(db, values_dicts), 1000)
+        self.assertEqual(SampleRows.find_or_create_all(db, values_dicts + [{'id' : 1000, 'heart_rate' : 60}]), 1)
+        self.assertEqual(SampleRows.row_count(db), 1001)
+
+
+class TestWriteBuffer(unittest.TestCase):
+
+    def setUp(self):
+        self.db_params_dict = {'db_type' : 'sqlite', 'db_path' : tempfile.mkdtemp()}
+        self.db = SampleDB(self.db_params_dict)
+        self.failed_commits = 0
+        self.commit_failures = 0
+
+    def tearDown(self):
+        if event.contains(self.db.session_maker, 'before_commit', self.fail_commit):
+            event.remove(self.db.session_maker, 'before_commit', self.fail_commit)
+
+    def fail_commit(self, session):
+        # as when another writer holds the DB lock
+        if self.failed_commits < self.commit_failures:
+            self.failed_commits += 1
+            raise OperationalError('COMMIT', {}, Exception('database is locked'))
+
+    def fail_commits(self, commit_failures):
+        self.commit_failures = commit_failures
+        event.listen(self.db.session_maker, 'before_commit', self.fail_commit)
+
+    def write_rows(self, rows, batch_size=1000):
+        write_buffer = WriteBuffer(self.db, batch_size)
+        for row in xrange(rows):
+            write_buffer.insert(SampleRows, {'id' : row, 'heart_rate' : 60})
+        write_buffer.close()
+        return write_buffer
+
+    def test_batches(self):
+        write_buffer = self.write_rows(2500)
+        self.assertEqual((write_buffer.rows_written, write_buffer.write_errors), (2500, 0))
+        self.assertEqual(SampleRows.row_count(self.db), 2500)
+
+    def test_failed_commit_retried(self):
+        self.fail_commits(1)
+        write_buffer = self.write_rows(10)
+        self.assertEqual(self.failed_commits, 1)
+        self.assertEqual((write_buffer.rows_written, write_buffer.write_errors), (10, 0))
+        self.assertEqual(SampleRows.row_count(self.db), 10)
+
+    def test_failed_commits_counted(self):
+        # every commit fails, the batch attempts then the commit of each row
+        self.fail_commits(DB.max_commit_attempts + 10)
+        write_buffer = self.write_rows(10)
+        self.assertEqual((write_buffer.rows_written, write_buffer.write_errors), (0, 10))
+        self.assertEqual(SampleRows.row_count(self.db), 0)
+
+    def test_unbuffered_write_retried(self):
+        self.fail_commits(1)
+        SampleRows.create_or_update(self.db, {'id' : 1, 'heart_rate' : 60})
+        self.assertEqual(self.failed_commits, 1)
+        self.assertEqual(SampleRows.find_or_create_all(self.db, [{'id' : id, 'heart_rate' : 60} for id in xrange(10)]), 9)
+        self.assertEqual(SampleRows.row_count(self.db), 10)
+
+    def test_unbuffered_write_failed(self):
+        self.fail_commits(DB.max_commit_attempts)
+        self.assertRaises(OperationalError, SampleRows.create, self.db, {'id' : 1, 'heart_rate' : 60})
+        self.assertEqual(self.failed_commits, DB.max_commit_attempts)
+        self.assertEqual(SampleRows.row_count(self.db), 0)
+
+    def test_concurrent_writers(self):
+        # buffered and unbuffered writers on different threads share the DB file, as the update_garmin stages do
+        commit_errors = DB.commit_errors
+        write_buffers = []
+        def write_rows(first_row):
+            write_buffer = WriteBuffer(SampleDB(self.db_params_dict), 100)
+            for row in xrange(first_row, first_row + 1000):
+                write_buffer.insert(SampleRows, {'id' : row, 'heart_rate' : 60})
+                if row % 100 == 0:
+                    SampleRows.create_or_update(SampleDB(self.db_params_dict), {'id' : -row - 1, 'heart_rate' : 60})
+            write_buffer.close()
+            write_buffers.append(write_buffer)
+        threads = [threading.Thread(target=write_rows, args=(thread * 1000,)) for thread in xrange(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(sum(write_buffer.write_errors for write_buffer in write_buffers), 0)
+        self.assertEqual(DB.commit_errors, commit_errors)
+        self.assertEqual(SampleRows.row_count(self.db), 4040)
+
+    def test_bad_row(self):
+        write_buffer = WriteBuffer(self.db, 20)
+        for row in xrange(10):
+            write_buffer.insert(SampleRows, {'id' : row, 'heart_rate' : 60})
+        # a duplicate key fails the batch's commit, the other rows are written one at a time
+        write_buffer.insert(SampleRows, {'id' : 5, 'heart_rate' : 70})
+        write_buffer.close()
+        self.assertEqual((write_buffer.rows_written, write_buffer.write_errors), (10, 1))
+        self.assertEqual(SampleRows.row_count(self.db), 10)
+
+
+class TestDateParser(unittest.TestCase):
+
+    def test_formats(self):
+        self.assertEqual(DateParser().parse('2018-10-14T05:37:00.0'), datetime.datetime(2018, 10, 14, 5, 37))
+        self.assertEqual(DateParser().parse('2018-10-14'), datetime.datetime(2018, 10, 14))
+        self.assertEqual(DateParser(ignoretz=True).parse('2018-10-14T05:37:00.500Z'), datetime.datetime(2018, 10, 14, 5, 37, 0, 500000))
+        self.assertEqual(DateParser(["%m/%d/%y %H:%M", "%m/%d/%y"], fallback=False).parse('10/14/18 05:37'), datetime.datetime(2018, 10, 14, 5, 37))
+
+    def test_fallback(self):
+        parser = DateParser()
+        self.assertEqual(parser.parse('Oct 14 2018 5:37'), datetime.datetime(2018, 10, 14, 5, 37))
+        self.assertEqual(parser.fallbacks, 1)
+        self.assertEqual(parser.parse('2018-10-14T05:37:00+02:00'), dateutil.parser.parse('2018-10-14T05:37:00+02:00'))
+        self.assertRaises(ValueError, DateParser(fallback=False).parse, 'Oct 14 2018')
+
+    def test_csv_importer(self):
+        self.assertEqual(CsvImporter.map_ymd_date(False, '2018-10-14'), datetime.date(2018, 10, 14))
+        self.assertEqual(CsvImporter.map_ymd_date(False, '10/14/18'), None)
+        self.assertEqual(CsvImporter.map_mdy_date(False, '10/14/18 05:37'), datetime.datetime(2018, 10, 14, 5, 37))
+        self.assertEqual(CsvImporter.map_mdy_date(False, '10/14/18'), datetime.datetime(2018, 10, 14))
+        self.assertEqual(CsvImporter.map_time(False, '23:15'), datetime.time(0, 23, 15))
+        self.assertEqual(CsvImporter.map_time(False, ''), None)
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
@@ -0,0 +1,349 @@
+#!/usr/bin/env python
+
+#
+# copyright Tom Goetz
+#
+
+import os, sys, getopt, logging, datetime, time, threading, glob
+# strptime imports this lazily, which isn't thread safe, so import it before the stage threads run
+import _strptime
+
+import GarminDB
+import HealthDB
+import download_garmin
+import import_garmin
+import import_garmin_activities
+import analyze_garmin
+from ActivityAssembler import ActivityAssembler
+from FileValidator import FileValidator
+
+
+root_logger = logging.getLogger()
+logger = logging.getLogger(__file__)
+
+
+class Stage():
+
+    def __init__(self, name, function, depends, lock):
+        self.name = name
+        self.function = function
+        self.depends = depends
+        self.lock = lock
+        self.done = threading.Event()
+        self.succeeded = False
+        self.start = None
+        self.elapsed = None
+
+
+#
+# Runs stages on their own threads, each one starting as soon as the stages it depends on have finished. A stage whose
+# dependencies failed is skipped. Stages that share a lock, ex: because they write to the same sqlite DB, run one at a time.
+#
+class StageGraph():
+
+    def __init__(self):
+        self.stages = []
+
+    def add(self, name, function, depends=[], lock=None):
+        self.stages.append(Stage(name, function, [self.stage(depend) for depend in depends], lock))
+
+    def stage(self, name):
+        return next(stage for stage in self.stages if stage.name == name)
+
+    def __run_stage(self, stage):
+        try:
+            for depend in stage.depends:
+                depend.done.wait()
+            failed = [depend.name for depend in stage.depends if not depend.succeeded]
+            if len(failed) > 0:
+                logger.error("Skipping %s, failed: %s", stage.name, ', '.join(failed))
+                return
+            if stage.lock:
+                stage.lock.acquire()
+            try:
+                logger.info("Starting %s", stage.name)
+                stage.start = time.time()
+                stage.function()
+                stage.succeeded = True
+            finally:
+                stage.elapsed = time.time() - stage.start
+                if stage.lock:
+                    stage.lock.release()
+        except Exception as e:
+            logger.exception("%s failed: %s", stage.name, str(e))
+        finally:
+            stage.done.set()
+
+    def run(self):
+        start = time.time()
+        threads = [threading.Thread(target=self.__run_stage, name=stage.name, args=(stage,)) for stage in self.stages]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.log_timing(time.time() - start)
+        return all(stage.succeeded for stage in self.stages)
+
+    def log_timing(self, elapsed):
+        for stage in self.stages:
+            if stage.elapsed is None:
+                logger.info("%-20s skipped", stage.name)
+            else:
+                logger.info("%-20s %8.1f s %s", stage.name, stage.elapsed, 'ok' if stage.succeeded else 'failed')
+        logger.info("%-20s %8.1f s (%.1f s if run one after the other)", 'total', elapsed,
+            sum(stage.elapsed for stage in self.stages if stage.elapsed is not None))
+
+
+#
+# Does what 'make update_garmin' does, downloading the data since the last update, importing it, and updating the summary DB,
+# in one process that logs in once and shares the DBs between the stages.
+#
+class GarminUpdate():
+
+    def __init__(self, db_params_dict, health_data_dir, english_units, debug, fit_cache_dir=None):
+        self.db_params_dict = db_params_dict
+        self.english_units = english_units
+        self.debug = debug
+        self.fit_cache_dir = fit_cache_dir
+        self.fit_file_dir = health_data_dir + '/FitFiles'
+        self.monitoring_dir = self.fit_file_dir + '/' + str(datetime.datetime.now().year) + '_Monitoring'
+        self.activities_dir = self.fit_file_dir + '/Activities'
+        self.sleep_dir = health_data_dir + '/Sleep'
+        self.weight_dir = health_data_dir + '/Weight'
+        self.rhr_dir = health_data_dir + '/RHR'
+        for directory in [self.monitoring_dir, self.activities_dir, self.sleep_dir, self.weight_dir, self.rhr_dir]:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+        # find where the last update stopped before anything is imported, the engines are shared by the stage threads but
+        # sqlite sessions can't be
+        garmindb = GarminDB.GarminDB(db_params_dict)
+        self.monitoring_days = download_garmin.latest_monitoring_days(GarminDB.MonitoringDB(db_params_dict))
+        self.sleep_days = download_garmin.latest_sleep_days(garmindb)
+        self.last_weight = GarminDB.Weight.latest_time(garmindb)
+        self.last_rhr = GarminDB.RestingHeartRate.latest_time(garmindb)
+        # shared by the import stages, so the files skipped by all of them are summarized together, checked in-process since the
+        # stages run in threads
+        self.validator = FileValidator(garmindb, GarminDB.Quarantine, 1)
+        self.download = None
+
+    def login(self, username, password, rate, concurrency, base_url=None, sso_url=None, archive=False):
+        self.download = download_garmin.Download(rate, concurrency, base_url=base_url, sso_url=sso_url, archive=archive)
+        return self.download.login(username, password)
+
+    def close(self):
+        if self.download:
+            self.download.close()
+
+    def download_monitoring(self):
+        (date, days) = self.monitoring_days
+        if days > 0:
+            self.download.get_monitoring(self.monitoring_dir, date, days)
+
+    def import_monitoring(self):
+        for directory in glob.glob(self.fit_file_dir + '/*Monitoring*/'):
+            gfd = import_garmin.GarminFitData(None, directory.rstrip('/'), True, self.english_units, self.debug, self.fit_cache_dir, self.validator)
+            self.validator.validate(gfd)
+            if gfd.file_count() > 0:
+                gfd.process_files(self.db_params_dict)
+
+    def download_activities(self):
+        self.download.get_activities(self.activities_dir, 1000, False, GarminDB.ActivitiesDB(self.db_params_dict))
+
+    def import_activities(self):
+        assembler = ActivityAssembler(self.db_params_dict, self.debug)
+        gjsd = import_garmin_activities.GarminJsonSummaryData(self.db_params_dict, None, self.activities_dir, True, self.english_units, self.debug,
+            assembler, self.validator)
+        gdjd = import_garmin_activities.GarminJsonDetailsData(self.db_params_dict, None, self.activities_dir, True, self.english_units, self.debug,
+            assembler, self.validator)
+        gtd = import_garmin_activities.GarminTcxData(None, self.activities_dir, True, self.english_units, self.debug, self.validator)
+        ggd = import_garmin_activities.GarminGpxData(None, self.activities_dir, True, self.english_units, self.debug, self.validator)
+        gfd = import_garmin_activities.GarminFitData(None, self.activities_dir, True, self.english_units, self.debug, self.fit_cache_dir,
+            self.validator)
+        self.validator.validate(gjsd, gdjd, gtd, ggd, gfd)
+        try:
+            if gjsd.file_count() > 0:
+                gjsd.process_files()
+            if gdjd.file_count() > 0:
+                gdjd.process_files()
+            if gtd.file_count() > 0:
+                gtd.process_files(self.db_params_dict, assembler)
+            if ggd.file_count() > 0:
+                ggd.process_files(self.db_params_dict, assembler)
+            if gfd.file_count() > 0:
+                gfd.process_files(self.db_params_dict, assembler)
+        finally:
+            # the laps and records of the imported files are already written, so are their activity rows if the import ends early
+            assembler.write()
+
+    def download_sleep(self):
+        (date, days) = self.sleep_days
+        if days > 0:
+            self.download.get_sleep(self.sleep_dir, date, days)
+
+    def import_sleep(self):
+        gsd = import_garmin.GarminSleepData(None, self.sleep_dir, True, self.debug, validator=self.validator)
+        self.validator.validate(gsd)
+        if gsd.file_count() > 0:
+            gsd.process_files(self.db_params_dict)
+
+    def download_weight(self):
+        self.download.save_weight(self.weight_dir, self.last_weight)
+
+    def import_weight(self):
+        gwd = import_garmin.GarminWeightData(None, self.weight_dir, True, self.english_units, self.debug, self.validator)
+        self.validator.validate(gwd)
+        if gwd.file_count() > 0:
+            gwd.process_files(self.db_params_dict)
+
+    def download_rhr(self):
+        self.download.save_rhr(self.rhr_dir, self.last_rhr)
+
+    def import_rhr(self):
+        grhrd = import_garmin.GarminRhrData(None, self.rhr_dir, True, self.debug, self.validator)
+        self.validator.validate(grhrd)
+        if grhrd.file_count() > 0:
+            grhrd.process_files(self.db_params_dict)
+
+    def summary(self):
+        analyze = analyze_garmin.Analyze(self.db_params_dict, self.debug - 1)
+        analyze.get_files_stats()
+        analyze.get_weight_stats()
+        analyze.get_stress_stats()
+        analyze.get_rhr_stats()
+        analyze.get_sleep_stats()
+        analyze.get_activities_stats()
+        analyze.get_monitoring_years()
+        analyze.summary()
+        analyze.summary_stats()
+
+    def stage_graph(self):
+        graph = StageGraph()
+        # the imports run at the same time, their writes to a shared sqlite DB file, ex: garmin.db, take turns, see DB.writing
+        data_types = ['monitoring', 'activities', 'sleep', 'weight', 'rhr']
+        for data_type in data_types:
+            graph.add('download_' + data_type, getattr(self, 'download_' + data_type))
+            graph.add('import_' + data_type, getattr(self, 'import_' + data_type), ['download_' + data_type])
+        graph.add('summary', self.summary, ['import_' + data_type for data_type in data_types])
+        return graph
+
+    def update(self):
+        succeeded = self.stage_graph().run()
+        self.validator.log_summary()
+        return succeeded
+
+
+def usage(program):
+    print '%s -u <username> -p <password> [--sqlite <db dir> | --mysql <user,password,host>] ...' % program
+    print '  downloads and imports the Garmin Connect data since the last update and updates the summary DB, like make update_garmin'
+    print '  -d <health data dir> where the downloaded files are kept, defaults to ~/HealthData'
+    print '  -e use english units: feet, lbs, etc'
+    print '  -z save downloaded JSON and FIT files to compressed per month archives'
+    print '  --rate <requests per second> limit the request rate, defaults to 1'
+    print '  --concurrency <n> number of requests that may be in progress at once, defaults to 4'
+    print '  --base_url <url> --sso_url <url> download from somewhere other than Garmin Connect, ex: garmin_connect_standin.py'
+    print '  --fit_cache_dir <dir> keep the decoded FIT messages in dir and reuse them when the same files are imported again'
+    print '  --journal_dir <dir> journal the rows written to the DBs in dir, so the DBs can be rebuilt with replay_journal.py'
+    print '  -t <level> turn on debug tracing'
+    sys.exit()
+
+def main(argv):
+    debug = 0
+    english_units = False
+    health_data_dir = os.path.expanduser('~/HealthData')
+    db_params_dict = {}
+    username = None
+    password = None
+    rate = 1.0
+    concurrency = 4
+    archive = False
+    base_url = None
+    sso_url = None
+    fit_cache_dir = None
+    journal_dir = None
+
+    try:
+        opts, args = getopt.getopt(argv,"d:ep:s:t:u:z",
+            ["archive", "base_url=", "concurrency=", "dir=", "english", "fit_cache_dir=", "journal_dir=", "mysql=", "password=", "rate=", "sqlite=", "sso_url=",
+             "trace=", "username="])
+    except getopt.GetoptError:
+        usage(sys.argv[0])
+
+    for opt, arg in opts:
+        if opt == '-h':
+            usage(sys.argv[0])
+        elif opt in ("-t", "--trace"):
+            debug = int(arg)
+        elif opt in ("-d", "--dir"):
+            logger.debug("Health data dir: " + arg)
+            health_data_dir = arg
+        elif opt in ("-e", "--english"):
+            english_units = True
+        elif opt in ("-z", "--archive"):
+            logger.debug("Archive")
+            archive = True
+        elif opt in ("-u", "--username"):
+            logger.debug("Username: " + arg)
+            username = arg
+        elif opt in ("-p", "--password"):
+            logger.debug("Password: " + arg)
+            password = arg
+        elif opt == "--rate":
+            logger.debug("Rate: " + arg)
+            rate = float(arg)
+        elif opt == "--concurrency":
+            logger.debug("Concurrency: " + arg)
+            concurrency = int(arg)
+        elif opt == "--base_url":
+            logger.debug("Base URL: " + arg)
+            base_url = arg
+        elif opt == "--sso_url":
+            logger.debug("SSO URL: " + arg)
+            sso_url = arg
+        elif opt == "--fit_cache_dir":
+            logger.debug("FIT cache dir: " + arg)
+            fit_cache_dir = arg
+        elif opt == "--journal_dir":
+            logger.debug("Journal dir: " + arg)
+            journal_dir = arg
+        elif opt in ("-s", "--sqlite"):
+            logging.debug("Sqlite DB path: %s" % arg)
+            db_params_dict['db_type'] = 'sqlite'
+            db_params_dict['db_path'] = arg
+        elif opt in ("--mysql"):
+            logging.debug("Mysql DB string: %s" % arg)
+            db_args = arg.split(',')
+            db_params_dict['db_type'] = 'mysql'
+            db_params_dict['db_username'] = db_args[0]
+            db_params_dict['db_password'] = db_args[1]
+            db_params_dict['db_host'] = db_args[2]
+
+    if debug > 0:
+        root_logger.setLevel(logging.DEBUG)
+    else:
+        root_logger.setLevel(logging.INFO)
+
+    if not username or not password:
+        print "Missing arguments: need username and password"
+        usage(sys.argv[0])
+    if len(db_params_dict) == 0:
+        print "Missing arguments: must specify <db params> with --sqlite or --mysql"
+        usage(sys.argv[0])
+
+    if journal_dir:
+        HealthDB.DB.journal = HealthDB.Journal(journal_dir)
+    update = GarminUpdate(db_params_dict, health_data_dir, english_units, debug, fit_cache_dir)
+    try:
+        if not update.login(username, password, rate, concurrency, base_url, sso_url, archive):
+            print "Failed to log in to Garmin Connect"
+            sys.exit(1)
+        succeeded = update.update()
+    finally:
+        update.close()
+        if HealthDB.DB.journal is not None:
+            HealthDB.DB.journal.close()
+    if not succeeded:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])